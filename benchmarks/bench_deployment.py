@@ -0,0 +1,209 @@
+"""
+Benchmarks for the manifest rendering and naming that runs on every deploy
+
+Each case reports operations per second and the peak memory allocated by a
+single operation. Results are compared to the stored baselines and the run
+fails (exit status 1) when a case is slower, or allocates more, than its
+baseline allows.
+
+    python3 benchmarks/bench_deployment.py              # compare to baseline
+    python3 benchmarks/bench_deployment.py --save       # record new baseline
+    python3 benchmarks/bench_deployment.py -k secret    # only matching cases
+
+Throughput is compared after scaling by a reference workload measured in
+the same run, which absorbs most of the difference between machines. Still,
+record baselines on the kind of host that checks them.
+
+"""
+
+import argparse
+import contextlib
+import gc
+import json
+import os
+import sys
+import time
+import timeit
+import tracemalloc
+
+here = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(os.path.dirname(here), 'service'))
+
+from deployment.gce import (
+    b64,
+    digest,
+    k8s_repcon_description,
+    k8s_secret_description,
+    k8s_service_description,
+    make_rc_name,
+    render,
+    rendered,
+)
+
+default_baseline = os.path.join(here, 'baseline.json')
+
+
+def config_text(keys, value="value-{}"):
+    """ return a key=value config with the given number of keys """
+    return ''.join(
+        "KEY_{}={}\n".format(n, value.format(n)) for n in range(keys)
+    )
+
+
+long_branch = "feature/" + "really-long-branch-name-" * 8
+unicode_value = "ünicøde-☃-\U0001f680-{}"
+large_value = "x" * 65536
+
+configs = {
+    "1": config_text(1),
+    "100": config_text(100),
+    "5000": config_text(5000),
+    "100-unicode": config_text(100, unicode_value),
+}
+
+
+def cases():
+    """ return (name, callable) pairs for every benchmark """
+    yield "b64/short", lambda: b64("mock-value")
+    yield "b64/unicode", lambda: b64(unicode_value)
+    yield "b64/64KiB", lambda: b64(large_value)
+    yield "b64/bytes", lambda: b64(b"mock-value")
+
+    for keys, text in sorted(configs.items()):
+        yield "digest/{}-keys".format(keys), lambda t=text: digest(t)
+        yield "secret/{}-keys".format(keys), (
+            lambda t=text: k8s_secret_description(t, 12345))
+
+    yield "service/short", (
+        lambda: k8s_service_description("svc", "master", 8000))
+    yield "service/long-branch", (
+        lambda: k8s_service_description("my-service", long_branch, 8000))
+
+    yield "rc_name/short", (
+        lambda: make_rc_name("master", "svc", "abc1234def", 12345))
+    yield "rc_name/long-branch", (
+        lambda: make_rc_name(long_branch, "my-long-service-name", "a" * 40, 1))
+
+    for keys in ["1", "5000"]:
+        text = configs[keys]
+        yield "repcon/{}-keys".format(keys), (
+            lambda t=text: k8s_repcon_description(
+                "my-service", long_branch, 12345, "a" * 40, "gcr.io/x/y:z", t))
+
+        def uncached(t=text):
+            rendered.clear()
+            render("my-service", long_branch, 12345, t, "a" * 40, "img")
+        yield "render/{}-keys".format(keys), uncached
+
+        yield "render/{}-keys-cached".format(keys), (
+            lambda t=text: render(
+                "my-service", long_branch, 12345, t, "a" * 40, "img"))
+
+
+def reference():
+    """ a fixed pure python workload used to calibrate for machine speed """
+    total = 0
+    for n in range(1000):
+        total += len("{}={}".format(n, n * n))
+    return total
+
+
+def measure(fn, repeat=7):
+    """ return ops/sec (best of repeats) and peak bytes for one call """
+    # cpu time keeps other processes on the host out of the measurement
+    timer = timeit.Timer(fn, timer=time.process_time)
+    number, _ = timer.autorange()
+    best = min(timer.repeat(repeat=repeat, number=number)) / number
+
+    gc.collect()
+    tracemalloc.start()
+    fn()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return {"ops_per_sec": 1.0 / best, "peak_bytes": peak}
+
+
+def compare(name, result, baseline, speed, tolerance):
+    """
+    return a list of regressions of result against the baseline
+
+    speed is this machine's reference throughput relative to the baseline's
+
+    """
+
+    regressions = []
+    if name not in baseline:
+        return regressions
+    expected = baseline[name]
+    floor = expected["ops_per_sec"] * speed * (1 - tolerance)
+    if result["ops_per_sec"] < floor:
+        regressions.append("{}: {:.0f} ops/sec is below {:.0f}".format(
+            name, result["ops_per_sec"], floor))
+    ceiling = expected["peak_bytes"] * (1 + tolerance)
+    if result["peak_bytes"] > ceiling:
+        regressions.append("{}: {} bytes is above {:.0f}".format(
+            name, result["peak_bytes"], ceiling))
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument("--baseline", default=default_baseline)
+    parser.add_argument("--save", action="store_true",
+                        help="record these results as the baseline")
+    parser.add_argument("--tolerance", type=float, default=0.3,
+                        help="allowed fractional regression (default 0.3)")
+    parser.add_argument("-k", dest="match", default="",
+                        help="only run cases containing this string")
+    args = parser.parse_args(argv)
+
+    try:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+    except FileNotFoundError:
+        baseline = {}
+
+    results = {"reference": measure(reference)}
+    if "reference" in baseline:
+        speed = (results["reference"]["ops_per_sec"] /
+                 baseline["reference"]["ops_per_sec"])
+    else:
+        speed = 1.0
+    print("reference speed {:.2f}x of baseline".format(speed))
+
+    regressions = []
+    print("{:<28} {:>14} {:>14} {:>9}".format(
+        "case", "ops/sec", "peak bytes", "vs base"))
+    for name, fn in cases():
+        if args.match not in name:
+            continue
+        # the secret description prints the config it encodes
+        with open(os.devnull, 'w') as devnull, \
+                contextlib.redirect_stdout(devnull):
+            result = measure(fn)
+        results[name] = result
+        if name in baseline:
+            ratio = "{:.2f}x".format(
+                result["ops_per_sec"] / baseline[name]["ops_per_sec"] / speed)
+        else:
+            ratio = "new"
+        print("{:<28} {:>14.0f} {:>14} {:>9}".format(
+            name, result["ops_per_sec"], result["peak_bytes"], ratio))
+        regressions += compare(name, result, baseline, speed, args.tolerance)
+
+    if args.save:
+        baseline.update(results)
+        with open(args.baseline, 'w') as f:
+            json.dump(baseline, f, indent=2, sort_keys=True)
+            f.write('\n')
+        print("saved baseline to {}".format(args.baseline))
+        return 0
+
+    for regression in regressions:
+        print("REGRESSION {}".format(regression))
+    return 1 if regressions else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,367 @@
+"""
+End to end load test of the herd webhooks against a local postgres
+
+Starts a throwaway postgres (testing.postgresql) loaded with the herd
+schema, serves the bottle app in this process and replays CI traffic at it:
+for every push a legacy `/commit/...` then `/build/...`, and a
+`/v1/build/...`, across many services and branches. Kubernetes calls go to
+a local stub so only the api and database path is measured.
+
+    python3 benchmarks/webhook_load.py --services 20 --concurrency 8
+
+Reports throughput, p50/p95/p99 latency and sql statements per request for
+each route.
+
+"""
+
+import argparse
+import glob
+import json
+import os
+import random
+import re
+import sys
+import threading
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+from wsgiref.simple_server import make_server, WSGIRequestHandler, WSGIServer
+
+import psycopg2
+import requests
+import testing.postgresql
+
+here = os.path.dirname(os.path.abspath(__file__))
+service_dir = os.path.join(os.path.dirname(here), 'service')
+sys.path.insert(0, service_dir)
+
+# The legacy routes use the herd 1.x model, which lives in its own database.
+# These are the tables and columns factories.py and deployment/gce.py use.
+legacy_schema = """
+create table service (
+    service_id serial primary key,
+    service_name varchar(100) not null unique
+);
+create table feature (
+    feature_id serial primary key,
+    feature_name varchar(100) not null,
+    service_id int not null references service
+);
+create table branch (
+    branch_id serial primary key,
+    branch_name varchar(100) not null,
+    feature_id int not null references feature
+);
+create table iteration (
+    iteration_id serial primary key,
+    commit_hash varchar(100) not null,
+    branch_id int not null references branch,
+    image_name varchar(100)
+);
+create table config (
+    config_id serial primary key,
+    key_value_pairs text not null default ''
+);
+create table environment (
+    environment_id serial primary key,
+    settings text not null default '',
+    infrastructure_backend varchar(100),
+    environment_name varchar(100)
+);
+create table deployment_pipeline (
+    deployment_pipeline_id serial primary key,
+    branch_id int not null references branch,
+    config_id int not null references config,
+    environment_id int not null references environment,
+    automatic boolean not null default false
+);
+create table release (
+    release_id serial primary key,
+    iteration_id int not null references iteration,
+    deployment_pipeline_id int not null references deployment_pipeline,
+    unique (iteration_id, deployment_pipeline_id)
+);
+"""
+
+
+def schema_version(path):
+    """ sort key for schema-x.y.z.sql files """
+    return tuple(
+        int(n) for n in re.findall(r'\d+', os.path.basename(path))
+    )
+
+
+def pg_init(pg):
+    """ load the herd 2.x schema, and a legacy database beside it """
+    conn = psycopg2.connect(**pg.dsn())
+    cursor = conn.cursor()
+    schemas = glob.glob(os.path.join(service_dir, 'schema-*.sql'))
+    for path in sorted(schemas, key=schema_version):
+        with open(path) as schema:
+            cursor.execute(schema.read())
+    conn.commit()
+    conn.autocommit = True
+    cursor.execute("create database herd_legacy")
+    cursor.close()
+    conn.close()
+
+    conn = psycopg2.connect(**dict(pg.dsn(), database='herd_legacy'))
+    cursor = conn.cursor()
+    cursor.execute(legacy_schema)
+    conn.commit()
+    cursor.close()
+    conn.close()
+
+
+class K8sStub(BaseHTTPRequestHandler):
+    """ answers every kubernetes call with an empty success """
+
+    def reply(self, code, body):
+        payload = json.dumps(body).encode()
+        self.send_response(code)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def drain(self):
+        length = int(self.headers.get("Content-Length", 0))
+        if length:
+            self.rfile.read(length)
+
+    def do_GET(self):
+        self.reply(200, {"items": [], "status": {"replicas": 0}})
+
+    def do_POST(self):
+        self.drain()
+        self.reply(201, {})
+
+    def do_PATCH(self):
+        self.drain()
+        self.reply(200, {})
+
+    def do_DELETE(self):
+        self.reply(200, {})
+
+    def log_message(self, *args):
+        pass
+
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class ThreadingWSGIServer(ThreadingMixIn, WSGIServer):
+    daemon_threads = True
+
+
+class QuietHandler(WSGIRequestHandler):
+    def log_request(self, *args, **kwargs):
+        pass
+
+
+def serve(server):
+    """ run a server in a daemon thread and return it """
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    return server
+
+
+class StatementCounter(object):
+    """
+    WSGI middleware collecting the sql statements each request executes
+
+    The api aggregates statements per request (see sqlstats); they are
+    attributed to the route of the request.
+
+    """
+
+    def __init__(self, app):
+        self.app = app
+        self.lock = threading.Lock()
+        self.statements = {}
+
+    def __call__(self, environ, start_response):
+        import sqlstats
+        try:
+            return self.app(environ, start_response)
+        finally:
+            stats = sqlstats.request_stats()
+            route = route_of(environ.get('PATH_INFO', ''))
+            with self.lock:
+                self.statements.setdefault(route, []).append(
+                    stats.count if stats is not None else 0)
+
+
+def route_of(path):
+    """ name the route a path belongs to """
+    for prefix, name in [("/v1/build/", "v1 build"),
+                         ("/commit/", "legacy commit"),
+                         ("/build/", "legacy build")]:
+        if path.startswith(prefix):
+            return name
+    return "other"
+
+
+def traffic(services, branches, pushes, retry_rate):
+    """
+    return a shuffled list of jobs, each an ordered list of paths
+
+    A job is one CI run for a push: the legacy commit and build webhooks in
+    order, and the v1 build. Some builds are retried as CI would.
+
+    """
+
+    jobs = []
+    for s in range(services):
+        service_name = "service-{}".format(s)
+        for b in range(branches):
+            branch_name = "branch-{}".format(b)
+            merge_base = "{:032x}".format(random.getrandbits(128))
+            for p in range(pushes):
+                commit_hash = "{:032x}".format(random.getrandbits(128))
+                image_name = "us.gcr.io/herd/{}:{}".format(
+                    service_name, commit_hash[:7])
+                job = [
+                    "/commit/{}/{}/{}/{}".format(
+                        service_name, branch_name, branch_name, commit_hash),
+                    "/build/{}/{}".format(commit_hash, image_name),
+                    "/v1/build/{}/{}/{}/{}/{}".format(
+                        service_name, branch_name, merge_base,
+                        commit_hash, image_name),
+                ]
+                if random.random() < retry_rate:
+                    job += job[1:]
+                jobs.append(job)
+    random.shuffle(jobs)
+    return jobs
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    if not values:
+        return float('nan')
+    index = min(len(values) - 1, int(round(fraction * (len(values) - 1))))
+    return values[index]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument("--services", type=int, default=20)
+    parser.add_argument("--branches", type=int, default=3,
+                        help="branches per service")
+    parser.add_argument("--pushes", type=int, default=5,
+                        help="pushes per branch")
+    parser.add_argument("--retry-rate", type=float, default=0.1,
+                        help="fraction of builds CI sends twice")
+    parser.add_argument("--concurrency", type=int, default=8,
+                        help="concurrent CI clients")
+    parser.add_argument("--threaded", action="store_true",
+                        help="serve with a thread per request instead of "
+                             "the default single threaded server")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args(argv)
+    random.seed(args.seed)
+
+    postgresql = testing.postgresql.PostgresqlFactory(
+        cache_initialized_db=True,
+        on_initialized=pg_init,
+    )
+    pg = postgresql()
+    k8s = serve(ThreadingHTTPServer(("127.0.0.1", 0), K8sStub))
+    try:
+        dsn = pg.dsn()
+        os.environ.update({
+            # herd 2.x model
+            'pg-host': dsn['host'],
+            'pg-port': str(dsn['port']),
+            'pg-database': dsn['database'],
+            'pg-user': dsn['user'],
+            # legacy model
+            'pghost': dsn['host'],
+            'pgport': str(dsn['port']),
+            'pgdatabase': 'herd_legacy',
+            'pguser': dsn['user'],
+            'default_infrastructure_backend': 'gce',
+            'kubeproxy': "127.0.0.1:{}".format(k8s.server_port),
+            'k8spassword': 'stub',
+            'v2_model': 'false',
+        })
+
+        import bottle
+        import routes
+        app = StatementCounter(bottle.default_app())
+        server_class = ThreadingWSGIServer if args.threaded else WSGIServer
+        server = serve(make_server(
+            "127.0.0.1", 0, app, server_class, QuietHandler))
+        base = "http://127.0.0.1:{}".format(server.server_port)
+
+        jobs = traffic(args.services, args.branches, args.pushes,
+                       args.retry_rate)
+        latencies = {}
+        errors = {}
+        lock = threading.Lock()
+
+        def run_job(job):
+            session = requests.Session()
+            session.headers["X-Authenticated-Token"] = "CI"
+            for path in job:
+                started = time.perf_counter()
+                response = session.get(base + path)
+                elapsed = time.perf_counter() - started
+                route = route_of(path)
+                with lock:
+                    latencies.setdefault(route, []).append(elapsed)
+                    if response.status_code >= 400:
+                        errors[route] = errors.get(route, 0) + 1
+
+        print("replaying {} requests in {} jobs with {} clients".format(
+            sum(len(job) for job in jobs), len(jobs), args.concurrency))
+        # keep the app's own output, and tracebacks, out of the report
+        stdout, stderr = sys.stdout, sys.stderr
+        sys.stdout = sys.stderr = open(os.devnull, 'w')
+        started = time.perf_counter()
+        try:
+            with ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+                list(pool.map(run_job, jobs))
+        finally:
+            elapsed = time.perf_counter() - started
+            sys.stdout.close()
+            sys.stdout, sys.stderr = stdout, stderr
+        server.shutdown()
+
+        total = sum(len(v) for v in latencies.values())
+        print("{} requests in {:.2f}s, {:.1f} requests/sec".format(
+            total, elapsed, total / elapsed))
+        print("{:<14} {:>7} {:>7} {:>9} {:>9} {:>9} {:>11}".format(
+            "route", "count", "errors", "p50 ms", "p95 ms", "p99 ms",
+            "sql/req"))
+        for route in sorted(latencies):
+            values = latencies[route]
+            statements = app.statements.get(route, [])
+            print("{:<14} {:>7} {:>7} {:>9.1f} {:>9.1f} {:>9.1f} {:>11.1f}"
+                  .format(
+                      route,
+                      len(values),
+                      errors.get(route, 0),
+                      percentile(values, 0.50) * 1000,
+                      percentile(values, 0.95) * 1000,
+                      percentile(values, 0.99) * 1000,
+                      sum(statements) / max(len(statements), 1),
+                  ))
+
+        import sqlstats
+        print("\nslowest statements by total time")
+        for fingerprint, stats in sqlstats.process_stats.summary()[:5]:
+            print("{:>7} x {:>8.1f}ms  {}".format(
+                stats["count"], stats["seconds"] * 1000, fingerprint[:100]))
+    finally:
+        k8s.shutdown()
+        pg.stop()
+        postgresql.clear_cache()
+
+
+if __name__ == '__main__':
+    main()
@@ -1,39 +1,52 @@
 import bottle
 
-from config_finder import cfg
+import settings
+from settings import cfg
 
-from m2.handlers import handle_build
+# register the api's routes on the default app
+import routes
 
-from handlers import (
-    handle_branch_commit as leg_handle_branch_commit,
-    handle_build as leg_handle_build,
-)
+from server import server_adapter
 
-from security import restricted
+# pick up config changes without a restart
+settings.reload_on_sighup()
+settings.watch()
 
-### v1 paths ###
-# regex   [^\/]+\/?                    [^\/]+     (\/?[^\/]+)?
-#         path followed by a slash     path       optional slash and path
-v1_build_path = "/v1/build/<service_name>/<branch_name>/<commit_hash>" + \
-                         "/<image_name:re:[^\/]+\/?[^\/]+(\/?[^\/]+)?>"
+# sweep up kubernetes objects for branches that are gone
+reconcile_interval = float(cfg('reconcile_interval', '0'))
+if reconcile_interval > 0:
+    from deployment.reconcile import run_periodically
+    run_periodically(reconcile_interval)
 
-bottle.route(v1_build_path, ["GET"], restricted(handle_build))
+# make release partitions ahead of the releases that go in them
+partition_interval = float(cfg('partition_interval', '86400'))
+if partition_interval > 0:
+    from m2 import retention
+    retention.ensure_partitions_periodically(partition_interval)
 
-### legacy paths ###
-leg_commit_path = "/commit/<{}>/<{}>/<{}>/<{}>".format(
-    "repo_name",
-    "feature_name",
-    "branch_name",
-    "commit_hash",
-)
+# archive and detach release history past its retention
+retention_interval = float(cfg('retention_interval', '0'))
+if retention_interval > 0:
+    from m2 import retention
+    retention.run_periodically(retention_interval)
+
+secret_gc_interval = float(cfg('secret_gc_interval', '0'))
 
-# regex   [^\/]+\/?                    [^\/]+     (\/?[^\/]+)?
-#         path followed by a slash     path       optional slash and path
-leg_build_path = "/build/<commit_hash>/<image_name:re:[^\/]+\/?[^\/]+(\/?[^\/]+)?>"
 
-bottle.route(leg_commit_path, ["GET"], restricted(leg_handle_branch_commit))
-bottle.route(leg_build_path, ["GET"], restricted(leg_handle_build))
+def start_process():
+    """ start the state each serving process keeps for itself """
+    if cfg('secret_cache', 'false') == 'true' or secret_gc_interval > 0:
+        from deployment import known_secrets
+        # seed every cluster's secret cache before the first deploy
+        known_secrets.start_all()
+        # delete config secrets no repcon mounts any more, from the caches
+        if secret_gc_interval > 0:
+            known_secrets.run_periodically(secret_gc_interval)
+
 
 debug = cfg("debug", "false") == "true"
 print("running herd api, debug? {}".format(debug))
-bottle.run(host="0.0.0.0", port="8000", debug=debug)
+bottle.run(
+    server=server_adapter("0.0.0.0", "8000", start_process),
+    debug=debug,
+)
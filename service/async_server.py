@@ -0,0 +1,380 @@
+"""
+An asyncio server for the herd api
+
+`server_mode` async serves the build webhooks, /commit, /build and
+/v1/build, from one asyncio event loop with aiohttp, so a webhook waiting
+on postgres holds neither a thread nor a database connection. /v1/build
+and the idempotency lookups run on an aiopg pool of `async_pool_min` to
+`async_pool_max` connections, each borrowed only for its statements.
+
+The legacy handlers deploy as they go, so they run unchanged on a pool of
+`async_executor_workers` threads, and webhooks beyond that wait on the
+loop rather than in threads of their own. Every other route is passed to
+the bottle app on the same threads, streaming responses chunk by chunk,
+except the long streams, release events and the export, which hold a
+thread for as long as they are open. They run on a pool of their own,
+`async_stream_workers` threads, so they can't starve the webhooks.
+
+Handlers keep their bottle semantics: the same `restricted` token check,
+answering 401 without the CI token, the same idempotent answers to
+duplicates, and the same JSON bodies.
+Requires aiohttp and aiopg.
+
+"""
+
+import asyncio
+import io
+import json
+import re
+import sys
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial, wraps
+from urllib.parse import unquote
+
+import bottle
+
+from aiohttp import web
+
+from settings import cfg
+
+import sqlstats
+
+from db import m2_create_pool
+from handlers import (
+    handle_branch_commit as leg_handle_branch_commit,
+    handle_build as leg_handle_build,
+)
+from idempotency import (
+    answer_once,
+    duplicates,
+    request_key,
+    responses,
+    store_response_sql,
+    stored_response_sql,
+    ttl,
+)
+from m2.handlers import (
+    qa_config_query,
+    save_query,
+)
+from routes import (
+    request_latency,
+    requests_in_progress,
+)
+from security import authorized
+
+# the bottle routes' paths in aiohttp's syntax
+v1_build_path = "/v1/build/{service_name}/{branch_name}" + \
+                "/{merge_base_commit_hash}/{commit_hash}" + \
+                "/{image_name:[^/]+/?[^/]+(?:/?[^/]+)?}"
+leg_commit_path = "/commit/{repo_name}/{feature_name}/{branch_name}" + \
+                  "/{commit_hash}"
+leg_build_path = "/build/{commit_hash}/{image_name:[^/]+/?[^/]+(?:/?[^/]+)?}"
+
+# bottle routes whose responses stream for as long as the client stays
+stream_paths = re.compile(r'^/v1/(releases/[0-9]+/events|export/releases)$')
+
+
+async def execute(cursor, sql, args=None):
+    """ execute a statement, recording it as PoliteCursor does """
+    started = time.perf_counter()
+    try:
+        await cursor.execute(sql, args)
+    except Exception as e:
+        print("Error executing sql, {}".format(e))
+        raise
+    finally:
+        sqlstats.record(sql, args, time.perf_counter() - started,
+                        cursor.rowcount)
+
+
+async def save(cursor, table, unique_columns, columns, values):
+    """ m2.handlers.save on an aiopg cursor """
+    await execute(
+        cursor,
+        save_query(table, unique_columns, columns, values),
+        values,
+    )
+    return (await cursor.fetchone())[0]
+
+
+async def handle_build(pool,
+                       service_name,
+                       branch_name,
+                       merge_base_commit_hash,
+                       commit_hash,
+                       image_name):
+    """ m2.handlers.handle_build, in one transaction on a pooled connection """
+    async with pool.acquire() as connection:
+        async with connection.cursor() as cursor:
+            async with cursor.begin():
+                service_id = await save(
+                    cursor,
+                    'service',
+                    ['service_name'],
+                    ['service_name'],
+                    (service_name,),
+                )
+                branch_id = await save(
+                    cursor,
+                    'branch',
+                    ['branch_name', 'merge_base_commit_hash', 'deleted_dt'],
+                    ['branch_name', 'merge_base_commit_hash', 'service_id'],
+                    (branch_name, merge_base_commit_hash, service_id),
+                )
+                iteration_id = await save(
+                    cursor,
+                    'iteration',
+                    ['commit_hash', 'branch_id'],
+                    ['commit_hash', 'branch_id', 'image_name'],
+                    (commit_hash, branch_id, image_name),
+                )
+                await execute(
+                    cursor,
+                    qa_config_query,
+                    (branch_id, merge_base_commit_hash,
+                     merge_base_commit_hash),
+                )
+                config_id = (await cursor.fetchone())[0]
+                if config_id is None:
+                    # postgres reads the untyped '' as the empty hstore
+                    config_id = await save(
+                        cursor,
+                        'config',
+                        ['key_value_pairs'],
+                        ['key_value_pairs'],
+                        ('',),
+                    )
+                await save(
+                    cursor,
+                    'release',
+                    [],
+                    ['iteration_id', 'config_id'],
+                    (iteration_id, config_id),
+                )
+
+
+async def lookup(pool, key):
+    """ idempotency.lookup on the pool """
+    response = responses.get(key)
+    if response is not None:
+        return response
+    try:
+        async with pool.acquire() as connection:
+            async with connection.cursor() as cursor:
+                await execute(cursor, stored_response_sql, (key,))
+                row = await cursor.fetchone()
+    except Exception as e:
+        print("Error looking up webhook response, {}".format(e))
+        return None
+    if row is None:
+        return None
+    response, remaining = row
+    response = json.loads(response)
+    responses.put(key, response, float(remaining))
+    return response
+
+
+async def remember(pool, key, response):
+    """ idempotency.remember on the pool """
+    responses.put(key, response, ttl)
+    try:
+        async with pool.acquire() as connection:
+            async with connection.cursor() as cursor:
+                await execute(
+                    cursor,
+                    store_response_sql,
+                    (key, json.dumps(response), ttl),
+                )
+    except Exception as e:
+        print("Error storing webhook response, {}".format(e))
+
+
+def idempotent(handler):
+    """ idempotency.idempotent for handlers on the event loop """
+    @wraps(handler)
+    async def idempotent_handler(request):
+        if ttl <= 0:
+            return await handler(request)
+
+        pool = request.app['pool']
+        key = request_key(
+            request.headers.get('X-Authenticated-Token', ''),
+            request.path,
+        )
+        response, duplicate = await answer_once(
+            key,
+            partial(lookup, pool),
+            partial(remember, pool),
+            partial(handler, request),
+        )
+        if duplicate:
+            duplicates.inc(route=request.match_info.route.name or "none")
+            print("answering duplicate {} with the original response".format(
+                request.path))
+        return response
+
+    return idempotent_handler
+
+
+def restricted(handler):
+    """ security.restricted for handlers on the event loop """
+    @wraps(handler)
+    async def restricted_handler(request):
+        if not authorized(request.headers):
+            raise web.HTTPUnauthorized(text="Not Authorized")
+        return await handler(request)
+
+    return restricted_handler
+
+
+def in_executor(handler):
+    """ run a blocking handler with the url's arguments on the executor """
+    async def executor_handler(request):
+        return await asyncio.get_event_loop().run_in_executor(
+            request.app['executor'],
+            partial(handler, **request.match_info),
+        )
+
+    return executor_handler
+
+
+def webhook(name, handler):
+    """ time a handler as routes does, and send its result as bottle would """
+    async def webhook_handler(request):
+        started = time.perf_counter()
+        requests_in_progress.inc()
+        try:
+            result = await handler(request)
+        finally:
+            requests_in_progress.dec()
+            request_latency.observe(time.perf_counter() - started, route=name)
+        if isinstance(result, dict):
+            return web.json_response(result)
+        return web.Response(text=result or "", content_type="text/html")
+
+    return webhook_handler
+
+
+async def handle_v1_build(request):
+    return await handle_build(request.app['pool'], **request.match_info)
+
+
+def wsgi_environ(request, body):
+    """ return the WSGI environ for an aiohttp request and its body """
+    path, _, query = request.raw_path.partition('?')
+    environ = {
+        'REQUEST_METHOD': request.method,
+        'SCRIPT_NAME': '',
+        # WSGI wants the path's bytes as latin-1
+        'PATH_INFO': unquote(path, encoding='latin-1'),
+        'QUERY_STRING': query,
+        'CONTENT_TYPE': request.headers.get('Content-Type', ''),
+        'CONTENT_LENGTH': str(len(body)),
+        'SERVER_NAME': request.url.host or '',
+        'SERVER_PORT': str(request.url.port or ''),
+        'SERVER_PROTOCOL': "HTTP/{}.{}".format(*request.version),
+        'REMOTE_ADDR': request.remote or '',
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': request.scheme,
+        'wsgi.input': io.BytesIO(body),
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': False,
+        'wsgi.run_once': False,
+    }
+    for name in set(request.headers.keys()):
+        key = 'HTTP_' + name.upper().replace('-', '_')
+        if key not in ('HTTP_CONTENT_TYPE', 'HTTP_CONTENT_LENGTH'):
+            environ[key] = ','.join(request.headers.getall(name))
+    return environ
+
+
+async def handle_wsgi(request):
+    """ serve a request with the bottle app on the executor """
+    body = await request.read()
+    loop = asyncio.get_event_loop()
+    if stream_paths.match(request.path):
+        executor = request.app['stream_executor']
+    else:
+        executor = request.app['executor']
+    started = []
+    written = []
+
+    def start_response(status, headers, exc_info=None):
+        started[:] = [status, headers]
+        # bottle never writes, but what an app does goes ahead of its body
+        return written.append
+
+    result = await loop.run_in_executor(
+        executor,
+        request.app['wsgi'],
+        wsgi_environ(request, body),
+        start_response,
+    )
+    chunks = iter(result)
+    try:
+        chunk = await loop.run_in_executor(executor, next, chunks, None)
+        status, headers = started
+        code, _, reason = status.partition(' ')
+        response = web.StreamResponse(status=int(code), reason=reason)
+        for name, value in headers:
+            response.headers.add(name, value)
+        await response.prepare(request)
+        for data in written:
+            await response.write(data)
+        while chunk is not None:
+            await response.write(chunk)
+            chunk = await loop.run_in_executor(executor, next, chunks, None)
+        await response.write_eof()
+        return response
+    finally:
+        if hasattr(result, 'close'):
+            await loop.run_in_executor(executor, result.close)
+
+
+async def open_pool(app):
+    if app.get('pool') is None:
+        app['pool'] = await m2_create_pool()
+
+
+async def close_pool(app):
+    app['pool'].close()
+    await app['pool'].wait_closed()
+    app['executor'].shutdown(wait=False)
+    app['stream_executor'].shutdown(wait=False)
+
+
+def make_app(wsgi=None, pool=None, executor=None, stream_executor=None):
+    """ return the aiohttp app, passing routes it doesn't serve to wsgi """
+    app = web.Application()
+    app['wsgi'] = wsgi or bottle.default_app()
+    app['pool'] = pool
+    app['executor'] = executor or ThreadPoolExecutor(
+        max_workers=int(cfg('async_executor_workers', '16')))
+    app['stream_executor'] = stream_executor or ThreadPoolExecutor(
+        max_workers=int(cfg('async_stream_workers', '8')))
+    app.on_startup.append(open_pool)
+    app.on_cleanup.append(close_pool)
+
+    app.router.add_get(
+        v1_build_path,
+        webhook("v1_build", restricted(idempotent(handle_v1_build))),
+        name="v1_build",
+    )
+    app.router.add_get(
+        leg_commit_path,
+        webhook("legacy_commit",
+                restricted(in_executor(leg_handle_branch_commit))),
+        name="legacy_commit",
+    )
+    app.router.add_get(
+        leg_build_path,
+        webhook("legacy_build",
+                restricted(idempotent(in_executor(leg_handle_build)))),
+        name="legacy_build",
+    )
+    app.router.add_route("*", "/{path:.*}", handle_wsgi, name="wsgi")
+    return app
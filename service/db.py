@@ -1,15 +1,33 @@
-from config_finder import cfg
+import hashlib
+import math
+import time
+
+from contextlib import contextmanager
+
+from settings import cfg
 
 import psycopg2
+import psycopg2.errors
 import psycopg2.extensions
 
+import sqlstats
+
 
 class PoliteCursor(psycopg2.extensions.cursor):
     def execute(self, sql, args=None, print_sql=False):
         try:
             if print_sql:
                 print("executing sql ({}) with args ({})".format(sql, args))
-            psycopg2.extensions.cursor.execute(self, sql, args)
+            started = time.perf_counter()
+            try:
+                psycopg2.extensions.cursor.execute(self, sql, args)
+            finally:
+                sqlstats.record(
+                    sql,
+                    args,
+                    time.perf_counter() - started,
+                    self.rowcount,
+                )
         except Exception as e:
             print("Error executing sql, {}".format(e))
             self.close()
@@ -21,7 +39,7 @@ class PoliteCursor(psycopg2.extensions.cursor):
         self.connection.commit()
 
 
-def m2_get_cursor():
+def m2_get_cursor(name=None):
     connection = psycopg2.connect(
         # Model version 2 cursor is configured with dashes in keys
         host=cfg(    'pg-host',     'herd-postgres'),
@@ -30,10 +48,26 @@ def m2_get_cursor():
         user=cfg(    'pg-user',     'herd_user'),
         password=cfg('pg-password',  None),
     )
-    return connection.cursor(cursor_factory=PoliteCursor)
+    # a named cursor lives on the server and sends rows as they're fetched
+    return connection.cursor(name=name, cursor_factory=PoliteCursor)
+
+
+async def m2_create_pool():
+    """ return an aiopg pool of model version 2 connections """
+    # only the async server needs aiopg
+    import aiopg
+    return await aiopg.create_pool(
+        host=cfg(    'pg-host',     'herd-postgres'),
+        port=cfg(    'pg-port',     '5433'),
+        dbname=cfg(  'pg-database', 'herd'),
+        user=cfg(    'pg-user',     'herd_user'),
+        password=cfg('pg-password',  None),
+        minsize=int(cfg('async_pool_min', '1')),
+        maxsize=int(cfg('async_pool_max', '20')),
+    )
 
 
-def get_cursor(connection=None):
+def get_cursor(connection=None, name=None):
     if connection is None:
         connection = psycopg2.connect(
             host=cfg('pghost', 'http://api-postgres'),
@@ -42,5 +76,43 @@ def get_cursor(connection=None):
             user=cfg('pguser', None),
             password=cfg('pgpassword', None),
         )
-    return connection.cursor(cursor_factory=PoliteCursor)
+    return connection.cursor(name=name, cursor_factory=PoliteCursor)
 
+
+
+class LockTimeout(TimeoutError):
+    """ an advisory lock was not granted in time """
+
+
+def lock_key(*names):
+    """ return the advisory lock key, a signed bigint, for some names """
+    digest = hashlib.sha256('\0'.join(names).encode()).digest()
+    return int.from_bytes(digest[:8], 'big', signed=True)
+
+
+@contextmanager
+def advisory_lock(cursor, key, timeout):
+    """
+    hold a session advisory lock on key for the with block
+
+    Waits at most timeout seconds for the lock, then raises LockTimeout.
+    The lock is held by the cursor's connection, which is closed, releasing
+    the lock, when the block ends.
+
+    """
+
+    connection = cursor.connection
+    try:
+        connection.autocommit = True
+        # lock_timeout bounds the wait, so waiters queue instead of polling.
+        # It is whole milliseconds, and 0 would wait forever.
+        cursor.execute("set lock_timeout = %s",
+                       (max(1, math.ceil(timeout * 1000)),))
+        try:
+            cursor.execute("select pg_advisory_lock(%s)", (key,))
+        except psycopg2.errors.LockNotAvailable:
+            raise LockTimeout(
+                "no advisory lock on {} after {}s".format(key, timeout))
+        yield
+    finally:
+        connection.close()
@@ -1,2 +1,106 @@
-# deployment module
+"""
+Deployment backends
 
+An environment's `infrastructure_backend` names the backend that deploys
+releases in its pipelines. Backends are modules with a
+
+    batch_runner(release_ids, action="UPDATE")
+
+function, imported the first time a release needs them, so the api only
+loads the backends it uses. Extra backends can be registered with the
+`infrastructure_backends` config, a comma separated list of name=module.
+Releases whose backend is unknown are counted, and fail the batch once the
+other releases have been sent to their backends.
+
+gce       deploys to kubernetes (deployment.gce)
+dryrun    renders the manifests without deploying them (deployment.dryrun)
+
+"""
+
+import importlib
+import threading
+
+from settings import cfg
+
+from db import get_cursor
+from metrics import Counter
+
+unknown_backend_releases = Counter(
+    "herd_unknown_backend_releases_total",
+    "Releases not deployed because their infrastructure backend is unknown",
+    ["backend"],
+)
+
+backends = {
+    "gce": "deployment.gce",
+    "dryrun": "deployment.dryrun",
+}
+
+for entry in cfg('infrastructure_backends', '').split(','):
+    if '=' in entry:
+        name, module_name = entry.split('=', 1)
+        backends[name.strip()] = module_name.strip()
+
+loaded = {}
+lock = threading.Lock()
+
+
+def register(name, module_name):
+    """ deploy releases with the infrastructure_backend name using a module """
+    with lock:
+        backends[name] = module_name
+        loaded.pop(name, None)
+
+
+def backend(name):
+    """ return the module for a backend, importing it on first use """
+    with lock:
+        if name not in loaded:
+            if name not in backends:
+                raise LookupError("unknown infrastructure backend {}".format(
+                    name))
+            loaded[name] = importlib.import_module(backends[name])
+        return loaded[name]
+
+
+def release_backends(release_ids):
+    """ return {infrastructure_backend: [release_id]} for the releases """
+    cursor = get_cursor()
+    cursor.execute(
+        ("SELECT release_id\n"
+         "      ,infrastructure_backend\n"
+         "  FROM release r\n"
+         "  JOIN deployment_pipeline d\n"
+         "    ON d.deployment_pipeline_id = r.deployment_pipeline_id\n"
+         "  JOIN environment e\n"
+         "    ON e.environment_id = d.environment_id\n"
+         " WHERE release_id = ANY(%s)"),
+        (list(release_ids),),
+    )
+    rows = cursor.fetchall()
+    cursor.close()
+
+    by_backend = {}
+    for release_id, name in rows:
+        by_backend.setdefault(name, []).append(release_id)
+    return by_backend
+
+
+def batch_runner(release_ids, action="UPDATE"):
+    """ send each release to its environment's backend """
+    release_ids = list(release_ids)
+    if not release_ids:
+        return True
+
+    unknown = {}
+    for name, ids in release_backends(release_ids).items():
+        if name not in backends:
+            unknown_backend_releases.inc(len(ids), backend=str(name))
+            unknown[name] = ids
+            continue
+        backend(name).batch_runner(ids, action)
+
+    if unknown:
+        raise LookupError("no infrastructure backend for releases {}".format(
+            unknown))
+    return True
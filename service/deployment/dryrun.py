@@ -0,0 +1,49 @@
+"""
+A backend that renders a release's manifests without deploying them
+
+Releases in environments with `infrastructure_backend` dryrun go through
+the same parameter lookup and manifest rendering as gce, but nothing is
+sent to kubernetes. Useful for local runs and benchmarks.
+
+"""
+
+
+def update(param_set):
+    """ render the manifests an update would apply """
+    # imported here, so loading this backend doesn't load gce's
+    from deployment.gce import render
+
+    (service_name,
+     branch_name,
+     config_id,
+     key_value_pairs,
+     commit_hash,
+     image_name) = param_set
+
+    manifests = render(
+        service_name.replace('_', '-'),
+        branch_name.replace('_', '-'),
+        config_id,
+        key_value_pairs,
+        commit_hash,
+        image_name,
+    )
+    print("dry run would apply {}, {} and {}".format(
+        manifests.service['metadata']['name'],
+        manifests.secret['metadata']['name'],
+        manifests.repcon['metadata']['name'],
+    ))
+    return manifests
+
+
+actions = {
+    "UPDATE": update,
+}
+
+
+def batch_runner(release_ids, action="UPDATE"):
+    """ carry out the action for many releases without deploying them """
+    from deployment.gce import batch_run_params
+    for row in batch_run_params(release_ids, backend="dryrun"):
+        actions[action](tuple(row[1:7]))
+    return True
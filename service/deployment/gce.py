@@ -1,19 +1,65 @@
 import base64
+import calendar
 import hashlib
-import os
 import re
 import requests
 import pprint
 import json
+import threading
 import time
 
+from collections import namedtuple, OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 from functools import singledispatch
-from config_finder import cfg
+from settings import cfg
 
-from db import get_cursor, m2_get_cursor
+import release_status
+
+from db import (
+    advisory_lock,
+    get_cursor,
+    lock_key,
+    LockTimeout,
+    m2_get_cursor,
+)
+from metrics import Counter, Gauge, Histogram
 
 pp = pprint.PrettyPrinter(indent=2)
 
+k8s_latency = Histogram(
+    "herd_k8s_request_duration_seconds",
+    "Kubernetes API call latency, by verb and resource",
+    ["verb", "resource"],
+)
+deploy_stage_duration = Histogram(
+    "herd_deploy_stage_duration_seconds",
+    "Time spent in each stage of a deploy",
+    ["stage"],
+)
+deploy_lock_wait = Histogram(
+    "herd_deploy_lock_wait_seconds",
+    "Time deploys waited for their branch's deploy lock",
+)
+deploy_lock_timeouts = Counter(
+    "herd_deploy_lock_timeouts_total",
+    "Deploys that gave up waiting for their branch's deploy lock",
+)
+cluster_deploy_duration = Histogram(
+    "herd_cluster_deploy_duration_seconds",
+    "Time to deploy a param set to each cluster, by cluster and result",
+    ["cluster", "result"],
+)
+deploys = Counter(
+    "herd_deploys_total",
+    "Deploys by result, unchanged when the branch already ran the release",
+    ["result"],
+)
+deploy_queue_depth = Gauge(
+    "herd_deploy_queue_depth",
+    "Deploy groups waiting for a batch runner worker",
+)
+
 """
 Python3 is very strict about encoding so I wanted to encapsulate
 some of the encode/decode bytes->string and back boiler plate
@@ -88,7 +134,7 @@ def m2_run_params(release_id):
          "  join config c\n"
          "    on c.config_id = r.config_id\n"
          "  join service s\n"
-         "    on b.service_id\n"
+         "    on s.service_id = b.service_id\n"
          " where release_id=%s"),
         (release_id,),
     )
@@ -97,6 +143,38 @@ def m2_run_params(release_id):
     return result
 
 
+def m2_batch_run_params(release_ids):
+    """
+    return (release_id, *params) rows for many releases from version 2 of
+    the model in a single query
+
+    """
+
+    cursor = m2_get_cursor()
+    cursor.execute(
+        ("select release_id\n"
+         "      ,service_name\n"
+         "      ,branch_name\n"
+         "      ,c.config_id\n"
+         "      ,key_value_pairs\n"
+         "      ,commit_hash\n"
+         "      ,image_name\n"
+         "  from release r\n"
+         "  join iteration i\n"
+         "    on i.iteration_id = r.iteration_id\n"
+         "  join branch b\n"
+         "    on b.branch_id = i.branch_id\n"
+         "  join config c\n"
+         "    on c.config_id = r.config_id\n"
+         "  join service s\n"
+         "    on s.service_id = b.service_id\n"
+         " where release_id = any(%s)"),
+        (list(release_ids),),
+    )
+    result = cursor.fetchall()
+    cursor.close()
+    return result
+
 
 def run_params(release_id):
     """ return the paramaters needed for a run on gce """
@@ -108,6 +186,7 @@ def run_params(release_id):
          "      ,key_value_pairs\n"
          "      ,commit_hash\n"
          "      ,image_name\n"
+         "      ,e.settings\n"
          "  FROM release r\n"
          "  JOIN iteration i\n"
          "    ON i.iteration_id = r.iteration_id\n"
@@ -133,21 +212,64 @@ def run_params(release_id):
     return result
 
 
+def batch_run_params(release_ids, backend="gce"):
+    """ return (release_id, *params) rows for many releases in one query """
+    cursor = get_cursor()
+    cursor.execute(
+        ("SELECT release_id\n"
+         "      ,service_name\n"
+         "      ,branch_name\n"
+         "      ,c.config_id\n"
+         "      ,key_value_pairs\n"
+         "      ,commit_hash\n"
+         "      ,image_name\n"
+         "      ,e.settings\n"
+         "  FROM release r\n"
+         "  JOIN iteration i\n"
+         "    ON i.iteration_id = r.iteration_id\n"
+         "  JOIN branch b\n"
+         "    ON b.branch_id = i.branch_id\n"
+         "  JOIN deployment_pipeline d\n"
+         "    ON b.branch_id = d.branch_id\n"
+         "   AND d.deployment_pipeline_id = r.deployment_pipeline_id\n"
+         "  JOIN config c\n"
+         "    ON c.config_id = d.config_id\n"
+         "  JOIN environment e\n"
+         "    ON e.environment_id = d.environment_id\n"
+         "  JOIN feature f\n"
+         "    ON f.feature_id = b.feature_id\n"
+         "  JOIN service s\n"
+         "    ON s.service_id = f.service_id\n"
+         " WHERE release_id = ANY(%s)\n"
+         "   AND infrastructure_backend = %s"),
+        (list(release_ids), backend),
+    )
+    result = cursor.fetchall()
+    cursor.close()
+    return result
+
+
+# names k8s will accept for services
+k8s_name_pattern = re.compile('[a-z]([-a-z0-9]*[a-z0-9])?')
+
+# names k8s will accept for labels
+label_pattern = re.compile('(([A-Za-z0-9][-A-Za-z0-9_.]*)?[A-Za-z0-9])?')
+
+
 def service_identity(service_name, branch_name):
     return "{}-{}".format(service_name, branch_name)
 
 
-def k8s_service_description(service_name, branch_name, port):
-    """ return the k8s service description """
-    k8s_name_match = re.search(
-        # get only the string that matches k8s restrictions
-        '[a-z]([-a-z0-9]*[a-z0-9])?',
+def k8s_service_name(service_name, branch_name):
+    """ return the name of the k8s service for a branch """
+    # get only the string that matches k8s restrictions
+    k8s_name_match = k8s_name_pattern.search(
         # limit the length of the name to fit in k8s restrictions
         "{}-{}".format(service_name[:11], branch_name[:12]),
     )
 
     if k8s_name_match:
-        k8s_name = k8s_name_match.group()
+        return k8s_name_match.group()
     else:
         # if that doesn't create a good name, just fail.
         raise NameError(
@@ -157,11 +279,14 @@ def k8s_service_description(service_name, branch_name, port):
             )
         )
 
+
+def k8s_service_description(service_name, branch_name, port):
+    """ return the k8s service description """
     return {
         "kind": "Service",
         "apiVersion": "v1",
         "metadata": {
-            "name": k8s_name,
+            "name": k8s_service_name(service_name, branch_name),
         },
         "spec": {
             "selector": {
@@ -177,8 +302,15 @@ def k8s_service_description(service_name, branch_name, port):
     }
 
 
-def k8s_secret_description(key_value_pairs, config_id):
+def secret_name(config_digest, config_id):
+    """ return the content addressed name of a config's secret """
+    return "{}-config-{}".format(config_digest, config_id)
+
+
+def k8s_secret_description(key_value_pairs, config_id, config_digest=None):
     """ return the k8s secret description """
+    if config_digest is None:
+        config_digest = digest(key_value_pairs)
     print("creating secret with pairs '{}'".format(key_value_pairs))
     data = {}
     for line in [l for l in key_value_pairs.strip().split('\n') if l]:
@@ -196,12 +328,37 @@ def k8s_secret_description(key_value_pairs, config_id):
         "kind": "Secret",
         "apiVersion": "v1",
         "metadata": {
-            "name": "{}-config-{}".format(digest(key_value_pairs), config_id)
+            "name": secret_name(config_digest, config_id),
         },
         "data": data,
     }
 
 
+# when a deploy last used a config secret, so it isn't collected meanwhile
+last_used_annotation = "herd/last-used"
+
+
+def k8s_time(epoch):
+    """ return epoch seconds in the format of k8s timestamps """
+    return time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime(epoch))
+
+
+def k8s_epoch(timestamp):
+    """ return a k8s timestamp in epoch seconds """
+    return calendar.timegm(time.strptime(timestamp, "%Y-%m-%dT%H:%M:%SZ"))
+
+
+def secret_idle(secret, now):
+    """ return how many seconds since a secret was created or last used """
+    metadata = secret['metadata']
+    times = [metadata.get('creationTimestamp'),
+             (metadata.get('annotations') or {}).get(last_used_annotation)]
+    times = [k8s_epoch(t) for t in times if t]
+    if not times:
+        return float('inf')
+    return now - max(times)
+
+
 def make_rc_name(branch_name, service_name, commit_hash, config_id):
     """
     make a replication controller name suitable for k8s labels
@@ -219,10 +376,7 @@ def make_rc_name(branch_name, service_name, commit_hash, config_id):
     )
 
     # check that it matches the required regex
-    name_match = re.search(
-        '(([A-Za-z0-9][-A-Za-z0-9_.]*)?[A-Za-z0-9])?',
-        name,
-    )
+    name_match = label_pattern.search(name)
     if not name_match:
         raise NameError(
             "cannot make good k8s name from {}".format([
@@ -236,14 +390,35 @@ def make_rc_name(branch_name, service_name, commit_hash, config_id):
     return name_match.group()
 
 
+def repcon_annotations(image_name, config_digest):
+    """ return the annotations saying what a repcon runs """
+    return {
+        "herd/image": image_name,
+        "herd/config-digest": config_digest,
+    }
+
+
+def is_current(repcon, rc_name, annotations):
+    """ return True if a listed repcon runs what is annotated, and is up """
+    metadata = repcon['metadata']
+    running = metadata.get('annotations') or {}
+    return (metadata['name'] == rc_name and
+            all(running.get(k) == v for k, v in annotations.items()) and
+            repcon.get('spec', {}).get('replicas', 0) > 0)
+
+
 def k8s_repcon_description(service_name,
                            branch_name,
                            config_id,
                            commit_hash,
                            image_name,
                            key_value_pairs,
+                           config_digest=None,
 ):
     """ return the k8s replication controller description """
+    if config_digest is None:
+        config_digest = digest(key_value_pairs)
+
     rc_name = make_rc_name(
         branch_name,
         service_name,
@@ -263,6 +438,7 @@ def k8s_repcon_description(service_name,
                 "service": service_name,
                 "branch": branch_name,
             },
+            "annotations": repcon_annotations(image_name, config_digest),
         },
         "spec": {
             "replicas": 1,
@@ -282,8 +458,8 @@ def k8s_repcon_description(service_name,
                         {
                             "name": "{}-secret".format(rc_name),
                             "secret": {
-                                "secretName": "{}-config-{}".format(
-                                    digest(key_value_pairs),
+                                "secretName": secret_name(
+                                    config_digest,
                                     config_id,
                                 ),
                             },
@@ -313,25 +489,305 @@ def k8s_repcon_description(service_name,
     }
 
 
-def k8s_endpoint(resource):
+class RenderCache(object):
+    """ a small thread safe LRU of rendered manifests """
+
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+
+    def get(self, key):
+        with self.lock:
+            try:
+                self.entries.move_to_end(key)
+            except KeyError:
+                return None
+            return self.entries[key]
+
+    def put(self, key, value):
+        with self.lock:
+            self.entries[key] = value
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+
+Manifests = namedtuple("Manifests", ["service", "secret", "repcon"])
+
+rendered = RenderCache(int(cfg('render_cache_size', '256')))
+
+
+def render(service_name,
+           branch_name,
+           config_id,
+           key_value_pairs,
+           commit_hash,
+           image_name,
+):
+    """
+    return the service, secret and repcon descriptions for a release
+
+    The config is digested once and shared by the secret and the repcon.
+    Results are cached by config digest and image (along with the names
+    they are rendered for) so redeploys and rollbacks skip rendering.
+    Cached descriptions are shared; callers must not modify them.
+
+    """
+
+    config_digest = digest(key_value_pairs)
+    key = (
+        config_digest,
+        image_name,
+        service_name,
+        branch_name,
+        commit_hash,
+        config_id,
+    )
+    manifests = rendered.get(key)
+    if manifests is None:
+        manifests = Manifests(
+            service=k8s_service_description(service_name, branch_name, 8000),
+            secret=k8s_secret_description(
+                key_value_pairs,
+                config_id,
+                config_digest,
+            ),
+            repcon=k8s_repcon_description(
+                service_name,
+                branch_name,
+                config_id,
+                commit_hash,
+                image_name,
+                key_value_pairs,
+                config_digest,
+            ),
+        )
+        rendered.put(key, manifests)
+    return manifests
+
+
+# the resource type in a namespaced k8s api path
+resource_pattern = re.compile('/namespaces/[^/]+/([^/?]+)')
+
+
+def k8s_resource(uri):
+    """ return the resource type a k8s api uri refers to """
+    match = resource_pattern.search(uri)
+    return match.group(1) if match else "unknown"
+
+
+class Cluster(object):
+    """ a kubernetes cluster to deploy to, with its own connection pool """
+
+    def __init__(self, name, kubeproxy, password, session=None):
+        self.name = name
+        self.kubeproxy = kubeproxy
+        self.password = password
+        # the default cluster goes through the requests module
+        self.session = session
+
+    def __repr__(self):
+        return "Cluster({!r}, {!r})".format(self.name, self.kubeproxy)
+
+
+def default_cluster():
+    """ return the cluster in the kubeproxy and k8spassword settings """
+    return Cluster("default", cfg('kubeproxy'), cfg('k8spassword'))
+
+
+sessions = {}
+sessions_lock = threading.Lock()
+
+
+def cluster_session(name, kubeproxy):
+    """ return the pooled session for a cluster, shared by its deploys """
+    with sessions_lock:
+        session = sessions.get((name, kubeproxy))
+        if session is None:
+            pool_size = int(cfg('k8s_pool_size', '10'))
+            session = requests.Session()
+            adapter = requests.adapters.HTTPAdapter(
+                pool_connections=1,
+                pool_maxsize=pool_size,
+            )
+            session.mount("http://", adapter)
+            session.mount("https://", adapter)
+            sessions[(name, kubeproxy)] = session
+        return session
+
+
+def settings_pairs(settings):
+    """ return an environment's KEY=value settings as a dict """
+    pairs = {}
+    for line in [l for l in (settings or '').strip().split('\n') if l]:
+        key, _, value = line.partition('=')
+        pairs[key.strip()] = value.strip()
+    return pairs
+
+
+def clusters(settings=None):
+    """
+    return the clusters an environment's settings deploy to
+
+    Settings name the clusters in `clusters`, then give each a kubeproxy
+    and the name of the secret setting holding its admin password, so
+    passwords stay out of the database:
+
+        clusters=us-east1,europe-west1
+        cluster.us-east1.kubeproxy=10.0.1.2:8001
+        cluster.us-east1.password_key=k8spassword-us-east1
+        ...
+
+    With no clusters listed, the default cluster is the only one. Password
+    keys must start with "k8spassword", so an environment's settings can't
+    send some other secret to a kubeproxy of their choosing.
+
+    """
+
+    pairs = settings_pairs(settings)
+    names = [n.strip() for n in pairs.get('clusters', '').split(',')
+             if n.strip()]
+    if not names:
+        return [default_cluster()]
+
+    listed = []
+    for name in names:
+        kubeproxy = pairs.get('cluster.{}.kubeproxy'.format(name))
+        if not kubeproxy:
+            raise ValueError("cluster {} has no kubeproxy".format(name))
+        password_key = pairs.get('cluster.{}.password_key'.format(name),
+                                 'k8spassword')
+        if not password_key.startswith('k8spassword'):
+            raise ValueError("cluster {} password_key {} is not a k8s "
+                             "password".format(name, password_key))
+        listed.append(Cluster(
+            name,
+            kubeproxy,
+            cfg(password_key),
+            cluster_session(name, kubeproxy),
+        ))
+    return listed
+
+
+def environment_clusters(settings_rows):
+    """
+    return the default cluster and every cluster some environments' settings
+    deploy to, once each
+
+    The herd 2.x model deploys to the default cluster, so it is always
+    included. Settings whose clusters are misconfigured are skipped.
+
+    """
+
+    found = OrderedDict()
+    found[("default", cfg('kubeproxy'))] = default_cluster()
+    for settings in settings_rows:
+        try:
+            listed = clusters(settings)
+        except ValueError as e:
+            print("Error reading environment clusters, {}".format(e))
+            continue
+        for cluster in listed:
+            found.setdefault((cluster.name, cluster.kubeproxy), cluster)
+    return list(found.values())
+
+
+def branch_clusters(service_name, branch_name):
+    """ return the clusters a branch, by its k8s names, may run in """
+    cursor = get_cursor()
+    cursor.execute(
+        ("SELECT DISTINCT e.settings\n"
+         "  FROM deployment_pipeline d\n"
+         "  JOIN environment e\n"
+         "    ON e.environment_id = d.environment_id\n"
+         "  JOIN branch b\n"
+         "    ON b.branch_id = d.branch_id\n"
+         "  JOIN feature f\n"
+         "    ON f.feature_id = b.feature_id\n"
+         "  JOIN service s\n"
+         "    ON s.service_id = f.service_id\n"
+         " WHERE replace(service_name, '_', '-') = %s\n"
+         "   AND replace(branch_name, '_', '-') = %s\n"
+         "   AND infrastructure_backend = %s"),
+        (service_name, branch_name, "gce"),
+    )
+    rows = cursor.fetchall()
+    cursor.close()
+    return environment_clusters(row[0] for row in rows)
+
+
+def all_clusters():
+    """ return every cluster herd deploys to """
+    cursor = get_cursor()
+    cursor.execute(
+        ("SELECT DISTINCT settings\n"
+         "  FROM environment\n"
+         " WHERE infrastructure_backend = %s"),
+        ("gce",),
+    )
+    rows = cursor.fetchall()
+    cursor.close()
+    return environment_clusters(row[0] for row in rows)
+
+
+def k8s_request(verb, uri, cluster=None, **kwargs):
+    """ make a k8s api request, timing it by verb and resource """
+    client = requests
+    if cluster is not None and cluster.session is not None:
+        client = cluster.session
+    with k8s_latency.time(verb=verb, resource=k8s_resource(uri)):
+        return getattr(client, verb)(uri, **kwargs)
+
+
+def k8s_endpoint(resource, cluster=None):
     """ return the endpoint for the given resource type """
     endpoint = "http://{}/api/v1/namespaces/default/{}".format(
-        cfg('kubeproxy'),
+        cfg('kubeproxy') if cluster is None else cluster.kubeproxy,
         resource,
     )
     return endpoint
 
 
-def idem_post(resource, description):
+def idem_post(resource, description, cluster=None):
     """ idempotently post a resource to k8s """
-    endpoint = k8s_endpoint(resource)
-    response = requests.post(
+    if cluster is None:
+        cluster = default_cluster()
+    endpoint = k8s_endpoint(resource, cluster)
+    response = k8s_request(
+        "post",
         endpoint,
+        cluster,
         json=description,
         verify="/secret/k8s.pem",
-        auth=('admin', cfg("k8spassword")),
+        auth=('admin', cluster.password),
+    )
+
+    return response
+
+
+def touch_secret(name, cluster=None):
+    """ mark a secret as used by a deploy now """
+    return k8s_request(
+        "patch",
+        "{}/{}".format(k8s_endpoint("secrets", cluster), name),
+        cluster,
+        data=json.dumps({"metadata": {"annotations": {
+            last_used_annotation: k8s_time(time.time()),
+        }}}),
+        headers={"Content-Type": "application/merge-patch+json"},
     )
 
+
+def apply_secret(description, cluster=None):
+    """ post a config secret, or mark the one already there as used """
+    response = idem_post("secrets", description, cluster)
+    if response.status_code == 409:
+        response = touch_secret(description['metadata']['name'], cluster)
     return response
 
 
@@ -342,10 +798,12 @@ def watch_uri(uri):
         raise TypeError("uri ({}) doesn't look like a k8s resource".format(uri))
     return updated
 
-def sync_scale(uri, scale_to, timeout=30):
+def sync_scale(uri, scale_to, timeout=30, cluster=None):
     """ scale an rc and wait til it's done """
-    resp = requests.patch(
+    resp = k8s_request(
+        "patch",
         uri,
+        cluster,
         data=json.dumps({"spec": {"replicas": scale_to}}),
         headers={"Content-Type": "application/merge-patch+json"},
     )
@@ -353,7 +811,7 @@ def sync_scale(uri, scale_to, timeout=30):
 
     # wait for the rc to scale to zero
     for s in range(5):
-        resp = requests.get(uri).json()
+        resp = k8s_request("get", uri, cluster).json()
         if resp['status']['replicas'] == scale_to:
             break
         else:
@@ -362,8 +820,20 @@ def sync_scale(uri, scale_to, timeout=30):
 def gc_repcons(service_name,
                branch_name,
                commit_hash,
-               config_id):
-    """ delete all other repcons for this branch of this service """
+               config_id,
+               cluster=None,
+               annotations=None):
+    """
+    delete the branch's stale repcons
+
+    With annotations, the repcon for this commit and config that runs what
+    they say is kept, and True returned if there is one. Without them every
+    repcon for the branch is stale.
+
+    """
+
+    if cluster is None:
+        cluster = default_cluster()
     # get all repcons creating pods labeled for this service
     # the repcon should be labeled with service=this_service_label
     rc_name = make_rc_name(
@@ -373,27 +843,28 @@ def gc_repcons(service_name,
         config_id,
     )
     selector = "service={},branch={}".format(service_name, branch_name)
-    response = requests.get(
-        k8s_endpoint("replicationcontrollers"),
+    response = k8s_request(
+        "get",
+        k8s_endpoint("replicationcontrollers", cluster),
+        cluster,
         params={
             "labelSelector": selector,
         },
     )
     delete_repcon_uris = []
+    kept = False
 
-    # normally we would exclude the current repcon name, except that
-    # we want to start fresh and update in case there is new config.
-
-    # we are deleting all repcons for this branch in order to get settings updated
-    # until we refactor to the simpler data model.
+    # a repcon with this name but another image or config is stale too, so
+    # config updates still apply
     for item in response.json()['items']:
-
-        # dont' exclude anything
-#        if item['metadata']['name'] != rc_name:
+        if annotations is not None and not kept and \
+                is_current(item, rc_name, annotations):
+            kept = True
+            continue
 
         delete_repcon_uris.append(
             "http://{}{}".format(
-                cfg("kubeproxy"),
+                cluster.kubeproxy,
                 item['metadata']['selfLink']
             )
         )
@@ -401,13 +872,181 @@ def gc_repcons(service_name,
     # scale to zero and delete the remaining repcons
     for uri in delete_repcon_uris:
         print("Scaling repcon at {} to zero".format(uri))
-        sync_scale(uri, 0)
+        sync_scale(uri, 0, cluster=cluster)
         print("Delete request to {}".format(uri))
-        requests.delete(uri)
+        k8s_request("delete", uri, cluster)
+
+    return kept
+
+
+def repcon_secret_names(repcon):
+    """ return the names of the secrets a repcon mounts """
+    volumes = repcon['spec']['template']['spec'].get('volumes', [])
+    return set(v['secret']['secretName'] for v in volumes if 'secret' in v)
+
+
+def teardown(service_name, branch_name, max_workers=None, targets=None):
+    """
+    delete a branch's service, repcons and the secrets only they mount, in
+    every cluster it may run in
 
+    The repcons are deleted with one label selector collection delete, and
+    their pods are garbage collected by k8s. Secrets are named for their
+    config and may be shared with other branches, so only secrets no other
+    repcon in the same cluster mounts are deleted. The deletes run
+    concurrently. targets are the clusters, by default the branch's
+    environments' and the default cluster.
+
+    Returns the status of each delete by uri.
+
+    """
+
+    if max_workers is None:
+        max_workers = int(cfg('deploy_concurrency', '4'))
+    if targets is None:
+        targets = branch_clusters(service_name, branch_name)
+
+    statuses = {}
+    for cluster in targets:
+        statuses.update(teardown_in(
+            cluster, service_name, branch_name, max_workers))
+    return statuses
+
+
+def teardown_in(cluster, service_name, branch_name, max_workers):
+    """ tear a branch down in one cluster """
+    # one list of every repcon tells us which secrets are still in use
+    response = k8s_request(
+        "get", k8s_endpoint("replicationcontrollers", cluster), cluster)
+    branch_secrets = set()
+    other_secrets = set()
+    for item in response.json()['items']:
+        labels = item['metadata'].get('labels', {})
+        if (labels.get('service') == service_name and
+                labels.get('branch') == branch_name):
+            branch_secrets |= repcon_secret_names(item)
+        else:
+            other_secrets |= repcon_secret_names(item)
+
+    deletes = [
+        (k8s_endpoint("replicationcontrollers", cluster), {
+            "params": {
+                "labelSelector": "service={},branch={}".format(
+                    service_name,
+                    branch_name,
+                ),
+            },
+            "json": {
+                "kind": "DeleteOptions",
+                "apiVersion": "v1",
+                "propagationPolicy": "Background",
+            },
+        }),
+        ("{}/{}".format(
+            k8s_endpoint("services", cluster),
+            k8s_service_name(service_name, branch_name),
+        ), {}),
+    ]
+    for name in sorted(branch_secrets - other_secrets):
+        deletes.append(
+            ("{}/{}".format(k8s_endpoint("secrets", cluster), name), {}))
+
+    print("tearing down {} {} in {}".format(
+        service_name, branch_name, cluster.name))
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = [
+            (uri, executor.submit(
+                k8s_request, "delete", uri, cluster, **kwargs))
+            for uri, kwargs in deletes
+        ]
+        statuses = dict(
+            (uri, future.result().status_code) for uri, future in futures)
+    print("tore down {} {} in {}: {}".format(
+        service_name, branch_name, cluster.name, statuses))
+    return statuses
+
+
+def stage_recorder(release_id):
+    """ return a function recording the deploy stages of a 2.x release """
+    def record_stage(stage, detail=None):
+        try:
+            cursor = m2_get_cursor()
+            release_status.record(cursor, release_id, stage, detail)
+            cursor.close()
+            cursor.connection.close()
+        except Exception as e:
+            # the deploy goes on whether or not anyone can watch it
+            print("Error recording release {} {}, {}".format(
+                release_id, stage, e))
+    return record_stage
+
+
+def wait_ready(repcon_name, checks, cluster=None):
+    """ return True once the repcon's replicas are ready """
+    uri = "{}/{}".format(
+        k8s_endpoint("replicationcontrollers", cluster), repcon_name)
+    for s in range(checks):
+        repcon = k8s_request("get", uri, cluster).json()
+        replicas = repcon.get('spec', {}).get('replicas', 1)
+        if repcon.get('status', {}).get('readyReplicas', 0) >= replicas:
+            return True
+        if s < checks - 1:
+            time.sleep(s)
+    return False
+
+
+@contextmanager
+def branch_lock(service_name, branch_name, cluster_name="default"):
+    """
+    hold a branch's deploy lock, so a branch deploys one at a time to a
+    cluster
+
+    The lock is a postgres advisory lock, so it holds across threads,
+    processes and replicas. It is taken in the herd 2.x database when
+    v2_model is run, otherwise in the legacy database, so legacy deploys
+    don't depend on the 2.x one. Deploys wait `deploy_lock_timeout` seconds
+    for it before giving up with LockTimeout.
+
+    """
+
+    timeout = float(cfg('deploy_lock_timeout', '120'))
+    if cfg('v2_model', 'false') == 'run':
+        cursor = m2_get_cursor()
+    else:
+        cursor = get_cursor()
+    started = time.perf_counter()
+    try:
+        with advisory_lock(cursor,
+                           lock_key("deploy", cluster_name, service_name,
+                                    branch_name),
+                           timeout):
+            deploy_lock_wait.observe(time.perf_counter() - started)
+            yield
+    except LockTimeout:
+        deploy_lock_wait.observe(time.perf_counter() - started)
+        deploy_lock_timeouts.inc()
+        raise
+
+
+def unrecorded(stage, detail=None):
+    """ record nothing, for releases no one can watch """
+
+
+def update(param_set, record_stage=unrecorded, cluster=None):
+    """
+    create service, secret and repcon, then garbage collect old repcons
+
+    If the branch already runs a repcon for this image and config, it is
+    left running and only the stale repcons are collected. Returns
+    "unchanged" for such a no-op deploy, otherwise "deployed".
+
+    The branch's deploy lock is held until the new repcon is applied. With
+    record_stage, each stage is recorded as it is reached, then the new
+    repcon is checked `deploy_ready_checks` times for ready replicas.
+    Without it no one is watching, so readiness isn't checked.
+
+    """
 
-def update(param_set):
-    """ create service, secret and repcon, then garbage collect old repcons """
     (service_name,
      branch_name,
      config_id,
@@ -419,53 +1058,284 @@ def update(param_set):
     service_name = service_name.replace('_', '-')
     branch_name = branch_name.replace('_', '-')
 
-    print("updating {}".format(param_set))
+    if cluster is None:
+        cluster = default_cluster()
+
+    print("updating {} in {}".format(param_set, cluster.name))
+
+    try:
+        with branch_lock(service_name, branch_name, cluster.name):
+            with deploy_stage_duration.time(stage="render"):
+                manifests = render(
+                    service_name,
+                    branch_name,
+                    config_id,
+                    key_value_pairs,
+                    commit_hash,
+                    image_name,
+                )
+            record_stage("rendered")
+
+            with deploy_stage_duration.time(stage="service"):
+                idem_post("services", manifests.service, cluster)
+            record_stage("service_applied")
+
+            with deploy_stage_duration.time(stage="secret"):
+                if cfg('secret_cache', 'false') == 'true':
+                    # imported here, as known_secrets builds on this module
+                    from deployment.known_secrets import known_secrets
+                    known_secrets(cluster).ensure(manifests.secret)
+                else:
+                    apply_secret(manifests.secret, cluster)
+            record_stage("secret_applied")
+
+            with deploy_stage_duration.time(stage="gc_repcons"):
+                unchanged = gc_repcons(
+                    service_name,
+                    branch_name,
+                    commit_hash,
+                    config_id,
+                    cluster,
+                    manifests.repcon['metadata']['annotations'],
+                )
+            record_stage("old_repcons_scaled")
+
+            if unchanged:
+                print("{} {} already runs {}, leaving it be".format(
+                    service_name, branch_name, image_name))
+                record_stage("repcon_applied", "unchanged")
+            else:
+                with deploy_stage_duration.time(stage="repcon"):
+                    idem_post("replicationcontrollers", manifests.repcon,
+                              cluster)
+                record_stage("repcon_applied")
+    except Exception as e:
+        record_stage("failed", str(e))
+        raise
+
+    result = "unchanged" if unchanged else "deployed"
+    deploys.inc(result=result)
+
+    if record_stage is unrecorded:
+        return result
+    checks = int(cfg('deploy_ready_checks', '5'))
+    if checks <= 0:
+        record_stage("repcon_not_ready", "readiness not checked")
+        return result
+    with deploy_stage_duration.time(stage="ready"):
+        ready = wait_ready(manifests.repcon['metadata']['name'], checks,
+                           cluster)
+    if ready:
+        record_stage("repcon_ready")
+    else:
+        record_stage("repcon_not_ready",
+                     "not ready after {} checks".format(checks))
+    return result
 
-    idem_post(
-        "services",
-        k8s_service_description(service_name, branch_name, 8000),
-    )
 
-    idem_post("secrets", k8s_secret_description(key_value_pairs, config_id))
+actions = {
+    "UPDATE": update,
+}
 
-    # here we delete all repcons for this branch so that we will get config
-    # changes even if the build did not change. This will be refactored when
-    # we move to a simpler data model. In fact this is the impotus to move to
-    # the simpler data model.
 
-    gc_repcons(
-        service_name,
-        branch_name,
-        commit_hash,
-        config_id,
-    )
+def cluster_recorder(record_stage, cluster_name, finals):
+    """
+    return a stage recorder for one of many clusters
 
-    idem_post(
-        "replicationcontrollers",
-        k8s_repcon_description(
-            service_name,
-            branch_name,
-            config_id,
-            commit_hash,
-            image_name,
-            key_value_pairs,
-        )
-    )
+    Stages are recorded with the cluster's name as their detail, and each
+    cluster's final stage is kept in finals for `fan_out` to sum up.
 
+    """
 
-actions = {
-    "UPDATE": update,
-}
+    def record_cluster_stage(stage, detail=None):
+        if stage in release_status.final_stages:
+            finals[cluster_name] = (stage, detail)
+            return
+        if detail is None:
+            detail = cluster_name
+        else:
+            detail = "{}: {}".format(cluster_name, detail)
+        record_stage(stage, detail)
+    return record_cluster_stage
+
+
+def fan_out(action, param_set, targets, record_stage=unrecorded):
+    """
+    carry out the action for a param set in every target cluster at once
+
+    Each cluster is deployed on its own thread through its own connection
+    pool, so a slow cluster only holds up its own deploy. Returns
+    {cluster name: (result, seconds)}, where result is the action's,
+    "deployed" or "unchanged", and once every cluster is done raises the
+    first failure.
+
+    """
+
+    if len(targets) == 1 or record_stage is unrecorded:
+        recorders = dict((c.name, record_stage) for c in targets)
+    else:
+        finals = {}
+        recorders = dict(
+            (c.name, cluster_recorder(record_stage, c.name, finals))
+            for c in targets)
+
+    def deploy_to(cluster):
+        started = time.perf_counter()
+        try:
+            result = action(param_set, recorders[cluster.name], cluster)
+            error = None
+        except Exception as e:
+            error = e
+        elapsed = time.perf_counter() - started
+        result = "failed" if error else result or "deployed"
+        cluster_deploy_duration.observe(
+            elapsed, cluster=cluster.name, result=result)
+        return cluster.name, result, elapsed, error
+
+    with ThreadPoolExecutor(max_workers=len(targets)) as executor:
+        outcomes = list(executor.map(deploy_to, targets))
+
+    results = dict((name, (result, round(elapsed, 3)))
+                   for name, result, elapsed, error in outcomes)
+    print("deployed {} {}: {}".format(param_set[0], param_set[1], results))
+
+    if len(targets) > 1 and record_stage is not unrecorded:
+        stages = [stage for stage, detail in finals.values()]
+        if "failed" in stages or len(finals) < len(targets):
+            final = "failed"
+        elif all(stage == "repcon_ready" for stage in stages):
+            final = "repcon_ready"
+        else:
+            final = "repcon_not_ready"
+        record_stage(final, "; ".join(
+            "{}: {}".format(name, " ".join(filter(None, finals[name])))
+            for name in sorted(finals)))
+
+    for name, result, elapsed, error in outcomes:
+        if error is not None:
+            raise error
+    return results
 
 
 def runner(run_request):
     """ carry out the run request """
-    for param_set in run_params(run_request['release_id']):
-        actions[run_request['action']](param_set)
+    action = actions[run_request['action']]
+    error = None
+    for row in run_params(run_request['release_id']):
+        try:
+            targets = clusters(row[6])
+        except ValueError as e:
+            # one environment's bad settings don't hold up the others
+            print("Error deploying {} {}, {}".format(row[0], row[1], e))
+            error = error or e
+            continue
+        fan_out(action, tuple(row[:6]), targets)
 
     # calculate the canary run request
-    if os.environ['v2_model'] == 'run':
+    if cfg('v2_model', 'false') == 'run':
+        record_stage = stage_recorder(run_request['release_id'])
         for param_set in m2_run_params(run_request['release_id']):
-            actions[run_request['action']](param_set)
+            fan_out(action, param_set, [default_cluster()], record_stage)
 
+    if error is not None:
+        raise error
     return True
+
+
+def deploy_group(action, param_sets):
+    """
+    carry out the action for each (param set, clusters, stage recorder) in
+    order
+
+    """
+
+    # this group has left the queue
+    deploy_queue_depth.dec()
+    for param_set, targets, record_stage in param_sets:
+        fan_out(action, param_set, targets, record_stage)
+
+
+def deploy_batch(rows, action="UPDATE", max_workers=None):
+    """
+    carry out the action for (release_id, *params, settings) rows
+
+    The stages of rows with a herd 2.x release_id are recorded in
+    release_status; other rows have a release_id of None. settings are the
+    environment's, which list the clusters to deploy to.
+
+    Param sets are grouped by (service, branch) and the groups are deployed
+    concurrently, at most `max_workers` at a time. Param sets within a group
+    are deployed in order because they share k8s names and `gc_repcons`
+    would otherwise race against itself. A row whose settings don't name
+    usable clusters fails on its own, once the other rows are deployed.
+
+    """
+
+    if max_workers is None:
+        max_workers = int(cfg('deploy_concurrency', '4'))
+
+    # group on the names k8s will see so pipelines for one branch serialise
+    groups = {}
+    error = None
+    for row in rows:
+        param_set = tuple(row[1:7])
+        key = (param_set[0].replace('_', '-'), param_set[1].replace('_', '-'))
+        record_stage = unrecorded
+        if row[0] is not None:
+            record_stage = stage_recorder(row[0])
+        try:
+            targets = clusters(row[7])
+        except ValueError as e:
+            # one environment's bad settings don't hold up the others
+            print("Error deploying {} {}, {}".format(
+                param_set[0], param_set[1], e))
+            record_stage("failed", str(e))
+            error = error or e
+            continue
+        groups.setdefault(key, []).append((param_set, targets, record_stage))
+
+    deploy_queue_depth.inc(len(groups))
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = [
+            executor.submit(deploy_group, actions[action], param_sets)
+            for param_sets in groups.values()
+        ]
+        # surface the first failure, if any, once every group is done
+        for future in futures:
+            future.result()
+
+    if error is not None:
+        raise error
+    return True
+
+
+def batch_runner(release_ids, action="UPDATE", max_workers=None):
+    """
+    carry out the action for many releases in one pass
+
+    Run parameters for every release are fetched with one query per model
+    and deployed together by `deploy_batch`.
+
+    """
+
+    release_ids = list(release_ids)
+    if not release_ids:
+        return True
+
+    # legacy release ids are another model's, so have no status
+    rows = [(None,) + tuple(row[1:]) for row in batch_run_params(release_ids)]
+    if cfg('v2_model', 'false') == 'run':
+        # the herd 2.x model has no environments, so uses the default cluster
+        rows += [tuple(row) + (None,)
+                 for row in m2_batch_run_params(release_ids)]
+
+    return deploy_batch(rows, action, max_workers)
+
+
+def m2_batch_runner(release_ids, action="UPDATE", max_workers=None):
+    """ carry out the action for many herd 2.x releases in one pass """
+    release_ids = list(release_ids)
+    if not release_ids:
+        return True
+    rows = [tuple(row) + (None,) for row in m2_batch_run_params(release_ids)]
+    return deploy_batch(rows, action, max_workers)
@@ -0,0 +1,322 @@
+"""
+Keep track of the config secrets in each cluster, and collect unused ones
+
+Config secrets are content addressed, `<sha256(config)>-config-<id>`, so a
+secret that exists never needs posting again. A `KnownSecrets` cache holds
+the names of herd's secrets in a cluster and the secrets each repcon
+mounts. It is seeded with one LIST of each and kept current by watching
+them, so deploys skip posting secrets the cluster already has without
+asking the api server. Each serving process seeds a cache for every
+cluster at startup with `start_all`, and collects from its own caches.
+
+A deploy that skips posting a secret still marks it used in the cluster,
+with the `herd/last-used` annotation that apply_secret sets, so every
+process and replica, and the reconciler, sees the use. The mark is skipped
+when the cache has seen one newer than `secret_touch_seconds`, which
+should be well under the grace periods. A secret the mark finds gone was
+deleted elsewhere, and is posted again.
+
+The same cache counts the repcons that mount each secret. `collect` deletes
+the secrets no repcon mounts, once they have been neither created nor
+marked used for `secret_gc_grace_seconds`, in batches of
+`secret_gc_batch_size`. Each is deleted at the resourceVersion the cache
+last saw, so a secret marked used in the meantime is kept. __main__
+collects in every cluster herd deploys to every `secret_gc_interval`
+seconds when that is set.
+
+Deploys use the cache when `secret_cache` is true.
+
+"""
+
+import json
+import threading
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+
+from settings import cfg
+
+from deployment.gce import (
+    all_clusters,
+    idem_post,
+    k8s_endpoint,
+    k8s_request,
+    repcon_secret_names,
+    secret_idle,
+    touch_secret,
+    watch_uri,
+)
+from deployment.reconcile import at_version, secret_name_pattern
+from metrics import Counter
+
+skipped_posts = Counter(
+    "herd_secret_posts_skipped_total",
+    "Secret posts skipped because the cluster already had the secret",
+    ["cluster"],
+)
+collected = Counter(
+    "herd_secrets_collected_total",
+    "Unreferenced config secrets deleted, by cluster",
+    ["cluster"],
+)
+
+
+class KnownSecrets(object):
+    """ herd's secrets in a cluster, and the secrets each repcon mounts """
+
+    resources = ("secrets", "replicationcontrollers")
+
+    def __init__(self, cluster):
+        self.cluster = cluster
+        self.lock = threading.Lock()
+        # secret name -> when it was created or a deploy last used it
+        self.secrets = {}
+        # secret name -> the resourceVersion it was last seen at
+        self.secret_versions = {}
+        # repcon name -> the secret names it mounts
+        self.mounts = {}
+        self.versions = {}
+        self.stop = threading.Event()
+
+    def __contains__(self, name):
+        with self.lock:
+            return name in self.secrets
+
+    def seed(self, resource):
+        """ replace what is known of a resource with one LIST of it """
+        listed = k8s_request(
+            "get",
+            k8s_endpoint(resource, self.cluster),
+            self.cluster,
+        ).json()
+        with self.lock:
+            if resource == "secrets":
+                self.secrets = {}
+                self.secret_versions = {}
+            else:
+                self.mounts = {}
+            for item in listed['items']:
+                self.apply(resource, "ADDED", item)
+            self.versions[resource] = \
+                listed.get('metadata', {}).get('resourceVersion')
+
+    def apply(self, resource, kind, item):
+        """ apply an ADDED, MODIFIED or DELETED object; hold the lock """
+        name = item['metadata']['name']
+        if resource == "secrets":
+            if not secret_name_pattern.match(name):
+                return
+            if kind == "DELETED":
+                self.secrets.pop(name, None)
+                self.secret_versions.pop(name, None)
+            else:
+                now = time.time()
+                self.secrets[name] = now - secret_idle(item, now)
+                self.secret_versions[name] = \
+                    item['metadata'].get('resourceVersion')
+        else:
+            if kind == "DELETED":
+                self.mounts.pop(name, None)
+            else:
+                self.mounts[name] = repcon_secret_names(item)
+        version = item['metadata'].get('resourceVersion')
+        if version:
+            self.versions[resource] = version
+
+    def watch_once(self, resource, timeout=None):
+        """ apply one watch request's events, relisting if it is too old """
+        if timeout is None:
+            timeout = float(cfg('secret_watch_seconds', '300'))
+        response = k8s_request(
+            "get",
+            watch_uri(k8s_endpoint(resource, self.cluster)),
+            self.cluster,
+            params={
+                "resourceVersion": self.versions.get(resource) or "",
+                "timeoutSeconds": int(timeout),
+            },
+            stream=True,
+            timeout=timeout + 10,
+        )
+        try:
+            for line in response.iter_lines():
+                if self.stop.is_set():
+                    return
+                if not line:
+                    continue
+                event = json.loads(line)
+                if event['type'] == "ERROR":
+                    # the version is too old to watch from, so start again
+                    self.seed(resource)
+                    return
+                with self.lock:
+                    self.apply(resource, event['type'], event['object'])
+        finally:
+            response.close()
+
+    def watch(self, resource):
+        while not self.stop.is_set():
+            try:
+                self.watch_once(resource)
+            except Exception as e:
+                print("Error watching {} in {}, {}".format(
+                    resource, self.cluster.name, e))
+                self.stop.wait(5)
+                try:
+                    self.seed(resource)
+                except Exception:
+                    pass
+
+    def start(self):
+        """ seed the cache, then keep it current from daemon threads """
+        for resource in self.resources:
+            self.seed(resource)
+            threading.Thread(
+                target=self.watch,
+                args=(resource,),
+                name="watch-{}-{}".format(self.cluster.name, resource),
+                daemon=True,
+            ).start()
+        return self
+
+    def ensure(self, manifest, touch_seconds=None):
+        """ post a secret unless the cluster has it; True if it was posted """
+        if touch_seconds is None:
+            touch_seconds = float(cfg('secret_touch_seconds', '60'))
+        name = manifest['metadata']['name']
+        now = time.time()
+        with self.lock:
+            last_used = self.secrets.get(name)
+        if last_used is not None:
+            if now - last_used <= touch_seconds:
+                skipped_posts.inc(cluster=self.cluster.name)
+                return False
+            response = touch_secret(name, self.cluster)
+            if response.status_code < 400:
+                with self.lock:
+                    self.apply("secrets", "MODIFIED", response.json())
+                skipped_posts.inc(cluster=self.cluster.name)
+                return False
+            # collected since the cache saw it, so post it again
+        response = idem_post("secrets", manifest, self.cluster)
+        # 409 means another process posted it first
+        if response.status_code >= 400 and response.status_code != 409:
+            raise IOError("posting secret {} to {} failed, {} {}".format(
+                name, self.cluster.name, response.status_code,
+                response.text))
+        with self.lock:
+            self.secrets[name] = now
+        return True
+
+    def references(self):
+        """ return how many repcons mount each known secret """
+        with self.lock:
+            counts = dict((name, 0) for name in self.secrets)
+            for names in self.mounts.values():
+                for name in names:
+                    if name in counts:
+                        counts[name] += 1
+        return counts
+
+    def unreferenced(self, grace, now=None):
+        """ return the secrets no repcon mounts, idle for grace seconds """
+        if now is None:
+            now = time.time()
+        with self.lock:
+            last = dict(self.secrets)
+        return sorted(
+            name for name, count in self.references().items()
+            if count == 0 and name in last and now - last[name] > grace)
+
+    def collect(self, grace=None, batch_size=None, batch_interval=None):
+        """ delete unreferenced secrets in batches; return how many went """
+        if grace is None:
+            grace = float(cfg('secret_gc_grace_seconds', '600'))
+        if batch_size is None:
+            batch_size = int(cfg('secret_gc_batch_size', '20'))
+        if batch_interval is None:
+            batch_interval = float(cfg('secret_gc_batch_interval', '1'))
+
+        names = self.unreferenced(grace)
+        deleted = 0
+        with ThreadPoolExecutor(max_workers=batch_size) as executor:
+            for start in range(0, len(names), batch_size):
+                if start:
+                    time.sleep(batch_interval)
+                batch = names[start:start + batch_size]
+                with self.lock:
+                    versions = dict(
+                        (name, self.secret_versions.get(name))
+                        for name in batch)
+                futures = [
+                    (name, executor.submit(
+                        k8s_request,
+                        "delete",
+                        "{}/{}".format(
+                            k8s_endpoint("secrets", self.cluster), name),
+                        self.cluster,
+                        **at_version(versions[name])
+                    ))
+                    for name in batch
+                ]
+                for name, future in futures:
+                    if future.result().status_code < 400:
+                        with self.lock:
+                            self.secrets.pop(name, None)
+                            self.secret_versions.pop(name, None)
+                        deleted += 1
+        collected.inc(deleted, cluster=self.cluster.name)
+        print("collected {} unreferenced secrets in {}".format(
+            deleted, self.cluster.name))
+        return deleted
+
+
+caches = {}
+caches_lock = threading.Lock()
+
+
+def known_secrets(cluster):
+    """ return the started cache for a cluster """
+    key = (cluster.name, cluster.kubeproxy)
+    with caches_lock:
+        cache = caches.get(key)
+        if cache is None:
+            cache = caches[key] = KnownSecrets(cluster).start()
+        return cache
+
+
+def start_all():
+    """ seed and watch the cache of every cluster herd deploys to """
+    for cluster in all_clusters():
+        try:
+            known_secrets(cluster)
+        except Exception as e:
+            # the cluster's first deploy tries again
+            print("Error seeding secrets in {}, {}".format(cluster.name, e))
+
+
+def collect_all():
+    """ collect unreferenced secrets in every cluster herd deploys to """
+    collected = {}
+    for cluster in all_clusters():
+        try:
+            collected[cluster.name] = known_secrets(cluster).collect()
+        except Exception as e:
+            print("Error collecting secrets in {}, {}".format(
+                cluster.name, e))
+    return collected
+
+
+def run_periodically(interval):
+    """ collect unreferenced secrets every interval seconds """
+    stop = threading.Event()
+
+    def loop():
+        while not stop.wait(interval):
+            try:
+                collect_all()
+            except Exception as e:
+                print("Error collecting secrets, {}".format(e))
+
+    threading.Thread(target=loop, name="secret-gc", daemon=True).start()
+    return stop
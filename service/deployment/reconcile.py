@@ -0,0 +1,302 @@
+"""
+Sweep kubernetes objects herd no longer needs
+
+Branches that go away without a delete webhook leave their services and
+replication controllers behind, and secrets are never deleted by deploys.
+`reconcile` lists herd's objects once per kind in each cluster herd deploys
+to, the default cluster and those the legacy environments list, and
+compares them to the live branches of both models:
+
+- repcons and services labelled for a branch that is not live are orphans
+- config secrets no remaining repcon mounts are orphans, once no deploy
+  has created or used them for `reconcile_grace_seconds`. Deploys apply
+  the secret before touching repcons, and mark a secret that is already
+  there with its `herd/last-used` annotation. A secret is only deleted
+  at the resourceVersion it was listed at, so one a deploy marks in the
+  meantime is kept.
+
+Orphans are deleted in batches of `reconcile_batch_size`, waiting
+`reconcile_batch_interval` seconds between batches so the api server is
+not flooded. Repcons go with one collection delete per branch.
+
+Reconciling is a dry run, which only reports, unless `reconcile_dry_run` is
+false. __main__ reconciles every `reconcile_interval` seconds when that is
+set; it can also be run by hand:
+
+    python3 service/deployment/reconcile.py [--delete]
+
+"""
+
+import argparse
+import os
+import re
+import sys
+import threading
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+
+if __name__ == '__main__':
+    sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(
+        __file__))))
+
+from settings import cfg
+
+from db import get_cursor, m2_get_cursor
+from deployment.gce import (
+    all_clusters,
+    k8s_endpoint,
+    k8s_request,
+    k8s_service_name,
+    repcon_secret_names,
+    secret_idle,
+)
+from metrics import Counter, Gauge
+
+reclaimed = Counter(
+    "herd_reconcile_deleted_total",
+    "Orphaned kubernetes objects deleted by the reconciler, by kind",
+    ["kind"],
+)
+orphans = Gauge(
+    "herd_reconcile_orphans",
+    "Orphaned kubernetes objects found by the last reconcile, by kind",
+    ["kind"],
+)
+
+# the content addressed names of config secrets
+secret_name_pattern = re.compile('^[0-9a-f]{64}-config-[0-9]+$')
+
+
+def k8s_name(name):
+    """ k8s names and labels use '-' where herd's names may have '_' """
+    return name.replace('_', '-')
+
+
+def live_branches():
+    """ return the (service, branch) label pairs of every live branch """
+    live = set()
+
+    cursor = get_cursor()
+    cursor.execute(
+        ("SELECT service_name\n"
+         "      ,branch_name\n"
+         "  FROM branch b\n"
+         "  JOIN feature f\n"
+         "    ON f.feature_id = b.feature_id\n"
+         "  JOIN service s\n"
+         "    ON s.service_id = f.service_id"),
+    )
+    live.update(cursor.fetchall())
+    cursor.close()
+
+    cursor = m2_get_cursor()
+    cursor.execute(
+        ("select service_name\n"
+         "      ,branch_name\n"
+         "  from branch b\n"
+         "  join service s\n"
+         "    on s.service_id = b.service_id\n"
+         " where deleted_dt = 'infinity'"),
+    )
+    live.update(cursor.fetchall())
+    cursor.close()
+
+    return set((k8s_name(s), k8s_name(b)) for s, b in live)
+
+
+def list_items(resource, cluster=None):
+    """ return every object of a resource type """
+    return k8s_request(
+        "get", k8s_endpoint(resource, cluster), cluster).json()['items']
+
+
+def branch_of(labels):
+    """ return the (service, branch) a herd label set is for, if any """
+    if labels and 'service' in labels and 'branch' in labels:
+        return (labels['service'], labels['branch'])
+    return None
+
+
+def service_name_of(branch):
+    """ return the name herd gives a branch's k8s service, if it has one """
+    try:
+        return k8s_service_name(*branch)
+    except NameError:
+        return None
+
+
+def at_version(version):
+    """ return delete kwargs that only delete an object at a version """
+    if not version:
+        return {}
+    return {"json": {
+        "kind": "DeleteOptions",
+        "apiVersion": "v1",
+        "preconditions": {"resourceVersion": version},
+    }}
+
+
+def unchanged_since(item):
+    """ return delete kwargs that only delete the object as it was listed """
+    return at_version(item['metadata'].get('resourceVersion'))
+
+
+def find_orphans(live, repcons, services, secrets, grace=0, now=None,
+                 cluster=None):
+    """
+    return the delete requests, (kind, uri, kwargs), for orphaned objects
+
+    live is the set of (service, branch) pairs that should keep running, and
+    the objects are the cluster's
+
+    """
+
+    if now is None:
+        now = time.time()
+    # service names are truncated, so a dead branch may share a live name
+    live_service_names = set(service_name_of(branch) for branch in live)
+
+    deletes = []
+    mounted = set()
+    orphan_branches = set()
+    for repcon in repcons:
+        branch = branch_of(repcon['metadata'].get('labels'))
+        if branch is not None and branch not in live:
+            orphan_branches.add(branch)
+        else:
+            mounted |= repcon_secret_names(repcon)
+
+    for service_name, branch_name in sorted(orphan_branches):
+        deletes.append(("replicationcontrollers",
+                        k8s_endpoint("replicationcontrollers", cluster), {
+            "params": {
+                "labelSelector": "service={},branch={}".format(
+                    service_name,
+                    branch_name,
+                ),
+            },
+            "json": {
+                "kind": "DeleteOptions",
+                "apiVersion": "v1",
+                "propagationPolicy": "Background",
+            },
+        }))
+
+    for service in services:
+        branch = branch_of(service.get('spec', {}).get('selector'))
+        name = service['metadata']['name']
+        # only services named the way herd names them are herd's
+        if branch is None or branch in live or \
+                name != service_name_of(branch) or \
+                name in live_service_names:
+            continue
+        deletes.append(("services", "{}/{}".format(
+            k8s_endpoint("services", cluster), name), {}))
+
+    for secret in secrets:
+        name = secret['metadata']['name']
+        if secret_name_pattern.match(name) and name not in mounted and \
+                secret_idle(secret, now) > grace:
+            deletes.append(("secrets", "{}/{}".format(
+                k8s_endpoint("secrets", cluster), name),
+                unchanged_since(secret)))
+
+    return deletes
+
+
+def reconcile(dry_run=None, batch_size=None, batch_interval=None,
+              targets=None):
+    """
+    delete orphaned k8s objects in rate limited batches, in every cluster
+
+    Returns the number of orphans found, or on a real run deleted, by kind.
+    Nothing is deleted on a dry run, or when there are no live branches at
+    all, which more likely means a bad database than an empty herd.
+
+    """
+
+    if dry_run is None:
+        dry_run = cfg('reconcile_dry_run', 'true') != 'false'
+    if batch_size is None:
+        batch_size = int(cfg('reconcile_batch_size', '20'))
+    if batch_interval is None:
+        batch_interval = float(cfg('reconcile_batch_interval', '1'))
+    if targets is None:
+        targets = all_clusters()
+    grace = float(cfg('reconcile_grace_seconds', '600'))
+
+    live = live_branches()
+    deletes = []
+    for cluster in targets:
+        deletes += [
+            (cluster, kind, uri, kwargs)
+            for kind, uri, kwargs in find_orphans(
+                live,
+                list_items("replicationcontrollers", cluster),
+                list_items("services", cluster),
+                list_items("secrets", cluster),
+                grace,
+                cluster=cluster,
+            )
+        ]
+
+    found = {}
+    for cluster, kind, uri, kwargs in deletes:
+        found[kind] = found.get(kind, 0) + 1
+    for kind in ["replicationcontrollers", "services", "secrets"]:
+        orphans.set(found.get(kind, 0), kind=kind)
+    print("reconcile found orphans {} in {}".format(
+        found, [c.name for c in targets]))
+
+    if dry_run:
+        return found
+    if not live:
+        print("reconcile found no live branches, not deleting anything")
+        return found
+
+    deleted = {}
+    with ThreadPoolExecutor(max_workers=batch_size) as executor:
+        for start in range(0, len(deletes), batch_size):
+            if start:
+                time.sleep(batch_interval)
+            batch = deletes[start:start + batch_size]
+            futures = [
+                (kind, executor.submit(
+                    k8s_request, "delete", uri, cluster, **kwargs))
+                for cluster, kind, uri, kwargs in batch
+            ]
+            for kind, future in futures:
+                if future.result().status_code < 400:
+                    reclaimed.inc(kind=kind)
+                    deleted[kind] = deleted.get(kind, 0) + 1
+    print("reconcile deleted orphans {}".format(deleted))
+    return deleted
+
+
+def run_periodically(interval):
+    """ reconcile every interval seconds from a daemon thread """
+    stop = threading.Event()
+
+    def loop():
+        while not stop.wait(interval):
+            try:
+                reconcile()
+            except Exception as e:
+                print("Error reconciling, {}".format(e))
+
+    threading.Thread(target=loop, name="reconcile", daemon=True).start()
+    return stop
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument("--delete", action="store_true",
+                        help="delete the orphans instead of reporting them")
+    args = parser.parse_args(argv)
+    reconcile(dry_run=not args.delete)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,6 +1,6 @@
 from functools import partial
 
-from config_finder import cfg
+from settings import cfg
 
 from db import get_cursor
 from getters import (
@@ -9,7 +9,7 @@ from factories import (
 from getters import get_iteration
 from setters import set_iteration
 
-from deployment.gce import runner
+from deployment import batch_runner
 
 from bottle import (
     request,
@@ -59,7 +59,7 @@ def handle_build(commit_hash, image_name):
     iteration = get_iteration(commit_hash=commit_hash)
     set_iteration(iteration['iteration_id'], {'image_name': image_name})
     releases = idem_release_in_automatic_pipelines(iteration['iteration_id'])
-    print("running releases {}".format(releases))
-    for release in releases:
-        runner({"release_id": release, "action": "UPDATE"})
+    release_ids = [release[0] for release in releases]
+    print("running releases {}".format(release_ids))
+    batch_runner(release_ids, "UPDATE")
     return {'iteration_id': iteration['iteration_id']}
@@ -0,0 +1,241 @@
+"""
+Idempotent webhooks
+
+CI retries and re-runs call the build webhooks again with the same
+arguments. A handler wrapped with `idempotent` remembers its response for
+`idempotency_ttl` seconds under the request's path and auth principal, and
+answers a duplicate inside that window with the original response without
+running the handler again.
+
+Responses are kept in memory, and in the webhook_response table so other
+processes and replicas see them too. A duplicate that arrives while the
+original is still running waits for its response. `answer_once` does the
+same for the async server's handlers. Duplicates are counted in
+herd_webhook_duplicates_total. Set idempotency_ttl to 0 to turn this off.
+
+"""
+
+import asyncio
+import hashlib
+import json
+import re
+import threading
+import time
+
+from collections import OrderedDict
+from functools import wraps
+from urllib.parse import unquote
+
+from bottle import request
+
+from settings import cfg
+
+from db import m2_get_cursor
+from metrics import Counter
+
+ttl = int(cfg('idempotency_ttl', '600'))
+
+duplicates = Counter(
+    "herd_webhook_duplicates_total",
+    "Duplicate webhooks answered with the original response, by route",
+    ["route"],
+)
+
+slashes = re.compile('/+')
+
+
+def request_key(principal, path):
+    """ return the key for a request by the principal to the path """
+    normal = slashes.sub('/', unquote(path)).rstrip('/')
+    return hashlib.sha256(
+        "{} {}".format(principal, normal).encode()).hexdigest()
+
+
+class ResponseCache(object):
+    """ a small thread safe cache of responses that expire """
+
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            expires, response = entry
+            if expires <= time.monotonic():
+                del self.entries[key]
+                return None
+            return response
+
+    def put(self, key, response, ttl):
+        with self.lock:
+            self.entries[key] = (time.monotonic() + ttl, response)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+
+responses = ResponseCache(int(cfg('idempotency_cache_size', '4096')))
+
+# requests being handled, by key, so duplicates can wait for them
+in_flight = {}
+in_flight_lock = threading.Lock()
+# the same for requests on the event loop, which needs no lock
+loop_in_flight = {}
+
+
+stored_response_sql = (
+    "select response, extract(epoch from expires_dt - now())\n"
+    "  from webhook_response\n"
+    " where request_key = %s\n"
+    "   and expires_dt > now()"
+)
+
+store_response_sql = (
+    "with expired as (\n"
+    "    delete from webhook_response where expires_dt <= now()\n"
+    ")\n"
+    "insert into webhook_response (request_key, response, expires_dt)\n"
+    "     values (%s, %s, now() + %s * interval '1 second')\n"
+    "on conflict (request_key) do update\n"
+    "        set response = excluded.response\n"
+    "          , expires_dt = excluded.expires_dt"
+)
+
+
+def stored_response(key):
+    """ return the response stored in postgres for the key, if any """
+    cursor = m2_get_cursor()
+    cursor.execute(stored_response_sql, (key,))
+    row = cursor.fetchone()
+    cursor.close()
+    if row is None:
+        return None
+    response, remaining = row
+    response = json.loads(response)
+    responses.put(key, response, float(remaining))
+    return response
+
+
+def store_response(key, response, ttl):
+    """ store the response in postgres, clearing out expired responses """
+    cursor = m2_get_cursor()
+    cursor.execute(store_response_sql, (key, json.dumps(response), ttl))
+    cursor.close()
+
+
+def lookup(key):
+    """ return the remembered response for the key, if any """
+    response = responses.get(key)
+    if response is not None:
+        return response
+    try:
+        return stored_response(key)
+    except Exception as e:
+        print("Error looking up webhook response, {}".format(e))
+        return None
+
+
+def remember(key, response):
+    responses.put(key, response, ttl)
+    try:
+        store_response(key, response, ttl)
+    except Exception as e:
+        print("Error storing webhook response, {}".format(e))
+
+
+def idempotent(handler):
+    """ answer duplicate requests with the handler's original response """
+    @wraps(handler)
+    def idempotent_handler(*args, **kwargs):
+        if ttl <= 0:
+            return handler(*args, **kwargs)
+
+        key = request_key(
+            request.headers.get('X-Authenticated-Token', ''),
+            request.path,
+        )
+        route = request.route.name or "none"
+
+        while True:
+            with in_flight_lock:
+                running = in_flight.get(key)
+                if running is None:
+                    done = in_flight[key] = threading.Event()
+
+            if running is None:
+                try:
+                    response = lookup(key)
+                    if response is None:
+                        response = handler(*args, **kwargs)
+                        # remember an empty body as "" so it is found again
+                        remember(key, "" if response is None else response)
+                        return response
+                finally:
+                    with in_flight_lock:
+                        del in_flight[key]
+                    done.set()
+                break
+
+            # the original is still being handled, wait for its response
+            if not running.wait(ttl):
+                # too long to wait for, so this is a new attempt
+                return handler(*args, **kwargs)
+            response = lookup(key)
+            if response is not None:
+                break
+            # the original failed, so one waiter tries again while the
+            # others wait for it
+
+        duplicates.inc(route=route)
+        print("answering duplicate {} with the original response".format(
+            request.path))
+        return response
+
+    return idempotent_handler
+
+
+async def answer_once(key, lookup, remember, handle):
+    """
+    the loop of `idempotent` for a request on the event loop
+
+    lookup(key) and remember(key, response) are coroutine functions, and
+    handle() returns an awaitable of the handler's response. Returns the
+    response, and True when it is the original's answering a duplicate.
+
+    """
+
+    while True:
+        running = loop_in_flight.get(key)
+        if running is None:
+            done = loop_in_flight[key] = asyncio.Event()
+            try:
+                response = await lookup(key)
+                if response is None:
+                    response = await handle()
+                    # remember an empty body as "" so it is found again
+                    await remember(key, "" if response is None else response)
+                    return response, False
+            finally:
+                del loop_in_flight[key]
+                done.set()
+            return response, True
+
+        # the original is still being handled, wait for its response
+        try:
+            await asyncio.wait_for(running.wait(), ttl)
+        except asyncio.TimeoutError:
+            # too long to wait for, so this is a new attempt
+            return await handle(), False
+        response = await lookup(key)
+        if response is not None:
+            return response, True
+        # the original failed, so one waiter tries again while the others
+        # wait for it
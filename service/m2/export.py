@@ -0,0 +1,106 @@
+"""
+Export the herd 2.x release history as newline delimited JSON
+
+Rows are read through a server side cursor `export_chunk_size` at a time
+and written as they arrive, so memory use stays flat however long the
+history is. The api streams it from /v1/export/releases, and it can be
+written to a file or stdout with
+
+    python3 service/m2/export.py [--since RELEASE_ID] [--output FILE]
+
+`since` exports only releases after that release id, for incremental
+exports.
+
+"""
+
+import argparse
+import json
+import os
+import sys
+
+if __name__ == '__main__':
+    sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(
+        __file__))))
+
+from settings import cfg
+
+from db import m2_get_cursor as get_cursor
+from m2.getters import jsonable
+
+chunk_size = int(cfg('export_chunk_size', '2000'))
+
+
+def release_history(since=0, size=None):
+    """ yield a dict for every release after `since`, oldest first """
+    if size is None:
+        size = chunk_size
+    cursor = get_cursor(name="release_history")
+    try:
+        cursor.itersize = size
+        cursor.execute(
+            ("select r.release_id\n"
+             "      ,r.created_dt\n"
+             "      ,r.config_id\n"
+             "      ,r.service_version_seq\n"
+             "      ,r.branch_version_seq\n"
+             "      ,i.iteration_id\n"
+             "      ,i.commit_hash\n"
+             "      ,i.image_name\n"
+             "      ,b.branch_id\n"
+             "      ,b.branch_name\n"
+             "      ,b.merge_base_commit_hash\n"
+             "      ,s.service_id\n"
+             "      ,s.service_name\n"
+             "  from release r\n"
+             "  join iteration i on i.iteration_id = r.iteration_id\n"
+             "  join branch b on b.branch_id = i.branch_id\n"
+             "  join service s on s.service_id = b.service_id\n"
+             " where r.release_id > %s\n"
+             " order by r.release_id"),
+            (since,),
+        )
+        columns = None
+        while True:
+            rows = cursor.fetchmany(size)
+            if not rows:
+                break
+            if columns is None:
+                columns = [c[0] for c in cursor.description]
+            for row in rows:
+                yield dict((c, jsonable(v)) for c, v in zip(columns, row))
+    finally:
+        connection = cursor.connection
+        if not cursor.closed:
+            cursor.close()
+        connection.close()
+
+
+def ndjson(records):
+    """ yield each record as a line of JSON """
+    for record in records:
+        yield (json.dumps(record, sort_keys=True) + '\n').encode()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument("--since", type=int, default=0,
+                        help="only export releases after this release id")
+    parser.add_argument("--output", default="-",
+                        help="file to write to (default stdout)")
+    args = parser.parse_args(argv)
+
+    if args.output == "-":
+        output = sys.stdout.buffer
+    else:
+        output = open(args.output, 'wb')
+    try:
+        for line in ndjson(release_history(args.since)):
+            output.write(line)
+    finally:
+        if output is not sys.stdout.buffer:
+            output.close()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
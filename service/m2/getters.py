@@ -0,0 +1,179 @@
+"""
+Read only lists of the herd 2.x model for the api
+
+Every list is newest first and paged by keyset on (created_dt, id): a page
+ends with a `next` token holding the key of its last row, and the next page
+starts strictly after it. Unlike OFFSET, fetching a page costs the same
+however deep into the history it is.
+
+Branches come with their head, the release `branch_head` holds for them.
+
+Each lister also has a `version`, a cheap aggregate of the list's rows that
+changes whenever the list does, for validating a client's cached pages
+without running the list.
+
+"""
+
+import base64
+import datetime
+import json
+
+from db import m2_get_cursor as get_cursor
+
+default_limit = 50
+max_limit = 500
+
+# sorts after every real row, so the first page uses the same query
+first_key = ('infinity', 2 ** 31 - 1)
+
+
+def encode_key(created_dt, row_id):
+    """ return the opaque token for a page starting after this key """
+    return base64.urlsafe_b64encode(
+        json.dumps([created_dt, row_id]).encode()).decode()
+
+
+def decode_key(token):
+    """ return the key in a page token, ValueError if it is not one """
+    try:
+        created_dt, row_id = json.loads(base64.urlsafe_b64decode(
+            token.encode()).decode())
+        datetime.datetime.strptime(created_dt, "%Y-%m-%dT%H:%M:%S.%f")
+        return created_dt, int(row_id)
+    except Exception:
+        raise ValueError("not a page token: {}".format(token))
+
+
+def jsonable(value):
+    if isinstance(value, datetime.datetime):
+        return value.strftime("%Y-%m-%dT%H:%M:%S.%f")
+    return value
+
+
+def make_lister(select, table, key_id, where="", version=None):
+    """
+    return a function listing a page of a query
+
+    select and where are sql fragments, table is the alias of the table
+    being paged, and key_id its id column. The function takes the values
+    for where's placeholders, then `after` (a page token) and `limit`.
+
+    version is a query over the same rows, taking where's values, whose
+    result changes whenever the list's does. The lister's `version`
+    function returns its result.
+
+    """
+
+    sql_template = (
+        "{select}\n"
+        " where {where}({table}.created_dt, {table}.{key_id})"
+        " < (%s::timestamp, %s)\n"
+        " order by {table}.created_dt desc, {table}.{key_id} desc\n"
+        " limit %s"
+    )
+    sql = sql_template.format(
+        select=select,
+        where="{} and ".format(where) if where else "",
+        table=table,
+        key_id=key_id,
+    )
+
+    def lister(*values, after=None, limit=default_limit):
+        """ return {'items': [...], 'next': token or None} """
+        key = first_key if after is None else decode_key(after)
+        limit = max(1, min(int(limit), max_limit))
+
+        cursor = get_cursor()
+        # one extra row tells us whether there is another page
+        cursor.execute(sql, values + key + (limit + 1,))
+        columns = [c[0] for c in cursor.description]
+        rows = cursor.fetchall()
+        cursor.close()
+
+        items = [
+            dict((c, jsonable(v)) for c, v in zip(columns, row))
+            for row in rows[:limit]
+        ]
+        following = None
+        if len(rows) > limit:
+            last = items[-1]
+            following = encode_key(last['created_dt'], last[key_id])
+        return {'items': items, 'next': following}
+
+    def lister_version(*values):
+        """ return the list's version, a tuple of aggregates """
+        cursor = get_cursor()
+        cursor.execute(version, values)
+        row = cursor.fetchone()
+        cursor.close()
+        return row
+
+    lister.__name__ = "list_{}".format(key_id[:-len("_id")])
+    lister.version = lister_version
+    return lister
+
+
+list_services = make_lister(
+    ("select s.service_id, s.service_name, s.created_dt\n"
+     "  from service s"),
+    "s",
+    "service_id",
+    version="select count(*), max(service_id) from service",
+)
+
+list_branches = make_lister(
+    ("select b.branch_id, b.branch_name, b.merge_base_commit_hash\n"
+     "      ,b.created_dt, nullif(b.deleted_dt, 'infinity') deleted_dt\n"
+     "      ,h.release_id head_release_id, h.config_id head_config_id\n"
+     "      ,i.commit_hash head_commit_hash, i.image_name head_image_name\n"
+     "  from branch b\n"
+     "  join service s on s.service_id = b.service_id\n"
+     "  left join branch_head h on h.branch_id = b.branch_id\n"
+     "  left join iteration i on i.iteration_id = h.iteration_id"),
+    "b",
+    "branch_id",
+    "s.service_name = %s",
+    # heads only move forward, so their sum moves with any of them
+    version=("select count(*), max(b.branch_id)\n"
+             "      ,count(nullif(b.deleted_dt, 'infinity'))\n"
+             "      ,sum(h.release_id)\n"
+             "  from branch b\n"
+             "  join service s on s.service_id = b.service_id\n"
+             "  left join branch_head h on h.branch_id = b.branch_id\n"
+             " where s.service_name = %s"),
+)
+
+list_iterations = make_lister(
+    ("select i.iteration_id, b.branch_name, i.commit_hash, i.image_name\n"
+     "      ,i.created_dt\n"
+     "  from iteration i\n"
+     "  join branch b on b.branch_id = i.branch_id\n"
+     "  join service s on s.service_id = b.service_id"),
+    "i",
+    "iteration_id",
+    "s.service_name = %s",
+    version=("select count(*), max(i.iteration_id)\n"
+             "  from iteration i\n"
+             "  join branch b on b.branch_id = i.branch_id\n"
+             "  join service s on s.service_id = b.service_id\n"
+             " where s.service_name = %s"),
+)
+
+list_releases = make_lister(
+    ("select r.release_id, b.branch_name, i.commit_hash, i.image_name\n"
+     "      ,r.config_id, r.service_version_seq, r.branch_version_seq\n"
+     "      ,r.created_dt\n"
+     "  from release r\n"
+     "  join iteration i on i.iteration_id = r.iteration_id\n"
+     "  join branch b on b.branch_id = i.branch_id\n"
+     "  join service s on s.service_id = b.service_id"),
+    "r",
+    "release_id",
+    "s.service_name = %s",
+    version=("select count(*), max(r.release_id)\n"
+             "  from release r\n"
+             "  join iteration i on i.iteration_id = r.iteration_id\n"
+             "  join branch b on b.branch_id = i.branch_id\n"
+             "  join service s on s.service_id = b.service_id\n"
+             " where s.service_name = %s"),
+)
@@ -6,8 +6,12 @@ No need for the indirection inserted by the "factories" idea.
 
 """
 
+from collections import OrderedDict
+
 from db import m2_get_cursor as get_cursor
+from deployment import backend
 from psycopg2.extras import register_hstore
+from settings import cfg
 from uuid import uuid4
 
 
@@ -21,6 +25,14 @@ def save(cursor, table, unique_columns, columns, values, returning=default):
 
     """
 
+    query = save_query(table, unique_columns, columns, values, returning)
+    cursor.execute(query, values)
+    return_value = cursor.fetchone()[0]
+    return return_value
+
+
+def save_query(table, unique_columns, columns, values, returning=default):
+    """ return the insert statement `save` runs """
     assert type(table) == str
     assert type(unique_columns) == list
     assert type(columns) == list
@@ -67,28 +79,41 @@ def save(cursor, table, unique_columns, columns, values, returning=default):
         conflict_clause,
         returning,
     )
-    cursor.execute(query, values)
-    return_value = cursor.fetchone()[0]
-    return return_value
+    return query
+
+
+qa_config_query = (
+    "select coalesce( "
+    "       (select config_id "
+    "          from branch_head "
+    "         where branch_id=%s), "
+    "       (select config_id "
+    "          from release "
+    "          join iteration using (iteration_id) "
+    "         where commit_hash=%s "
+    "         order by iteration.created_dt desc, release.created_dt desc "
+    "         limit 1), "
+    "       (select h.config_id "
+    "          from iteration "
+    "          join branch_head h using (branch_id) "
+    "         where commit_hash=%s "
+    "         order by iteration.created_dt desc "
+    "         limit 1)) "
+)
 
 
 def correct_qa_config(cursor, branch_id, merge_base_commit_hash):
     """ Return the config_id to release a new commit to this build with """
     register_hstore(cursor)
-    # if there are releases on this branch, use the config from the most recent
-    # otherwise use the most recent release of the merge base commit
+    # if there are releases on this branch, use the config from its head
+    # otherwise use the most recent release of the merge base commit, or
+    # when that was retired, the head of the branch it was built on
     cursor.execute(
-        ("select config_id "
-         "  from release "
-         "  join iteration using (iteration_id) "
-         " where branch_id=%s "
-         "    or commit_hash=%s "
-         " order by iteration.created_dt desc, release.created_dt desc "
-         " limit 1 "),
-        (branch_id, merge_base_commit_hash),
+        qa_config_query,
+        (branch_id, merge_base_commit_hash, merge_base_commit_hash),
     )
-    results = cursor.fetchall()
-    if len(results) is 0:
+    config_id = cursor.fetchone()[0]
+    if config_id is None:
         config_id = save(
             cursor,
             'config',               # table
@@ -96,10 +121,6 @@ def correct_qa_config(cursor, branch_id, merge_base_commit_hash):
             ['key_value_pairs'],    # column
             ({},),                  # value
         )
-    elif len(results) is 1:
-        config_id = results[0][0]
-    else:
-        raise ValueError("There should only be one correct config")
     return config_id
 
 
@@ -147,3 +168,182 @@ def handle_build(service_name,
         ( iteration_id ,  config_id ),       # values
     )
     cursor.close()
+
+
+build_fields = [
+    'service_name',
+    'branch_name',
+    'merge_base_commit_hash',
+    'commit_hash',
+    'image_name',
+]
+
+
+def handle_builds(builds):
+    """
+    Save many builds in one transaction, then deploy their releases together
+
+    builds is a list of dicts with the arguments of handle_build. Each table
+    is written with one set based insert, with the same conflict handling as
+    `save`, and every build gets a release with the config
+    `correct_qa_config` would choose. Returns the builds, in order, each
+    with its release_id.
+
+    """
+
+    if not builds:
+        return []
+
+    cursor = get_cursor()
+
+    # rows must be unique within an insert ... on conflict do update
+    service_names = list(OrderedDict.fromkeys(
+        b['service_name'] for b in builds))
+    cursor.execute(
+        ("insert into service (service_name)\n"
+         "     select unnest(%s::varchar[])\n"
+         "on conflict (service_name) do update\n"
+         "        set service_name = service.service_name\n"
+         "  returning service_name, service_id"),
+        (service_names,),
+    )
+    service_ids = dict(cursor.fetchall())
+
+    branches = OrderedDict()
+    for b in builds:
+        key = (b['branch_name'], b['merge_base_commit_hash'])
+        branches.setdefault(key, service_ids[b['service_name']])
+    cursor.execute(
+        ("insert into branch (branch_name, merge_base_commit_hash, service_id)\n"
+         "     select * from unnest(%s::varchar[], %s::varchar[], %s::int[])\n"
+         "on conflict (branch_name, merge_base_commit_hash, deleted_dt)\n"
+         "  do update set merge_base_commit_hash\n"
+         "              = branch.merge_base_commit_hash\n"
+         "  returning branch_name, merge_base_commit_hash, branch_id"),
+        ([k[0] for k in branches],
+         [k[1] for k in branches],
+         list(branches.values())),
+    )
+    branch_ids = dict(((n, m), i) for n, m, i in cursor.fetchall())
+
+    iterations = OrderedDict()
+    for b in builds:
+        branch_id = branch_ids[(b['branch_name'], b['merge_base_commit_hash'])]
+        iterations.setdefault((b['commit_hash'], branch_id), b['image_name'])
+    cursor.execute(
+        ("insert into iteration (commit_hash, branch_id, image_name)\n"
+         "     select * from unnest(%s::varchar[], %s::int[], %s::varchar[])\n"
+         "on conflict (branch_id, commit_hash) do update\n"
+         "        set branch_id = iteration.branch_id\n"
+         "  returning commit_hash, branch_id, iteration_id"),
+        ([k[0] for k in iterations],
+         [k[1] for k in iterations],
+         list(iterations.values())),
+    )
+    iteration_ids = dict(((c, b), i) for c, b, i in cursor.fetchall())
+
+    # the config of each branch's head, or of its merge base's latest
+    # release, or of the head of the branch the merge base was built on
+    cursor.execute(
+        ("select b.branch_id,\n"
+         "       coalesce(h.config_id, m.config_id, mh.config_id)\n"
+         "  from unnest(%s::int[], %s::varchar[]) b (branch_id, merge_base)\n"
+         "  left join branch_head h on h.branch_id = b.branch_id\n"
+         "  left join lateral (\n"
+         "       select config_id\n"
+         "         from release\n"
+         "         join iteration using (iteration_id)\n"
+         "        where commit_hash = b.merge_base\n"
+         "        order by iteration.created_dt desc, release.created_dt desc\n"
+         "        limit 1\n"
+         "       ) m on h.config_id is null\n"
+         "  left join lateral (\n"
+         "       select mbh.config_id\n"
+         "         from iteration\n"
+         "         join branch_head mbh using (branch_id)\n"
+         "        where commit_hash = b.merge_base\n"
+         "        order by iteration.created_dt desc\n"
+         "        limit 1\n"
+         "       ) mh on coalesce(h.config_id, m.config_id) is null"),
+        (list(branch_ids.values()), [k[1] for k in branch_ids]),
+    )
+    config_ids = dict(cursor.fetchall())
+    if None in config_ids.values():
+        register_hstore(cursor)
+        empty_config_id = save(
+            cursor,
+            'config',               # table
+            ['key_value_pairs'],    # unique columns
+            ['key_value_pairs'],    # column
+            ({},),                  # value
+        )
+        for branch_id, config_id in config_ids.items():
+            if config_id is None:
+                config_ids[branch_id] = empty_config_id
+
+    # allocate the release ids up front so each build knows its release
+    cursor.execute(
+        ("select nextval(pg_get_serial_sequence('release', 'release_id'))\n"
+         "  from generate_series(1, %s)"),
+        (len(builds),),
+    )
+    release_ids = [row[0] for row in cursor.fetchall()]
+    release_iteration_ids = []
+    release_config_ids = []
+    for b in builds:
+        branch_id = branch_ids[(b['branch_name'], b['merge_base_commit_hash'])]
+        release_iteration_ids.append(
+            iteration_ids[(b['commit_hash'], branch_id)])
+        release_config_ids.append(config_ids[branch_id])
+    cursor.execute(
+        ("insert into release (release_id, iteration_id, config_id)\n"
+         "     select * from unnest(%s::int[], %s::int[], %s::int[])"),
+        (release_ids, release_iteration_ids, release_config_ids),
+    )
+    cursor.close()
+
+    if cfg('v2_model', 'false') == 'run':
+        backend('gce').m2_batch_runner(release_ids, "UPDATE")
+
+    return [dict(b, release_id=release_id)
+            for b, release_id in zip(builds, release_ids)]
+
+
+def handle_delete(payload):
+    """
+    Mark a deleted branch as deleted, then tear down what it runs
+
+    payload is github's delete webhook message. Deleted tags are ignored.
+    The repository is the service and the ref is the branch.
+
+    """
+
+    if payload.get('ref_type') != 'branch':
+        return {'deleted_branch_ids': []}
+
+    service_name = payload['repository']['name']
+    branch_name = payload['ref']
+
+    cursor = get_cursor()
+    cursor.execute(
+        ("update branch\n"
+         "   set deleted_dt = now()\n"
+         "  from service\n"
+         " where service.service_id = branch.service_id\n"
+         "   and service_name = %s\n"
+         "   and branch_name = %s\n"
+         "   and deleted_dt = 'infinity'\n"
+         "returning branch_id"),
+        (service_name, branch_name),
+    )
+    branch_ids = [row[0] for row in cursor.fetchall()]
+    cursor.close()
+
+    # legacy releases of the branch run under the same names, so tear down
+    # even when there was no herd 2.x branch
+    backend('gce').teardown(
+        service_name.replace('_', '-'),
+        branch_name.replace('_', '-'),
+    )
+
+    return {'deleted_branch_ids': branch_ids}
@@ -0,0 +1,53 @@
+"""
+Rebuild the herd 2.x branch heads from the release history
+
+A trigger on release keeps `branch_head` up to date as releases are saved,
+so this is only needed if the table is lost or releases are changed behind
+the trigger's back, by deleting them say. The rebuild takes the table's
+lock, so builds wait for it rather than advancing heads it is replacing.
+
+    python3 service/m2/heads.py
+
+"""
+
+import argparse
+import os
+import sys
+
+if __name__ == '__main__':
+    sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(
+        __file__))))
+
+from db import m2_get_cursor as get_cursor
+
+
+def rebuild():
+    """ replace every branch head with one found from history """
+    cursor = get_cursor()
+    cursor.execute("lock table branch_head in exclusive mode")
+    cursor.execute("delete from branch_head")
+    cursor.execute(
+        ("insert into branch_head\n"
+         "select distinct on (i.branch_id)\n"
+         "       i.branch_id, r.iteration_id, r.config_id, r.release_id,\n"
+         "       i.created_dt, r.created_dt\n"
+         "  from release r\n"
+         "  join iteration i on i.iteration_id = r.iteration_id\n"
+         " order by i.branch_id, i.created_dt desc, r.created_dt desc,\n"
+         "          r.release_id desc"),
+    )
+    heads = cursor.rowcount
+    cursor.close()
+    cursor.connection.close()
+    return heads
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.parse_args(argv)
+    print("rebuilt {} branch heads".format(rebuild()))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,346 @@
+"""
+Import release history into the herd 2.x model in bulk
+
+Each record is a release of a build: service_name, branch_name,
+merge_base_commit_hash, commit_hash, image_name, and optionally
+key_value_pairs (KEY=value lines, or a JSON object in NDJSON) and the
+release's created_dt. Records come from a CSV file with a header row, an
+NDJSON file (such as m2/export.py writes, plus configs) or straight from
+the legacy model's database.
+
+Records are COPYed into the import_release staging table `import_chunk_rows`
+at a time, and each chunk is merged into service, branch, config, iteration
+and release with set based inserts that keep the tables' uniqueness rules.
+Releases are inserted in record order, so release versioning counts up as
+it would have. The chunk's merge and the import's progress commit together,
+so an interrupted import picks up after its last merged chunk when it is run
+again with the same name. Releases that were already imported with the same
+created_dt are not imported again, and a record without a created_dt (every
+legacy record) is not imported for an iteration and config that already
+have a release.
+
+    python3 service/m2/import_history.py history.ndjson
+    python3 service/m2/import_history.py history.csv --name backfill-1
+    python3 service/m2/import_history.py --legacy
+
+"""
+
+import argparse
+import csv
+import io
+import json
+import os
+import sys
+import time
+
+if __name__ == '__main__':
+    sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(
+        __file__))))
+
+from settings import cfg
+
+from db import get_cursor as legacy_get_cursor
+from db import m2_get_cursor as get_cursor
+
+chunk_rows = int(cfg('import_chunk_rows', '10000'))
+
+
+def config_pairs(key_value_pairs):
+    """ return a config as a dict, from KEY=value lines or a dict """
+    if key_value_pairs is None:
+        return {}
+    if isinstance(key_value_pairs, dict):
+        return key_value_pairs
+    pairs = {}
+    for line in [l for l in key_value_pairs.strip().split('\n') if l]:
+        key, value = line.split('=', 1)
+        pairs[key] = value
+    return pairs
+
+
+def hstore_text(pairs):
+    """ return a dict in hstore's text format """
+    def quote(text):
+        return '"{}"'.format(
+            str(text).replace('\\', '\\\\').replace('"', '\\"'))
+    return ', '.join(
+        "{}=>{}".format(quote(k), quote(v)) for k, v in sorted(pairs.items()))
+
+
+def staged_row(import_name, line_no, record):
+    """ return a record as a row of the import_release table """
+    return [
+        import_name,
+        line_no,
+        record['service_name'],
+        record['branch_name'],
+        record.get('merge_base_commit_hash') or '',
+        record['commit_hash'],
+        record['image_name'],
+        hstore_text(config_pairs(record.get('key_value_pairs'))),
+        record.get('created_dt') or None,
+    ]
+
+
+def read_ndjson(lines):
+    for line in lines:
+        if line.strip():
+            yield json.loads(line)
+
+
+def read_csv(lines):
+    for row in csv.DictReader(lines):
+        yield row
+
+
+def read_legacy(size=None):
+    """ yield every legacy release with an image as an import record """
+    if size is None:
+        size = chunk_rows
+    cursor = legacy_get_cursor(name="legacy_history")
+    try:
+        cursor.itersize = size
+        # the legacy model has no merge base, or release times
+        cursor.execute(
+            ("SELECT service_name\n"
+             "      ,branch_name\n"
+             "      ,commit_hash\n"
+             "      ,image_name\n"
+             "      ,key_value_pairs\n"
+             "  FROM release r\n"
+             "  JOIN iteration i\n"
+             "    ON i.iteration_id = r.iteration_id\n"
+             "  JOIN deployment_pipeline d\n"
+             "    ON d.deployment_pipeline_id = r.deployment_pipeline_id\n"
+             "  JOIN config c\n"
+             "    ON c.config_id = d.config_id\n"
+             "  JOIN branch b\n"
+             "    ON b.branch_id = i.branch_id\n"
+             "  JOIN feature f\n"
+             "    ON f.feature_id = b.feature_id\n"
+             "  JOIN service s\n"
+             "    ON s.service_id = f.service_id\n"
+             " WHERE image_name IS NOT NULL\n"
+             " ORDER BY release_id"),
+        )
+        while True:
+            rows = cursor.fetchmany(size)
+            if not rows:
+                break
+            for row in rows:
+                yield dict(zip(
+                    ['service_name', 'branch_name', 'commit_hash',
+                     'image_name', 'key_value_pairs'],
+                    row,
+                ))
+    finally:
+        connection = cursor.connection
+        if not cursor.closed:
+            cursor.close()
+        connection.close()
+
+
+merge_statements = [
+    ("insert into service (service_name)\n"
+     "select distinct service_name\n"
+     "  from import_release\n"
+     " where import_name = %(import_name)s\n"
+     "on conflict (service_name) do nothing"),
+
+    ("insert into branch (branch_name, merge_base_commit_hash, service_id)\n"
+     "select distinct on (i.branch_name, i.merge_base_commit_hash)\n"
+     "       i.branch_name, i.merge_base_commit_hash, s.service_id\n"
+     "  from import_release i\n"
+     "  join service s on s.service_name = i.service_name\n"
+     " where import_name = %(import_name)s\n"
+     " order by i.branch_name, i.merge_base_commit_hash, i.line_no\n"
+     "on conflict (branch_name, merge_base_commit_hash, deleted_dt)\n"
+     "do nothing"),
+
+    ("insert into config (key_value_pairs)\n"
+     "select distinct key_value_pairs\n"
+     "  from import_release\n"
+     " where import_name = %(import_name)s\n"
+     "on conflict (key_value_pairs) do nothing"),
+
+    ("insert into iteration (commit_hash, branch_id, image_name)\n"
+     "select distinct on (b.branch_id, i.commit_hash)\n"
+     "       i.commit_hash, b.branch_id, i.image_name\n"
+     "  from import_release i\n"
+     "  join branch b\n"
+     "    on b.branch_name = i.branch_name\n"
+     "   and b.merge_base_commit_hash = i.merge_base_commit_hash\n"
+     "   and b.deleted_dt = 'infinity'\n"
+     " where import_name = %(import_name)s\n"
+     " order by b.branch_id, i.commit_hash, i.line_no\n"
+     "on conflict (branch_id, commit_hash) do nothing"),
+
+    # in record order, so the versioning trigger counts up as it would have.
+    # Undated records can't be told apart by time, so one of them is
+    # imported per iteration and config, and only when it has no release yet.
+    ("insert into release (iteration_id, config_id, created_dt)\n"
+     "select n.iteration_id, n.config_id, coalesce(n.created_dt, now())\n"
+     "  from (select it.iteration_id, c.config_id, i.created_dt, i.line_no\n"
+     "              ,i.created_dt is null undated\n"
+     "              ,row_number() over (\n"
+     "                   partition by it.iteration_id, c.config_id,\n"
+     "                                i.created_dt is null\n"
+     "                   order by i.line_no) nth\n"
+     "          from import_release i\n"
+     "          join branch b\n"
+     "            on b.branch_name = i.branch_name\n"
+     "           and b.merge_base_commit_hash = i.merge_base_commit_hash\n"
+     "           and b.deleted_dt = 'infinity'\n"
+     "          join iteration it\n"
+     "            on it.branch_id = b.branch_id\n"
+     "           and it.commit_hash = i.commit_hash\n"
+     "          join config c on c.key_value_pairs = i.key_value_pairs\n"
+     "         where import_name = %(import_name)s) n\n"
+     " where (not n.undated or n.nth = 1)\n"
+     "   and not exists (select 1\n"
+     "                     from release r\n"
+     "                    where r.iteration_id = n.iteration_id\n"
+     "                      and r.config_id = n.config_id\n"
+     "                      and (n.undated or r.created_dt = n.created_dt))\n"
+     " order by n.line_no"),
+
+    ("delete from import_release where import_name = %(import_name)s"),
+
+    ("update import_progress\n"
+     "   set lines_merged = %(lines_merged)s\n"
+     " where import_name = %(import_name)s"),
+]
+
+
+def merge_chunk(import_name, rows):
+    """ copy rows into staging and merge them, all in one transaction """
+    buffer = io.StringIO()
+    csv.writer(buffer, quoting=csv.QUOTE_ALL).writerows(rows)
+    buffer.seek(0)
+
+    cursor = get_cursor()
+    connection = cursor.connection
+    try:
+        cursor.copy_expert(
+            ("copy import_release (import_name, line_no, service_name,\n"
+             "                     branch_name, merge_base_commit_hash,\n"
+             "                     commit_hash, image_name, key_value_pairs,\n"
+             "                     created_dt)\n"
+             "from stdin with (format csv, force_null (created_dt))"),
+            buffer,
+        )
+        values = {'import_name': import_name, 'lines_merged': rows[-1][1]}
+        for sql in merge_statements:
+            cursor.execute(sql, values)
+        cursor.close()
+    finally:
+        # closing without a commit rolls the chunk back
+        connection.close()
+
+
+def progress(import_name):
+    """ return (lines merged, finished) for an import, starting it if new """
+    cursor = get_cursor()
+    cursor.execute(
+        ("insert into import_progress (import_name)\n"
+         "     values (%s)\n"
+         "on conflict (import_name) do update\n"
+         "        set import_name = import_progress.import_name\n"
+         "  returning lines_merged, finished_dt is not null"),
+        (import_name,),
+    )
+    lines_merged, finished = cursor.fetchone()
+    cursor.close()
+    cursor.connection.close()
+    return lines_merged, finished
+
+
+def finish(import_name):
+    cursor = get_cursor()
+    cursor.execute(
+        ("update import_progress\n"
+         "   set finished_dt = now()\n"
+         " where import_name = %s"),
+        (import_name,),
+    )
+    cursor.close()
+    cursor.connection.close()
+
+
+def import_history(import_name, records, size=None, report=None):
+    """
+    import the records under a name, resuming where it got to before
+
+    Returns the number of lines merged by this run.
+
+    """
+
+    if size is None:
+        size = chunk_rows
+    if report is None:
+        report = sys.stderr
+
+    lines_merged, finished = progress(import_name)
+    if finished:
+        print("import {} already finished".format(import_name), file=report)
+        return 0
+    if lines_merged:
+        print("resuming import {} after line {}".format(
+            import_name, lines_merged), file=report)
+
+    started = time.perf_counter()
+    merged = 0
+    chunk = []
+    for line_no, record in enumerate(records, start=1):
+        if line_no <= lines_merged:
+            continue
+        chunk.append(staged_row(import_name, line_no, record))
+        if len(chunk) >= size:
+            merge_chunk(import_name, chunk)
+            merged += len(chunk)
+            chunk = []
+            elapsed = time.perf_counter() - started
+            print("import {}: {} lines, {:.0f} lines/sec".format(
+                import_name, lines_merged + merged, merged / elapsed),
+                file=report)
+    if chunk:
+        merge_chunk(import_name, chunk)
+        merged += len(chunk)
+
+    finish(import_name)
+    elapsed = time.perf_counter() - started
+    print("import {} finished: {} lines in {:.1f}s, {:.0f} lines/sec".format(
+        import_name, lines_merged + merged, elapsed,
+        merged / elapsed if elapsed else 0), file=report)
+    return merged
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument("path", nargs="?",
+                        help="a .csv or .ndjson file of records")
+    parser.add_argument("--legacy", action="store_true",
+                        help="import from the legacy model's database")
+    parser.add_argument("--name",
+                        help="the import's name, to resume it by "
+                             "(default the file's name, or legacy)")
+    parser.add_argument("--chunk-rows", type=int, default=chunk_rows)
+    args = parser.parse_args(argv)
+
+    if args.legacy == bool(args.path):
+        parser.error("give a file to import, or --legacy")
+
+    if args.legacy:
+        name = args.name or "legacy"
+        import_history(name, read_legacy(args.chunk_rows), args.chunk_rows)
+        return 0
+
+    name = args.name or os.path.basename(args.path)
+    read = read_csv if args.path.endswith('.csv') else read_ndjson
+    with open(args.path, newline='') as lines:
+        import_history(name, read(lines), args.chunk_rows)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,230 @@
+"""
+Archive and detach old months of the herd 2.x release history
+
+release is partitioned by month of created_dt. `retire` archives every
+month partition that ended more than `retention_days` ago to a gzipped CSV
+file in `retention_archive_dir`, then detaches and drops it. The release
+each live branch's head points at is put back, into the default partition,
+so current configs and the branch heads survive; a branch cut from a
+retired commit takes its config from the head of the branch that commit
+was built on. A partition is copied to its archive while still attached,
+then detached and dropped in a short transaction, and its archive file
+only gets its final name once that commits.
+
+`ensure_partitions` creates the partitions for this month and the next
+`partition_months_ahead`, so new releases never land in the default
+partition; any that did are moved into their month's partition when it is
+made. __main__ ensures partitions at startup and every `partition_interval`
+seconds (a day), and retires partitions every `retention_interval` seconds
+when that is set. Both can also be run by hand:
+
+    python3 service/m2/retention.py [--dry-run]
+
+"""
+
+import argparse
+import datetime
+import gzip
+import os
+import re
+import sys
+import threading
+
+if __name__ == '__main__':
+    sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(
+        __file__))))
+
+from settings import cfg
+
+from db import m2_get_cursor as get_cursor
+from metrics import Counter
+
+archived = Counter(
+    "herd_release_rows_archived_total",
+    "Release rows archived and detached by the retention job",
+)
+
+# the names create_release_partition gives month partitions
+partition_name_pattern = re.compile('^release_y([0-9]{4})m([0-9]{2})$')
+
+
+def month_partition_ends():
+    """ return {partition name: the month after it} for every month """
+    cursor = get_cursor()
+    cursor.execute(
+        ("select c.relname\n"
+         "  from pg_inherits i\n"
+         "  join pg_class c on c.oid = i.inhrelid\n"
+         " where i.inhparent = 'release'::regclass"),
+    )
+    names = [row[0] for row in cursor.fetchall()]
+    cursor.close()
+    cursor.connection.close()
+
+    ends = {}
+    for name in names:
+        match = partition_name_pattern.match(name)
+        if match:
+            year, month = int(match.group(1)), int(match.group(2))
+            ends[name] = datetime.datetime(
+                year + month // 12, month % 12 + 1, 1)
+    return ends
+
+
+def expired_partitions(ends, horizon, now=None):
+    """ return the names of partitions that ended before the horizon """
+    if now is None:
+        now = datetime.datetime.utcnow()
+    return sorted(name for name, end in ends.items() if end <= now - horizon)
+
+
+def ensure_partitions(months_ahead=None):
+    """ create the month partitions up to months_ahead from now """
+    if months_ahead is None:
+        months_ahead = int(cfg('partition_months_ahead', '3'))
+    cursor = get_cursor()
+    cursor.execute(
+        ("select create_release_partition(month)\n"
+         "  from generate_series(date_trunc('month', now()::timestamp),\n"
+         "                       now()::timestamp + %s * interval '1 month',\n"
+         "                       interval '1 month') month"),
+        (months_ahead,),
+    )
+    names = [row[0] for row in cursor.fetchall()]
+    cursor.close()
+    cursor.connection.close()
+    return names
+
+
+def archive_partition(name, archive_dir):
+    """
+    archive a month partition to a file, then detach and drop it
+
+    Returns (rows archived, rows kept).
+
+    """
+
+    assert partition_name_pattern.match(name)
+    path = os.path.join(archive_dir, "{}.csv.gz".format(name))
+    partial = path + ".partial"
+
+    cursor = get_cursor()
+    connection = cursor.connection
+    try:
+        # archive while the month is still attached, so builds aren't held
+        # up behind the file being written. The count and the copy see one
+        # snapshot.
+        cursor.execute("set transaction isolation level repeatable read")
+        cursor.execute("select count(*) from {}".format(name))
+        rows = cursor.fetchone()[0]
+        with gzip.open(partial, 'wt') as archive:
+            cursor.copy_expert(
+                "copy {} to stdout with (format csv, header)".format(name),
+                archive,
+            )
+        connection.commit()
+
+        # then detach and drop it in a short transaction. Not detached
+        # concurrently, which a table with a default partition doesn't allow.
+        cursor.execute("alter table release detach partition {}".format(name))
+        cursor.execute("select count(*) from {}".format(name))
+        if cursor.fetchone()[0] != rows:
+            raise RuntimeError(
+                "{} changed while it was archived".format(name))
+        cursor.execute(
+            ("insert into release\n"
+             "select p.*\n"
+             "  from {} p\n"
+             "  join branch_head h on h.release_id = p.release_id\n"
+             "  join branch b on b.branch_id = h.branch_id\n"
+             " where b.deleted_dt = 'infinity'").format(name),
+        )
+        kept = cursor.rowcount
+        cursor.execute("drop table {}".format(name))
+        cursor.close()
+        os.replace(partial, path)
+    finally:
+        connection.close()
+        if os.path.exists(partial):
+            os.remove(partial)
+
+    archived.inc(rows - kept)
+    return rows, kept
+
+
+def retire(dry_run=False, horizon_days=None, archive_dir=None, now=None):
+    """
+    archive every month partition past the horizon
+
+    Returns the names of the partitions retired, or on a dry run the names
+    that would be.
+
+    """
+
+    if horizon_days is None:
+        horizon_days = float(cfg('retention_days', '365'))
+    if archive_dir is None:
+        archive_dir = cfg('retention_archive_dir', '/var/lib/herd/archive')
+
+    expired = expired_partitions(
+        month_partition_ends(),
+        datetime.timedelta(days=horizon_days),
+        now,
+    )
+    if dry_run:
+        print("retention would archive {}".format(expired))
+        return expired
+
+    os.makedirs(archive_dir, exist_ok=True)
+    for name in expired:
+        rows, kept = archive_partition(name, archive_dir)
+        print("retention archived {} rows of {}, kept {} branch heads".format(
+            rows, name, kept))
+    return expired
+
+
+def run_periodically(interval):
+    """ retire old partitions every interval seconds """
+    stop = threading.Event()
+
+    def loop():
+        while not stop.wait(interval):
+            try:
+                retire()
+            except Exception as e:
+                print("Error retiring releases, {}".format(e))
+
+    threading.Thread(target=loop, name="retention", daemon=True).start()
+    return stop
+
+
+def ensure_partitions_periodically(interval):
+    """ make partitions now, then every interval seconds """
+    stop = threading.Event()
+
+    def loop():
+        while True:
+            try:
+                ensure_partitions()
+            except Exception as e:
+                print("Error making release partitions, {}".format(e))
+            if stop.wait(interval):
+                break
+
+    threading.Thread(target=loop, name="partitions", daemon=True).start()
+    return stop
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument("--dry-run", action="store_true",
+                        help="report the partitions to archive and stop")
+    args = parser.parse_args(argv)
+    if not args.dry_run:
+        ensure_partitions()
+    retire(dry_run=args.dry_run)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
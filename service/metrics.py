@@ -0,0 +1,189 @@
+"""
+In process metrics, served in the prometheus text format
+
+Counters, gauges and histograms are kept in memory and rendered on scrape,
+so serving /metrics needs nothing outside this process. Every metric is
+registered on the module's registry when it is created.
+
+>>> requests = Counter("herd_things_total", "Things done", ["kind"])
+>>> requests.inc(kind="good")
+>>> latency = Histogram("herd_thing_seconds", "Time doing things", ["kind"])
+>>> with latency.time(kind="good"):
+...     do_thing()
+
+"""
+
+import threading
+import time
+
+from contextlib import contextmanager
+
+# upper bounds, in seconds, of the default histogram buckets
+default_buckets = (
+    0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0,
+    10.0, 30.0, 60.0,
+)
+
+
+def escape(value):
+    """ escape a label value for the text format """
+    return str(value).replace('\\', r'\\').replace('"', r'\"') \
+                     .replace('\n', r'\n')
+
+
+def label_text(names, values, extra=""):
+    """ return {a="x",b="y"} for the label names and values """
+    pairs = ['{}="{}"'.format(n, escape(v)) for n, v in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    if not pairs:
+        return ""
+    return "{" + ",".join(pairs) + "}"
+
+
+def number(value):
+    """ format a sample value """
+    if value == float('inf'):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Registry(object):
+    """ the metrics rendered on scrape """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.metrics = []
+
+    def register(self, metric):
+        with self.lock:
+            self.metrics.append(metric)
+        return metric
+
+    def render(self):
+        with self.lock:
+            metrics = list(self.metrics)
+        lines = []
+        for metric in metrics:
+            lines.append("# HELP {} {}".format(metric.name, metric.help))
+            lines.append("# TYPE {} {}".format(metric.name, metric.kind))
+            lines.extend(metric.samples())
+        return "\n".join(lines) + "\n"
+
+
+registry = Registry()
+
+
+class Metric(object):
+    """ a named metric with a value per combination of label values """
+
+    kind = "untyped"
+
+    def __init__(self, name, help, labels=(), registry=registry):
+        self.name = name
+        self.help = help
+        self.label_names = tuple(labels)
+        self.lock = threading.Lock()
+        self.values = {}
+        if not self.label_names:
+            # unlabelled metrics are scraped as zero before first use
+            self.values[()] = self.zero()
+        if registry is not None:
+            registry.register(self)
+
+    def zero(self):
+        return 0
+
+    def key(self, labels):
+        if set(labels) != set(self.label_names):
+            raise ValueError("{} expects labels {}, got {}".format(
+                self.name, self.label_names, tuple(labels)))
+        return tuple(labels[n] for n in self.label_names)
+
+    def samples(self):
+        with self.lock:
+            values = sorted(self.values.items())
+        return ["{}{} {}".format(self.name,
+                                 label_text(self.label_names, key),
+                                 number(value))
+                for key, value in values]
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = self.key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    kind = "gauge"
+
+    def set(self, value, **labels):
+        key = self.key(labels)
+        with self.lock:
+            self.values[key] = value
+
+    def inc(self, amount=1, **labels):
+        key = self.key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name, help, labels=(), buckets=default_buckets,
+                 registry=registry):
+        self.buckets = tuple(sorted(buckets)) + (float('inf'),)
+        super().__init__(name, help, labels, registry)
+
+    def zero(self):
+        # a count per bucket, then the sum
+        return [0] * len(self.buckets) + [0.0]
+
+    def observe(self, value, **labels):
+        key = self.key(labels)
+        with self.lock:
+            counts = self.values.get(key)
+            if counts is None:
+                counts = self.values[key] = self.zero()
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+                    break
+            counts[-1] += value
+
+    @contextmanager
+    def time(self, **labels):
+        """ observe the time spent in the with block """
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, **labels)
+
+    def samples(self):
+        with self.lock:
+            values = sorted((k, list(v)) for k, v in self.values.items())
+        lines = []
+        for key, counts in values:
+            cumulative = 0
+            for bound, count in zip(self.buckets, counts):
+                cumulative += count
+                lines.append("{}_bucket{} {}".format(
+                    self.name,
+                    label_text(self.label_names, key,
+                               'le="{}"'.format(number(bound))),
+                    cumulative,
+                ))
+            labels = label_text(self.label_names, key)
+            lines.append("{}_sum{} {}".format(self.name, labels,
+                                              number(counts[-1])))
+            lines.append("{}_count{} {}".format(self.name, labels, cumulative))
+        return lines
@@ -0,0 +1,290 @@
+"""
+Deploy progress of herd 2.x releases, pushed as server-sent events
+
+Deploys record each stage they reach in the release_status table with
+`record`, which notifies the release_status channel in the same
+transaction. Each process has one listener on that channel, started with
+the first subscriber, and a `Broker` fans its notifications out to every
+subscriber in the process. Watching a deploy costs one query for the
+current stage, not a poll per subscriber, and works whichever process or
+replica is deploying. When the listener reconnects it publishes the
+current stage of every watched release, as notifications sent in between
+are lost.
+
+`events` yields a release's stages in the text/event-stream format until
+it reaches a final stage, with a comment every `sse_keepalive_seconds` so
+proxies keep the connection open, for at most `sse_max_seconds`.
+
+A stream holds the thread serving it for as long as it is open, so each
+process serves at most `sse_max_streams` at once, and `stream_slot` turns
+the rest away. By default that is none under wsgiref, whose one thread
+would stop the whole api for a stream, half of the async server's stream
+threads, and a quarter of the threads in the other server modes, leaving
+the rest for ordinary requests. Watching deploys needs a server_mode other
+than wsgiref.
+
+"""
+
+import json
+import queue
+import select
+import threading
+import time
+
+from contextlib import contextmanager
+
+from settings import cfg
+
+from db import m2_get_cursor
+from metrics import (
+    Counter,
+    Gauge,
+)
+
+# the stages of deployment.gce.update, in order
+stages = [
+    "rendered",
+    "service_applied",
+    "secret_applied",
+    "old_repcons_scaled",
+    "repcon_applied",
+    "repcon_ready",
+]
+final_stages = {"repcon_ready", "repcon_not_ready", "failed"}
+
+channel = "release_status"
+
+streams_open = Gauge(
+    "herd_sse_streams_open",
+    "Release event streams being served by this process",
+)
+streams_refused = Counter(
+    "herd_sse_streams_refused_total",
+    "Release event streams turned away at sse_max_streams",
+)
+
+
+class Broker(object):
+    """ fan events for a release out to its subscribers in this process """
+
+    def __init__(self, maxsize=100):
+        self.maxsize = maxsize
+        self.lock = threading.Lock()
+        self.subscribers = {}
+
+    def subscribe(self, release_id):
+        """ return a queue that gets the release's events """
+        events = queue.Queue(self.maxsize)
+        with self.lock:
+            self.subscribers.setdefault(release_id, set()).add(events)
+        return events
+
+    def unsubscribe(self, release_id, events):
+        with self.lock:
+            subscribers = self.subscribers.get(release_id, set())
+            subscribers.discard(events)
+            if not subscribers:
+                self.subscribers.pop(release_id, None)
+
+    def watched(self):
+        """ return the releases with subscribers """
+        with self.lock:
+            return list(self.subscribers)
+
+    def publish(self, release_id, event):
+        with self.lock:
+            subscribers = list(self.subscribers.get(release_id, ()))
+        for events in subscribers:
+            try:
+                events.put_nowait(event)
+            except queue.Full:
+                # a subscriber this far behind has gone away
+                pass
+
+
+broker = Broker()
+
+
+def record(cursor, release_id, stage, detail=None):
+    """ save the stage a release's deploy reached and notify listeners """
+    cursor.execute(
+        ("with status as (\n"
+         "     insert into release_status (release_id, stage, detail)\n"
+         "          values (%s, %s, %s)\n"
+         "     on conflict (release_id) do update\n"
+         "             set stage = excluded.stage\n"
+         "               , detail = excluded.detail\n"
+         "               , updated_dt = now()\n"
+         "       returning release_id, stage, detail, updated_dt\n"
+         ")\n"
+         "select pg_notify(%s, json_build_object(\n"
+         "           'release_id', release_id,\n"
+         "           'stage', stage,\n"
+         "           'detail', detail,\n"
+         "           'updated_dt', updated_dt)::text)\n"
+         "  from status"),
+        (release_id, stage, detail, channel),
+    )
+
+
+def current(release_id):
+    """ return the release's last recorded stage as an event, or None """
+    cursor = m2_get_cursor()
+    cursor.execute(
+        ("select json_build_object(\n"
+         "           'release_id', release_id,\n"
+         "           'stage', stage,\n"
+         "           'detail', detail,\n"
+         "           'updated_dt', updated_dt)\n"
+         "  from release_status\n"
+         " where release_id = %s"),
+        (release_id,),
+    )
+    row = cursor.fetchone()
+    cursor.close()
+    cursor.connection.close()
+    return row[0] if row else None
+
+
+def catch_up():
+    """ publish the current stage of every release with subscribers """
+    for release_id in broker.watched():
+        event = current(release_id)
+        if event is not None:
+            broker.publish(release_id, event)
+
+
+def listen(ready, stop):
+    """ publish the channel's notifications to the broker until stopped """
+    while not stop.is_set():
+        connection = None
+        try:
+            cursor = m2_get_cursor()
+            connection = cursor.connection
+            connection.autocommit = True
+            cursor.execute("listen {}".format(channel))
+            ready.set()
+            # nothing is heard between connections, so streams open across
+            # a reconnect would wait for stages already recorded
+            catch_up()
+            while not stop.is_set():
+                if select.select([connection], [], [], 1) == ([], [], []):
+                    continue
+                connection.poll()
+                while connection.notifies:
+                    event = json.loads(connection.notifies.pop(0).payload)
+                    broker.publish(event['release_id'], event)
+        except Exception as e:
+            print("Error listening for release status, {}".format(e))
+            time.sleep(1)
+        finally:
+            if connection is not None:
+                connection.close()
+
+
+listener = None
+listener_lock = threading.Lock()
+
+
+def ensure_listening(timeout=5):
+    """ start this process's listener if it is not running yet """
+    global listener
+    with listener_lock:
+        if listener is None:
+            ready = threading.Event()
+            stop = threading.Event()
+            threading.Thread(target=listen, args=(ready, stop),
+                             name="release-status", daemon=True).start()
+            listener = (ready, stop)
+    listener[0].wait(timeout)
+
+
+def stop_listening():
+    global listener
+    with listener_lock:
+        if listener is not None:
+            listener[1].set()
+            listener = None
+
+
+class TooManyStreams(Exception):
+    """ the process is serving as many event streams as it may """
+
+
+def max_streams():
+    """ return how many event streams this process may serve at once """
+    configured = cfg('sse_max_streams')
+    if configured is not None:
+        return int(configured)
+    mode = cfg('server_mode', 'wsgiref')
+    if mode == 'wsgiref':
+        return 0
+    if mode == 'async':
+        # leaving the stream pool room for exports
+        return int(cfg('async_stream_workers', '8')) // 2
+    return int(cfg('server_workers', '8')) // 4
+
+
+streams_lock = threading.Lock()
+streams = 0
+
+
+@contextmanager
+def stream_slot():
+    """ hold one of the process's event streams, or raise TooManyStreams """
+    global streams
+    with streams_lock:
+        limit = max_streams()
+        if streams >= limit:
+            streams_refused.inc()
+            raise TooManyStreams(
+                "already serving {} event streams".format(limit))
+        streams += 1
+    streams_open.inc()
+    try:
+        yield
+    finally:
+        with streams_lock:
+            streams -= 1
+        streams_open.dec()
+
+
+def sse(event):
+    """ return an event in the text/event-stream format """
+    return "event: {}\ndata: {}\n\n".format(
+        event['stage'], json.dumps(event, sort_keys=True)).encode()
+
+
+def events(release_id, keepalive=None, max_seconds=None):
+    """ yield the release's stages as server-sent events until it's done """
+    if keepalive is None:
+        keepalive = float(cfg('sse_keepalive_seconds', '15'))
+    if max_seconds is None:
+        max_seconds = float(cfg('sse_max_seconds', '600'))
+
+    ensure_listening()
+    # subscribe before reading the current stage, so nothing falls between
+    subscription = broker.subscribe(release_id)
+    try:
+        event = current(release_id)
+        if event is not None:
+            yield sse(event)
+            if event['stage'] in final_stages:
+                return
+        deadline = time.monotonic() + max_seconds
+        while time.monotonic() < deadline:
+            try:
+                latest = subscription.get(timeout=min(
+                    keepalive, max(0, deadline - time.monotonic())))
+            except queue.Empty:
+                yield b": keepalive\n\n"
+                continue
+            # a listener catching up sends stages again
+            if latest == event:
+                continue
+            event = latest
+            yield sse(event)
+            if event['stage'] in final_stages:
+                return
+    finally:
+        broker.unsubscribe(release_id, subscription)
@@ -0,0 +1,113 @@
+"""
+Cheap JSON responses for polling clients
+
+A handler wrapped with `cached_json` returns data to serialise as JSON. The
+response gets an ETag of the body, so a client sending it back in
+If-None-Match gets an empty 304 when nothing changed, and bodies over
+`gzip_min_bytes` are gzipped for clients that accept it. A gzipped body has
+its own ETag, the identity body's with a "-gzip" suffix, since the two are
+different bytes.
+
+Given a validator, a cheap function of the handler's arguments that changes
+whenever its result does, the ETag is made from the validator's result and
+the request's path and query instead, so a 304 costs the validator and not
+the handler.
+
+"""
+
+import gzip
+import hashlib
+import json
+
+from functools import wraps
+
+from bottle import (
+    HTTPResponse,
+    request,
+    response,
+)
+
+from settings import cfg
+
+gzip_min_bytes = int(cfg('gzip_min_bytes', '1024'))
+
+
+def etag(body):
+    """ return a strong ETag for a response body """
+    return '"{}"'.format(hashlib.sha256(body).hexdigest()[:32])
+
+
+def encoded(tag, coding):
+    """ return the ETag for a body encoded with coding """
+    return '{}-{}"'.format(tag[:-1], coding)
+
+
+def none_match(header, tag):
+    """ return True if an If-None-Match header matches the tag """
+    if header is None:
+        return False
+    tags = [t.strip() for t in header.split(',')]
+    # weak comparison, as If-None-Match calls for
+    return '*' in tags or tag in tags or 'W/' + tag in tags
+
+
+def accepts_gzip(header):
+    """ return True if an Accept-Encoding header allows gzip """
+    for coding in (header or '').split(','):
+        name, _, params = coding.strip().partition(';')
+        if name.strip() in ('gzip', '*'):
+            return params.replace(' ', '') not in ('q=0', 'q=0.0', 'q=0.00')
+    return False
+
+
+def not_modified(tag):
+    """ return an empty 304 response for an ETag """
+    return HTTPResponse(status=304, **{
+        'ETag': tag,
+        'Vary': 'Accept-Encoding',
+        'Cache-Control': 'no-cache',
+    })
+
+
+def cached_json(handler, validator=None):
+    """ serve the handler's result as JSON with an ETag and gzip """
+    @wraps(handler)
+    def cached_json_handler(*args, **kwargs):
+        if_none_match = request.headers.get('If-None-Match')
+
+        tag = None
+        if validator is not None:
+            tag = etag(json.dumps(
+                [validator(*args, **kwargs), request.path, request.query_string],
+                default=str,
+            ).encode())
+            # either encoding's tag shows the client has the current list
+            for candidate in (tag, encoded(tag, 'gzip')):
+                if none_match(if_none_match, candidate):
+                    return not_modified(candidate)
+
+        body = json.dumps(
+            handler(*args, **kwargs),
+            sort_keys=True,
+            separators=(',', ':'),
+        ).encode()
+        if tag is None:
+            tag = etag(body)
+        compress = len(body) >= gzip_min_bytes and \
+            accepts_gzip(request.headers.get('Accept-Encoding'))
+        if compress:
+            tag = encoded(tag, 'gzip')
+
+        if none_match(if_none_match, tag):
+            return not_modified(tag)
+
+        response.content_type = 'application/json'
+        response.set_header('ETag', tag)
+        response.set_header('Vary', 'Accept-Encoding')
+        response.set_header('Cache-Control', 'no-cache')
+        if compress:
+            body = gzip.compress(body, compresslevel=5)
+            response.set_header('Content-Encoding', 'gzip')
+        return body
+
+    return cached_json_handler
@@ -0,0 +1,246 @@
+"""
+Routes for the herd api, registered on bottle's default app
+
+"""
+
+import time
+
+import bottle
+
+from m2.handlers import (
+    build_fields,
+    handle_build,
+    handle_builds,
+    handle_delete,
+)
+
+from handlers import (
+    handle_branch_commit as leg_handle_branch_commit,
+    handle_build as leg_handle_build,
+)
+
+from idempotency import idempotent
+from m2.export import (
+    ndjson,
+    release_history,
+)
+from m2.getters import (
+    list_branches,
+    list_iterations,
+    list_releases,
+    list_services,
+)
+from release_status import (
+    events as release_events,
+    stream_slot,
+    TooManyStreams,
+)
+from responses import cached_json
+from security import (
+    github_signed,
+    restricted,
+)
+from settings import cfg
+
+import metrics
+import sqlstats
+
+request_latency = metrics.Histogram(
+    "herd_http_request_duration_seconds",
+    "HTTP request latency, by route",
+    ["route"],
+)
+requests_in_progress = metrics.Gauge(
+    "herd_http_requests_in_progress",
+    "HTTP requests being handled",
+)
+
+
+@bottle.hook('before_request')
+def begin_request_stats():
+    bottle.request.environ['herd.started'] = time.perf_counter()
+    requests_in_progress.inc()
+    sqlstats.begin_request()
+
+
+@bottle.hook('after_request')
+def log_request_stats():
+    requests_in_progress.dec()
+    route = bottle.request.environ.get('bottle.route')
+    started = bottle.request.environ.get('herd.started')
+    if started is not None:
+        request_latency.observe(
+            time.perf_counter() - started,
+            route=route.name if route is not None and route.name else "none",
+        )
+
+    stats = sqlstats.request_stats()
+    if stats is not None and stats.count:
+        print("{} {} ran {} sql statements in {:.1f}ms".format(
+            bottle.request.method,
+            bottle.request.path,
+            stats.count,
+            stats.seconds * 1000,
+        ))
+
+### v1 paths ###
+# regex   [^\/]+\/?                    [^\/]+     (\/?[^\/]+)?
+#         path followed by a slash     path       optional slash and path
+v1_build_path = "/v1/build/<service_name>/<branch_name>" + \
+                "/<merge_base_commit_hash>/<commit_hash>" + \
+                "/<image_name:re:[^\/]+\/?[^\/]+(\/?[^\/]+)?>"
+
+bottle.route(
+    v1_build_path,
+    ["GET"],
+    restricted(idempotent(handle_build)),
+    name="v1_build",
+)
+
+max_batch_builds = int(cfg('max_batch_builds', '100'))
+
+
+def handle_builds_request():
+    """ save and deploy the JSON array of builds in the request body """
+    builds = bottle.request.json
+    if not isinstance(builds, list):
+        bottle.abort(400, "expected a JSON array of builds")
+    if len(builds) > max_batch_builds:
+        bottle.abort(400, "at most {} builds per request".format(
+            max_batch_builds))
+    for build in builds:
+        if not isinstance(build, dict) or not all(
+                isinstance(build.get(field), str) for field in build_fields):
+            bottle.abort(400, "each build needs {}".format(
+                ", ".join(build_fields)))
+    return {'builds': handle_builds([
+        dict((field, build[field]) for field in build_fields)
+        for build in builds
+    ])}
+
+bottle.route(
+    "/v1/builds",
+    ["POST"],
+    restricted(handle_builds_request),
+    name="v1_builds",
+)
+
+def handle_github_delete():
+    """ handle github's delete webhook, other events are acknowledged """
+    event = bottle.request.headers.get('X-GitHub-Event')
+    if event != 'delete':
+        return {'ignored': event}
+    payload = bottle.request.json
+    if not isinstance(payload, dict) or 'ref' not in payload or \
+            not isinstance(payload.get('repository'), dict):
+        bottle.abort(400, "expected github's delete webhook message")
+    return handle_delete(payload)
+
+bottle.route(
+    "/v1/github/delete",
+    ["POST"],
+    github_signed(handle_github_delete),
+    name="v1_github_delete",
+)
+
+def page_of(lister):
+    """ return a handler serving a page of the lister's results """
+    def handle_page(**url_args):
+        try:
+            return lister(
+                *url_args.values(),
+                after=bottle.request.query.get('after') or None,
+                limit=bottle.request.query.get('limit') or 50
+            )
+        except ValueError as e:
+            bottle.abort(400, str(e))
+
+    def page_version(**url_args):
+        return lister.version(*url_args.values())
+    return restricted(cached_json(handle_page, validator=page_version))
+
+bottle.route("/v1/services", ["GET"], page_of(list_services),
+             name="v1_services")
+for resource, lister in [("branches", list_branches),
+                         ("iterations", list_iterations),
+                         ("releases", list_releases)]:
+    bottle.route(
+        "/v1/services/<service_name>/{}".format(resource),
+        ["GET"],
+        page_of(lister),
+        name="v1_service_{}".format(resource),
+    )
+
+def handle_export_releases():
+    """ stream the release history as newline delimited JSON """
+    try:
+        since = int(bottle.request.query.get('since') or 0)
+    except ValueError:
+        bottle.abort(400, "since should be a release id")
+    bottle.response.content_type = "application/x-ndjson"
+    return ndjson(release_history(since))
+
+bottle.route(
+    "/v1/export/releases",
+    ["GET"],
+    restricted(handle_export_releases),
+    name="v1_export_releases",
+)
+
+def handle_release_events(release_id):
+    """ push a release's deploy stages as server-sent events """
+    bottle.response.content_type = "text/event-stream"
+    bottle.response.set_header("Cache-Control", "no-cache")
+    # ask proxies not to hold events back in a buffer
+    bottle.response.set_header("X-Accel-Buffering", "no")
+
+    def stream():
+        # bottle sends what is raised before the first event as the response
+        try:
+            with stream_slot():
+                yield from release_events(release_id)
+        except TooManyStreams as e:
+            raise bottle.HTTPResponse(str(e), status=503, **{
+                'Retry-After': cfg('sse_retry_after_seconds', '10'),
+            })
+    return stream()
+
+bottle.route(
+    "/v1/releases/<release_id:int>/events",
+    ["GET"],
+    restricted(handle_release_events),
+    name="v1_release_events",
+)
+
+### legacy paths ###
+leg_commit_path = "/commit/<{}>/<{}>/<{}>/<{}>".format(
+    "repo_name",
+    "feature_name",
+    "branch_name",
+    "commit_hash",
+)
+
+# regex   [^\/]+\/?                    [^\/]+     (\/?[^\/]+)?
+#         path followed by a slash     path       optional slash and path
+leg_build_path = "/build/<commit_hash>/<image_name:re:[^\/]+\/?[^\/]+(\/?[^\/]+)?>"
+
+bottle.route(
+    leg_commit_path,
+    ["GET"],
+    restricted(leg_handle_branch_commit),
+    name="legacy_commit",
+)
+bottle.route(
+    leg_build_path,
+    ["GET"],
+    restricted(idempotent(leg_handle_build)),
+    name="legacy_build",
+)
+
+### operations ###
+def handle_metrics():
+    """ serve the process's metrics in the prometheus text format """
+    bottle.response.content_type = "text/plain; version=0.0.4"
+    return metrics.registry.render()
+
+bottle.route("/metrics", ["GET"], handle_metrics, name="metrics")
@@ -0,0 +1,17 @@
+-- herd 2.2.0, applied after schema-2.1.2.sql
+
+BEGIN;
+
+-- Table: webhook_response
+-- responses to webhooks, so a retried webhook gets the original response
+CREATE TABLE webhook_response (
+    request_key varchar(64)  NOT NULL,
+    response text  NOT NULL,
+    created_dt timestamp  NOT NULL DEFAULT now(),
+    expires_dt timestamp  NOT NULL,
+    CONSTRAINT webhook_response_pk PRIMARY KEY (request_key)
+);
+
+CREATE INDEX webhook_response_expires_dt ON webhook_response (expires_dt);
+
+COMMIT;
@@ -0,0 +1,11 @@
+-- herd 2.3.0, applied after schema-2.2.0.sql
+
+BEGIN;
+
+-- indexes for the api's lists, which page newest first by (created_dt, id)
+CREATE INDEX service_created_dt_id ON service (created_dt, service_id);
+CREATE INDEX branch_service_created_dt_id ON branch (service_id, created_dt, branch_id);
+CREATE INDEX iteration_created_dt_id ON iteration (created_dt, iteration_id);
+CREATE INDEX release_created_dt_id ON release (created_dt, release_id);
+
+COMMIT;
@@ -0,0 +1,33 @@
+-- herd 2.4.0, applied after schema-2.3.0.sql
+
+BEGIN;
+
+-- Table: import_release
+-- history being imported, copied in a chunk at a time then merged
+CREATE UNLOGGED TABLE import_release (
+    import_name varchar(100)  NOT NULL,
+    line_no bigint  NOT NULL,
+    service_name varchar(100)  NOT NULL,
+    branch_name varchar(100)  NOT NULL,
+    merge_base_commit_hash varchar(100)  NOT NULL,
+    commit_hash varchar(100)  NOT NULL,
+    image_name varchar(100)  NOT NULL,
+    key_value_pairs hstore  NOT NULL,
+    created_dt timestamp  NULL,
+    CONSTRAINT import_release_pk PRIMARY KEY (import_name, line_no)
+);
+
+-- Table: import_progress
+-- how far each import has got, so an interrupted import can resume
+CREATE TABLE import_progress (
+    import_name varchar(100)  NOT NULL,
+    lines_merged bigint  NOT NULL DEFAULT 0,
+    created_dt timestamp  NOT NULL DEFAULT now(),
+    finished_dt timestamp  NULL,
+    CONSTRAINT import_progress_pk PRIMARY KEY (import_name)
+);
+
+-- imports look for releases they already made
+CREATE INDEX release_iteration_id ON release (iteration_id);
+
+COMMIT;
@@ -0,0 +1,68 @@
+-- herd 2.5.0, applied after schema-2.4.0.sql
+
+BEGIN;
+
+-- Table: branch_head
+-- the latest release of each branch, kept up to date by a release trigger.
+-- The latest is the release of the newest iteration, then the newest
+-- release of that, as correct_qa_config has always chosen.
+CREATE TABLE branch_head (
+    branch_id int  NOT NULL,
+    iteration_id int  NOT NULL,
+    config_id int  NOT NULL,
+    release_id int  NOT NULL,
+    iteration_created_dt timestamp  NOT NULL,
+    release_created_dt timestamp  NOT NULL,
+    CONSTRAINT branch_head_pk PRIMARY KEY (branch_id)
+);
+
+ALTER TABLE branch_head ADD CONSTRAINT branch_head_branch
+    FOREIGN KEY (branch_id)
+    REFERENCES branch (branch_id)
+    NOT DEFERRABLE
+    INITIALLY IMMEDIATE
+;
+
+create or replace function advance_branch_head() returns trigger as $head$
+    begin
+        -- the row lock on conflict serialises releases of the same branch
+        insert into branch_head (branch_id, iteration_id, config_id,
+                                 release_id, iteration_created_dt,
+                                 release_created_dt)
+        select branch_id, iteration_id, NEW.config_id, NEW.release_id,
+               created_dt, NEW.created_dt
+          from iteration
+         where iteration_id = NEW.iteration_id
+        on conflict (branch_id) do update
+           set iteration_id = excluded.iteration_id
+             , config_id = excluded.config_id
+             , release_id = excluded.release_id
+             , iteration_created_dt = excluded.iteration_created_dt
+             , release_created_dt = excluded.release_created_dt
+         where (branch_head.iteration_created_dt,
+                branch_head.release_created_dt,
+                branch_head.release_id)
+            <= (excluded.iteration_created_dt,
+                excluded.release_created_dt,
+                excluded.release_id);
+        return NEW;
+    end;
+$head$ language plpgsql;
+
+create trigger release_branch_head_trig
+after insert or update of iteration_id, config_id, created_dt on release
+for each row execute procedure advance_branch_head();
+
+-- the heads of the history so far
+insert into branch_head
+select distinct on (i.branch_id)
+       i.branch_id, r.iteration_id, r.config_id, r.release_id,
+       i.created_dt, r.created_dt
+  from release r
+  join iteration i on i.iteration_id = r.iteration_id
+ order by i.branch_id, i.created_dt desc, r.created_dt desc, r.release_id desc;
+
+-- new branches take their config from their merge base's releases
+CREATE INDEX iteration_commit_hash ON iteration (commit_hash);
+
+COMMIT;
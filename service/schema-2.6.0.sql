@@ -0,0 +1,152 @@
+-- herd 2.6.0, applied after schema-2.5.0.sql
+
+BEGIN;
+
+-- release becomes range partitioned by month of created_dt, so old months
+-- can be archived and detached (see m2/retention.py). A partition's primary
+-- key has to include the partition key, so the primary key is now
+-- (release_id, created_dt) and release_id alone is no longer unique; only
+-- the sequence keeps ids apart. A foreign key to release has to name both.
+ALTER TABLE release RENAME TO release_2_5;
+ALTER INDEX release_pk RENAME TO release_2_5_pk;
+DROP INDEX release_created_dt_id;
+DROP INDEX release_iteration_id;
+
+-- Table: release
+CREATE TABLE release (
+    release_id int  NOT NULL DEFAULT nextval('release_release_id_seq'),
+    iteration_id int  NOT NULL,
+    config_id int  NOT NULL,
+    created_dt timestamp  NOT NULL DEFAULT now(),
+    service_version_seq int  NOT NULL DEFAULT 0,
+    branch_version_seq int  NOT NULL DEFAULT 0,
+    CONSTRAINT release_pk PRIMARY KEY (release_id, created_dt)
+) PARTITION BY RANGE (created_dt);
+
+-- rows no month partition takes, like releases kept past retention
+CREATE TABLE release_default PARTITION OF release DEFAULT;
+
+create or replace function create_release_partition(month timestamp)
+returns text as $partition$
+    declare
+        first timestamp := date_trunc('month', month);
+        name text := 'release_' || to_char(first, '"y"YYYY"m"MM');
+    begin
+        execute format(
+            'create table if not exists %I partition of release '
+            'for values from (%L) to (%L)',
+            name, first, first + interval '1 month');
+        return name;
+    end;
+$partition$ language plpgsql;
+
+select create_release_partition(month)
+  from generate_series(
+       date_trunc('month', coalesce((select min(created_dt)
+                                       from release_2_5), now()::timestamp)),
+       now()::timestamp + interval '3 months',
+       interval '1 month') month;
+
+-- before the triggers, so versions and heads are copied as they are
+insert into release (release_id, iteration_id, config_id, created_dt,
+                     service_version_seq, branch_version_seq)
+select release_id, iteration_id, config_id, created_dt,
+       service_version_seq, branch_version_seq
+  from release_2_5;
+
+ALTER SEQUENCE release_release_id_seq OWNED BY release.release_id;
+DROP TABLE release_2_5;
+
+ALTER TABLE release ADD CONSTRAINT release_config
+    FOREIGN KEY (config_id)
+    REFERENCES config (config_id)
+    NOT DEFERRABLE
+    INITIALLY IMMEDIATE
+;
+
+ALTER TABLE release ADD CONSTRAINT release_iteration
+    FOREIGN KEY (iteration_id)
+    REFERENCES iteration (iteration_id)
+    NOT DEFERRABLE
+    INITIALLY IMMEDIATE
+;
+
+CREATE INDEX release_created_dt_id ON release (created_dt, release_id);
+CREATE INDEX release_iteration_id ON release (iteration_id);
+
+-- releases put back by retention already have their versions
+create or replace function increment_version() returns trigger as $version$
+    declare
+        service_seq integer;
+        branch_seq integer;
+    begin
+        if NEW.service_version_seq <> 0 then
+            return NEW;
+        end if;
+
+        select coalesce(max(service_version_seq), 0)
+          from release
+          join iteration using (iteration_id)
+          join branch using (branch_id)
+          join service using (service_id)
+         where iteration_id = NEW.iteration_id
+         group by service_id
+          into service_seq;
+
+        select coalesce(max(branch_version_seq), 0)
+          from release
+          join iteration using (iteration_id)
+          join branch using (branch_id)
+         where iteration_id = NEW.iteration_id
+         group by branch_id
+          into branch_seq;
+
+        service_seq := service_seq + 1;
+        branch_seq := branch_seq + 1;
+
+        update release set service_version_seq = service_seq
+                         , branch_version_seq = branch_seq
+         where release_id = NEW.release_id
+           and created_dt = NEW.created_dt;
+        return NEW;
+    end;
+$version$ language plpgsql;
+
+-- a head follows its own release when that changes, as its created_dt does
+-- when it moves partition
+create or replace function advance_branch_head() returns trigger as $head$
+    begin
+        -- the row lock on conflict serialises releases of the same branch
+        insert into branch_head (branch_id, iteration_id, config_id,
+                                 release_id, iteration_created_dt,
+                                 release_created_dt)
+        select branch_id, iteration_id, NEW.config_id, NEW.release_id,
+               created_dt, NEW.created_dt
+          from iteration
+         where iteration_id = NEW.iteration_id
+        on conflict (branch_id) do update
+           set iteration_id = excluded.iteration_id
+             , config_id = excluded.config_id
+             , release_id = excluded.release_id
+             , iteration_created_dt = excluded.iteration_created_dt
+             , release_created_dt = excluded.release_created_dt
+         where branch_head.release_id = excluded.release_id
+            or (branch_head.iteration_created_dt,
+                branch_head.release_created_dt,
+                branch_head.release_id)
+            <= (excluded.iteration_created_dt,
+                excluded.release_created_dt,
+                excluded.release_id);
+        return NEW;
+    end;
+$head$ language plpgsql;
+
+create trigger release_version_increment_trig
+after insert on release
+for each row execute procedure increment_version();
+
+create trigger release_branch_head_trig
+after insert or update of iteration_id, config_id, created_dt on release
+for each row execute procedure advance_branch_head();
+
+COMMIT;
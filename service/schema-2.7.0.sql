@@ -0,0 +1,16 @@
+-- herd 2.7.0, applied after schema-2.6.0.sql
+
+BEGIN;
+
+-- Table: release_status
+-- the last deploy stage each release reached; each change is also sent
+-- on the release_status notification channel
+CREATE TABLE release_status (
+    release_id int  NOT NULL,
+    stage varchar(32)  NOT NULL,
+    detail text  NULL,
+    updated_dt timestamp  NOT NULL DEFAULT now(),
+    CONSTRAINT release_status_pk PRIMARY KEY (release_id)
+);
+
+COMMIT;
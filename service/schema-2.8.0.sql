@@ -0,0 +1,37 @@
+-- herd 2.8.0, applied after schema-2.7.0.sql
+
+BEGIN;
+
+-- a month's releases that landed in the default partition, because its
+-- partition wasn't made in time, move into the partition when it is.
+-- Otherwise attaching it fails, as the default partition would hold rows
+-- the new partition's range covers.
+create or replace function create_release_partition(month timestamp)
+returns text as $partition$
+    declare
+        first timestamp := date_trunc('month', month);
+        name text := 'release_' || to_char(first, '"y"YYYY"m"MM');
+    begin
+        -- one at a time, so a partition is only made once
+        perform pg_advisory_xact_lock(hashtext('create_release_partition'));
+        if to_regclass(name) is not null then
+            return name;
+        end if;
+        execute format(
+            'create table %I (like release including defaults)', name);
+        execute format(
+            'with moved as (delete from release_default'
+            '                where created_dt >= %L'
+            '                  and created_dt < %L'
+            '            returning *)'
+            'insert into %I select * from moved',
+            first, first + interval '1 month', name);
+        execute format(
+            'alter table release attach partition %I '
+            'for values from (%L) to (%L)',
+            name, first, first + interval '1 month');
+        return name;
+    end;
+$partition$ language plpgsql;
+
+COMMIT;
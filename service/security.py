@@ -1,21 +1,52 @@
+import hashlib
+import hmac
+
 from bottle import (
     request,
     abort,
 )
 
-from config_finder import cfg
+from settings import cfg
+
+def authorized(headers):
+    """ return True if request headers carry the CI token """
+    return headers.get('X-Authenticated-Token') == "CI"
+
 
 def restricted(handler):
     """ Only allow CI token access to handler """
     def restricted_handler(*args, **kwargs):
         """ check the request for an authorized email then call the hander """
         try:
-            auth_token = request.headers.get('X-Authenticated-Token')
-            assert auth_token == "CI"
+            allowed = authorized(request.headers)
         except:
+            allowed = False
+        if not allowed:
             abort(401, "Not Authorized")
             return
         return handler(*args, **kwargs)
 
     return restricted_handler
 
+
+
+def github_signed(handler):
+    """ Only allow webhooks signed with the github webhook secret """
+    def github_signed_handler(*args, **kwargs):
+        """ check the body's signature then call the handler """
+        secret = cfg('github_webhook_secret', None)
+        signature = request.headers.get('X-Hub-Signature-256', '')
+        if secret is None:
+            abort(401, "Not Authorized")
+            return
+        expected = "sha256=" + hmac.new(
+            secret.encode(),
+            request.body.read(),
+            hashlib.sha256,
+        ).hexdigest()
+        if not hmac.compare_digest(signature, expected):
+            abort(401, "Not Authorized")
+            return
+        return handler(*args, **kwargs)
+
+    return github_signed_handler
@@ -0,0 +1,238 @@
+"""
+Servers for running the herd api
+
+`server_mode` picks how __main__ serves the api:
+
+wsgiref   bottle's default single threaded server (the default)
+threaded  a pool of `server_workers` threads. Up to `server_queue_limit`
+          connections wait for a free worker, more are turned away with a
+          503. SIGTERM stops accepting connections and waits up to
+          `server_shutdown_timeout` seconds for requests in flight.
+prefork   gunicorn with `server_processes` pre-forked processes, each with
+          a pool of `server_workers` threads, HTTP keep-alive for
+          `server_keepalive` seconds and a listen backlog of
+          `server_queue_limit`. Requires gunicorn.
+async     one asyncio event loop, serving the build webhooks with aiohttp
+          and an aiopg pool and everything else with the bottle app on a
+          pool of threads, see async_server. The legacy /commit and /build
+          webhooks and the other bottle routes share
+          `async_executor_workers` threads (16), so at most that many run
+          at once and the rest wait; release event streams and the export
+          get `async_stream_workers` threads (8) of their own. SIGTERM
+          stops accepting connections and waits up to
+          `server_shutdown_timeout` seconds. Requires aiohttp and aiopg.
+
+Every mode but async gives up on a client after `server_request_timeout`
+seconds; the async server keeps idle connections for `server_keepalive`.
+
+In the threaded and prefork modes a slow build webhook only ties up its
+own worker. In prefork mode in process state such as /metrics, the render
+cache and the secret caches belongs to each process, and each worker
+starts its own.
+
+A release's event stream holds a thread for up to `sse_max_seconds`, so
+wsgiref serves none, and the other modes at most `sse_max_streams` per
+process, see release_status. Watching deploys needs one of them.
+
+"""
+
+import signal
+import threading
+
+from concurrent.futures import ThreadPoolExecutor
+from wsgiref.simple_server import (
+    make_server,
+    WSGIRequestHandler,
+    WSGIServer,
+)
+
+import bottle
+
+from settings import cfg
+
+
+class TimeoutHandler(WSGIRequestHandler):
+    """ a wsgiref handler that gives up on slow clients """
+
+    def address_string(self):
+        # skip reverse DNS lookups
+        return self.client_address[0]
+
+    def setup(self):
+        self.timeout = self.server.request_timeout
+        super().setup()
+
+
+class ThreadPoolWSGIServer(WSGIServer):
+    """ a wsgiref server that handles requests on a bounded thread pool """
+
+    def __init__(self, server_address, handler_class,
+                 workers=8,
+                 queue_limit=64,
+                 request_timeout=30,
+                 shutdown_timeout=30,
+    ):
+        self.workers = workers
+        self.request_timeout = request_timeout
+        self.shutdown_timeout = shutdown_timeout
+        self.pool = ThreadPoolExecutor(max_workers=workers)
+        # a slot for every connection being handled or waiting
+        self.slots = threading.BoundedSemaphore(workers + queue_limit)
+        self.idle = threading.Condition()
+        self.active = 0
+        super().__init__(server_address, handler_class)
+
+    def process_request(self, request, client_address):
+        if not self.slots.acquire(blocking=False):
+            self.reject(request)
+            return
+        with self.idle:
+            self.active += 1
+        self.pool.submit(self.process_request_thread, request, client_address)
+
+    def process_request_thread(self, request, client_address):
+        try:
+            self.finish_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            self.shutdown_request(request)
+            self.slots.release()
+            with self.idle:
+                self.active -= 1
+                self.idle.notify_all()
+
+    def reject(self, request):
+        """ turn a connection away because the queue is full """
+        try:
+            request.sendall(
+                b"HTTP/1.0 503 Service Unavailable\r\n"
+                b"Retry-After: 1\r\n"
+                b"Content-Length: 0\r\n"
+                b"Connection: close\r\n"
+                b"\r\n"
+            )
+        except OSError:
+            pass
+        self.shutdown_request(request)
+
+    def drain(self, timeout=None):
+        """ wait for requests in flight, return True if there are none """
+        if timeout is None:
+            timeout = self.shutdown_timeout
+        with self.idle:
+            return self.idle.wait_for(lambda: self.active == 0, timeout)
+
+    def server_close(self):
+        super().server_close()
+        self.pool.shutdown(wait=False)
+
+
+class ThreadPoolServer(bottle.ServerAdapter):
+    """ bottle adapter for the thread pool server with graceful shutdown """
+
+    def run(self, handler):
+        self.srv = make_server(
+            self.host,
+            self.port,
+            handler,
+            lambda address, handler_class: ThreadPoolWSGIServer(
+                address, handler_class, **self.options),
+            TimeoutHandler,
+        )
+        self.port = self.srv.server_port
+
+        def stop(signum, frame):
+            print("stopping herd api, draining requests")
+            # shutdown waits for serve_forever, so it can't run in this frame
+            threading.Thread(target=self.srv.shutdown, daemon=True).start()
+        signal.signal(signal.SIGTERM, stop)
+
+        try:
+            self.srv.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            if not self.srv.drain():
+                print("gave up waiting for requests in flight")
+            self.srv.server_close()
+
+
+class AsyncServer(bottle.ServerAdapter):
+    """ bottle adapter for the asyncio server """
+
+    def run(self, handler):
+        # only this mode needs aiohttp
+        from aiohttp import web
+        from async_server import make_app
+
+        web.run_app(
+            make_app(wsgi=handler),
+            host=self.host,
+            port=int(self.port),
+            backlog=self.options['backlog'],
+            keepalive_timeout=self.options['keepalive'],
+            shutdown_timeout=self.options['shutdown_timeout'],
+        )
+
+
+def server_adapter(host, port, start_process=None):
+    """
+    return the bottle server adapter configured by server_mode
+
+    start_process starts what each process serving requests keeps for
+    itself, such as caches and the threads keeping them. It is called in
+    each worker once gunicorn has forked it in prefork mode, otherwise now.
+
+    """
+
+    mode = cfg('server_mode', 'wsgiref')
+    if start_process is None:
+        start_process = lambda: None
+    if mode != 'prefork':
+        start_process()
+    workers = int(cfg('server_workers', '8'))
+    queue_limit = int(cfg('server_queue_limit', '64'))
+    request_timeout = int(cfg('server_request_timeout', '120'))
+    shutdown_timeout = int(cfg('server_shutdown_timeout', '30'))
+
+    if mode == 'wsgiref':
+        return bottle.WSGIRefServer(host=host, port=port)
+
+    if mode == 'threaded':
+        return ThreadPoolServer(
+            host=host,
+            port=port,
+            workers=workers,
+            queue_limit=queue_limit,
+            request_timeout=request_timeout,
+            shutdown_timeout=shutdown_timeout,
+        )
+
+    if mode == 'prefork':
+        return bottle.GunicornServer(
+            host=host,
+            port=port,
+            workers=int(cfg('server_processes', '4')),
+            worker_class='gthread',
+            threads=workers,
+            # the most connections each process serves at once
+            worker_connections=workers + queue_limit,
+            backlog=queue_limit,
+            keepalive=int(cfg('server_keepalive', '5')),
+            timeout=request_timeout,
+            graceful_timeout=shutdown_timeout,
+            # threads started before the fork stay in the master
+            post_worker_init=lambda worker: start_process(),
+        )
+
+    if mode == 'async':
+        return AsyncServer(
+            host=host,
+            port=port,
+            backlog=queue_limit,
+            keepalive=int(cfg('server_keepalive', '5')),
+            shutdown_timeout=shutdown_timeout,
+        )
+
+    raise ValueError("unknown server_mode {}".format(mode))
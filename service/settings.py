@@ -0,0 +1,110 @@
+"""
+An in memory snapshot of herd's config
+
+config_finder looks a key up in /secret and then the environment on every
+call. Instead, every key is looked up once into an immutable snapshot and
+`cfg` answers from memory, so connecting to postgres or calling kubernetes
+never reads config from disk.
+
+The snapshot is rebuilt, and swapped in whole, by `reload`. __main__
+reloads on SIGHUP and `watch` reloads when the contents of /secret change,
+which is how kubernetes delivers updated secrets. Values read at import
+time (e.g. sqlstats' slow_query_ms) keep the value they were first given.
+
+"""
+
+import os
+import signal
+import threading
+
+from types import MappingProxyType
+
+import config_finder
+
+secret_dir = '/secret'
+
+lock = threading.Lock()
+
+
+def secret_keys():
+    """ return the keys with a file in the secret dir """
+    try:
+        names = os.listdir(secret_dir)
+    except OSError:
+        return []
+    # kubernetes keeps the real files in dot dirs behind the symlinks
+    return [name for name in names if not name.startswith('.')]
+
+
+def load():
+    """ return a snapshot of every key config_finder can see """
+    keys = set(os.environ) | set(secret_keys())
+    return MappingProxyType(
+        dict((key, config_finder.cfg(key, None)) for key in keys))
+
+
+def secret_version():
+    """ return something that changes when a file in the secret dir does """
+    stats = []
+    for name in sorted(secret_keys()):
+        try:
+            stats.append((name, os.stat(os.path.join(secret_dir, name))
+                                  .st_mtime_ns))
+        except OSError:
+            pass
+    return tuple(stats)
+
+
+snapshot = load()
+version = secret_version()
+
+
+def cfg(key, default=None):
+    """ return the key's value from the current snapshot """
+    value = snapshot.get(key)
+    if value is None:
+        return default
+    return value
+
+
+def reload():
+    """ build a new snapshot and swap it in """
+    global snapshot, version
+    with lock:
+        version = secret_version()
+        snapshot = load()
+    return snapshot
+
+
+def changed():
+    """ reload if the secret dir changed since the last load """
+    if secret_version() != version:
+        print("config changed, reloading")
+        reload()
+        return True
+    return False
+
+
+def watch(interval=None):
+    """ reload from a daemon thread whenever the secret dir changes """
+    if interval is None:
+        interval = float(cfg('config_poll_seconds', '10'))
+    stop = threading.Event()
+
+    def poll():
+        while not stop.wait(interval):
+            try:
+                changed()
+            except Exception as e:
+                print("Error reloading config, {}".format(e))
+
+    threading.Thread(target=poll, name="settings-watch", daemon=True).start()
+    return stop
+
+
+def reload_on_sighup():
+    """ reload when the process gets SIGHUP, call from the main thread """
+    def hup(signum, frame):
+        print("got SIGHUP, reloading config")
+        reload()
+    signal.signal(signal.SIGHUP, hup)
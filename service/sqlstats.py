@@ -0,0 +1,155 @@
+"""
+Statistics on the sql herd executes
+
+PoliteCursor records every statement here with its duration and row count
+under a normalised fingerprint, so the same query with different values is
+counted together. Statements are aggregated for the whole process and for
+the HTTP request the current thread is serving.
+
+Statements slower than `slow_query_ms` are written to the slow query log
+(`slow_query_log`, a file path, or stdout when unset). Bind parameters are
+redacted to their types before they are logged.
+
+"""
+
+import re
+import threading
+import time
+
+from functools import lru_cache
+
+from settings import cfg
+
+from metrics import Counter, Histogram
+
+slow_query_ms = float(cfg('slow_query_ms', '250'))
+slow_query_log = cfg('slow_query_log', None)
+
+# things in a query that vary from call to call
+string_literal = re.compile(r"'(?:[^']|'')*'")
+number_literal = re.compile(r"\b\d+(?:\.\d+)?\b")
+placeholder = re.compile(r"%(?:\(\w+\))?s")
+value_list = re.compile(r"\((?:\s*\?\s*,)+\s*\?\s*\)")
+whitespace = re.compile(r"\s+")
+
+statements = Counter(
+    "herd_sql_statements_total",
+    "SQL statements executed, by verb",
+    ["verb"],
+)
+statement_duration = Histogram(
+    "herd_sql_statement_duration_seconds",
+    "SQL statement execution time, by verb",
+    ["verb"],
+)
+
+
+@lru_cache(maxsize=1024)
+def fingerprint(sql):
+    """ return the query with its values replaced by ? and spacing collapsed """
+    normal = string_literal.sub("?", sql)
+    normal = placeholder.sub("?", normal)
+    normal = number_literal.sub("?", normal)
+    normal = value_list.sub("(?)", normal)
+    normal = whitespace.sub(" ", normal).strip()
+    return normal.lower()
+
+
+def redact(args):
+    """ return bind parameters with each value replaced by its type """
+    if args is None:
+        return None
+    if isinstance(args, dict):
+        return dict((k, "<{}>".format(type(v).__name__))
+                    for k, v in args.items())
+    return tuple("<{}>".format(type(v).__name__) for v in args)
+
+
+class StatementStats(object):
+    """ counts, total time and rows per query fingerprint """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.started = time.time()
+        self.fingerprints = {}
+
+    def record(self, fingerprint, seconds, rows):
+        with self.lock:
+            stats = self.fingerprints.get(fingerprint)
+            if stats is None:
+                stats = self.fingerprints[fingerprint] = {
+                    "count": 0,
+                    "seconds": 0.0,
+                    "max_seconds": 0.0,
+                    "rows": 0,
+                }
+            stats["count"] += 1
+            stats["seconds"] += seconds
+            stats["max_seconds"] = max(stats["max_seconds"], seconds)
+            if rows > 0:
+                stats["rows"] += rows
+
+    @property
+    def count(self):
+        with self.lock:
+            return sum(s["count"] for s in self.fingerprints.values())
+
+    @property
+    def seconds(self):
+        with self.lock:
+            return sum(s["seconds"] for s in self.fingerprints.values())
+
+    def summary(self):
+        """ return a copy of the stats, slowest fingerprints first """
+        with self.lock:
+            items = [(fp, dict(s)) for fp, s in self.fingerprints.items()]
+        return sorted(items, key=lambda item: item[1]["seconds"], reverse=True)
+
+
+process_stats = StatementStats()
+local = threading.local()
+
+
+def begin_request():
+    """ start aggregating this thread's statements for a new request """
+    local.stats = StatementStats()
+    return local.stats
+
+
+def request_stats():
+    """ return the stats of the request this thread is serving, if any """
+    return getattr(local, 'stats', None)
+
+
+def log_slow(fingerprint, args, seconds, rows):
+    """ write a statement to the slow query log """
+    line = "slow sql ({:.1f}ms, {} rows) {} with args {}".format(
+        seconds * 1000,
+        rows,
+        fingerprint,
+        redact(args),
+    )
+    if slow_query_log:
+        with open(slow_query_log, 'a') as log:
+            log.write(line + '\n')
+    else:
+        print(line)
+
+
+def record(sql, args, seconds, rows):
+    """ record an executed statement """
+    if isinstance(sql, bytes):
+        sql = sql.decode()
+    elif not isinstance(sql, str):
+        # composed sql (psycopg2.sql) is recorded by its type
+        sql = "<{}>".format(type(sql).__name__)
+    normal = fingerprint(sql)
+    verb = normal.split(' ', 1)[0] or "unknown"
+    statements.inc(verb=verb)
+    statement_duration.observe(seconds, verb=verb)
+    process_stats.record(normal, seconds, rows)
+    stats = request_stats()
+    if stats is not None:
+        stats.record(normal, seconds, rows)
+    if seconds * 1000 >= slow_query_ms:
+        log_slow(normal, args, seconds, rows)
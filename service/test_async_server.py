@@ -0,0 +1,205 @@
+import threading
+import unittest
+
+from concurrent.futures import ThreadPoolExecutor
+from unittest.mock import (
+    patch,
+    AsyncMock,
+)
+
+import bottle
+
+try:
+    from aiohttp.test_utils import (
+        make_mocked_request,
+        TestClient,
+        TestServer,
+    )
+except ImportError:
+    TestClient = None
+else:
+    from async_server import (
+        make_app,
+        wsgi_environ,
+    )
+    from idempotency import responses
+
+ci = {'X-Authenticated-Token': "CI"}
+
+
+class DownPool(object):
+    """ a pool whose database is unreachable """
+
+    def acquire(self):
+        raise ConnectionError("no database here")
+
+    def close(self):
+        pass
+
+    async def wait_closed(self):
+        pass
+
+
+@unittest.skipIf(TestClient is None, "the async server needs aiohttp")
+class AsyncServerTestCase(unittest.IsolatedAsyncioTestCase):
+    """ the async server serves the webhooks with their bottle semantics """
+
+    async def asyncSetUp(self):
+        responses.clear()
+        self.pool = DownPool()
+        wsgi = bottle.Bottle()
+
+        @wsgi.route("/v1/echo", ["POST"])
+        def echo():
+            return "{} {}".format(
+                bottle.request.query.get('name'),
+                bottle.request.body.read().decode(),
+            )
+
+        @wsgi.route("/v1/stream")
+        def stream():
+            bottle.response.content_type = "text/event-stream"
+            return (chunk for chunk in [b"one\n", b"two\n"])
+
+        @wsgi.route("/v1/export/releases")
+        def export():
+            return threading.current_thread().name
+
+        # the app takes its handlers when it is made
+        commit_patcher = patch("async_server.leg_handle_branch_commit",
+                               return_value={'iteration_id': 7})
+        self.mock_commit = commit_patcher.start()
+        self.addCleanup(commit_patcher.stop)
+        build_patcher = patch("async_server.leg_handle_build",
+                              return_value={'iteration_id': 7})
+        self.mock_build = build_patcher.start()
+        self.addCleanup(build_patcher.stop)
+
+        self.client = TestClient(TestServer(make_app(
+            wsgi=wsgi,
+            pool=self.pool,
+            executor=ThreadPoolExecutor(max_workers=2),
+            stream_executor=ThreadPoolExecutor(
+                max_workers=1, thread_name_prefix="stream"),
+        )))
+        await self.client.start_server()
+
+    async def asyncTearDown(self):
+        await self.client.close()
+
+    async def test_restricted(self):
+        """ webhooks without the CI token are not authorized """
+        response = await self.client.get("/commit/r/f/b/abc")
+        self.assertEqual(response.status, 401)
+        self.mock_commit.assert_not_called()
+
+    async def test_legacy_commit(self):
+        """ legacy handlers run on the executor with the url's arguments """
+        response = await self.client.get("/commit/r/f/b/abc", headers=ci)
+        self.assertEqual(response.status, 200)
+        self.assertEqual(await response.json(), {'iteration_id': 7})
+        self.mock_commit.assert_called_once_with(
+            repo_name="r",
+            feature_name="f",
+            branch_name="b",
+            commit_hash="abc",
+        )
+
+    async def test_legacy_build_idempotent(self):
+        """ a duplicate build gets the original response """
+        for _ in range(2):
+            response = await self.client.get(
+                "/build/abc/gcr.io/herd/svc:abc", headers=ci)
+            self.assertEqual(await response.json(), {'iteration_id': 7})
+        self.mock_build.assert_called_once_with(
+            commit_hash="abc",
+            image_name="gcr.io/herd/svc:abc",
+        )
+
+    async def test_v1_build(self):
+        """ v1 builds are saved on the pool """
+        with patch("async_server.handle_build",
+                   new_callable=AsyncMock,
+                   return_value=None) as mock_handle:
+            response = await self.client.get(
+                "/v1/build/svc/br/base/abc/herd/svc:abc", headers=ci)
+        self.assertEqual(response.status, 200)
+        self.assertEqual(await response.text(), "")
+        mock_handle.assert_awaited_once_with(
+            self.pool,
+            service_name="svc",
+            branch_name="br",
+            merge_base_commit_hash="base",
+            commit_hash="abc",
+            image_name="herd/svc:abc",
+        )
+
+    async def test_wsgi_fallback(self):
+        """ other routes are served by the bottle app """
+        response = await self.client.post("/v1/echo?name=herd", data=b"hi")
+        self.assertEqual(response.status, 200)
+        self.assertEqual(await response.text(), "herd hi")
+
+        response = await self.client.get("/v1/echo")
+        self.assertEqual(response.status, 405)
+
+    async def test_wsgi_streams(self):
+        """ streamed bottle responses are passed on as they come """
+        response = await self.client.get("/v1/stream")
+        self.assertEqual(response.headers['Content-Type'],
+                         "text/event-stream")
+        self.assertEqual(await response.text(), "one\ntwo\n")
+
+    async def test_long_streams_have_their_own_threads(self):
+        """ exports and event streams don't hold the webhooks' threads """
+        response = await self.client.get("/v1/export/releases")
+        self.assertTrue((await response.text()).startswith("stream"))
+
+        response = await self.client.post("/v1/echo", data=b"hi")
+        self.assertEqual(await response.text(), "None hi")
+
+
+@unittest.skipIf(TestClient is None, "the async server needs aiohttp")
+class WSGIWriteTestCase(unittest.IsolatedAsyncioTestCase):
+
+    async def test_write(self):
+        """ bytes an app writes go out ahead of its body """
+        def app(environ, start_response):
+            write = start_response("200 OK", [('Content-Type', "text/plain")])
+            write(b"one\n")
+            return [b"two\n"]
+
+        client = TestClient(TestServer(make_app(
+            wsgi=app,
+            pool=DownPool(),
+            executor=ThreadPoolExecutor(max_workers=1),
+            stream_executor=ThreadPoolExecutor(max_workers=1),
+        )))
+        await client.start_server()
+        try:
+            response = await client.get("/anything")
+            self.assertEqual(await response.text(), "one\ntwo\n")
+        finally:
+            await client.close()
+
+
+@unittest.skipIf(TestClient is None, "the async server needs aiohttp")
+class WSGIEnvironTestCase(unittest.TestCase):
+
+    def test_environ(self):
+        request = make_mocked_request(
+            "POST",
+            "/v1/builds/a%20b?x=1",
+            headers={
+                'Content-Type': "application/json",
+                'X-Authenticated-Token': "CI",
+            },
+        )
+        environ = wsgi_environ(request, b"[]")
+        self.assertEqual(environ['PATH_INFO'], "/v1/builds/a b")
+        self.assertEqual(environ['QUERY_STRING'], "x=1")
+        self.assertEqual(environ['CONTENT_TYPE'], "application/json")
+        self.assertEqual(environ['CONTENT_LENGTH'], "2")
+        self.assertEqual(environ['HTTP_X_AUTHENTICATED_TOKEN'], "CI")
+        self.assertNotIn('HTTP_CONTENT_TYPE', environ)
+        self.assertEqual(environ['wsgi.input'].read(), b"[]")
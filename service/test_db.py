@@ -0,0 +1,107 @@
+import os
+import threading
+import time
+import unittest
+from unittest.mock import patch
+
+import settings
+
+from db import (
+    advisory_lock,
+    lock_key,
+    LockTimeout,
+    m2_get_cursor,
+)
+from deployment.gce import (
+    branch_lock,
+    deploy_lock_timeouts,
+)
+from testdb import start_postgres
+
+
+class LockKeyTestCase(unittest.TestCase):
+
+    def test_lock_key(self):
+        key = lock_key("deploy", "svc", "br")
+        self.assertEqual(key, lock_key("deploy", "svc", "br"))
+        self.assertNotEqual(key, lock_key("deploy", "svcb", "r"))
+        self.assertTrue(-2 ** 63 <= key < 2 ** 63)
+
+
+class AdvisoryLockIntegrationCase(unittest.TestCase):
+    """ a lock is held by one session at a time, across connections """
+
+    def setUp(self):
+        os.environ['deploy_lock_timeout'] = '0.2'
+        self.pg = start_postgres()
+
+    def tearDown(self):
+        self.pg.stop()
+
+    def test_one_holder(self):
+        with advisory_lock(m2_get_cursor(), 1, 0.2):
+            with self.assertRaises(LockTimeout):
+                with advisory_lock(m2_get_cursor(), 1, 0.2):
+                    pass
+            # other keys are free
+            with advisory_lock(m2_get_cursor(), 2, 0.2):
+                pass
+        # and the lock is released with the block
+        with advisory_lock(m2_get_cursor(), 1, 0.2):
+            pass
+
+    def test_waits_for_holder(self):
+        held = threading.Event()
+
+        def hold():
+            with advisory_lock(m2_get_cursor(), 1, 1):
+                held.set()
+                time.sleep(0.3)
+
+        holder = threading.Thread(target=hold)
+        holder.start()
+        held.wait()
+        started = time.monotonic()
+        with advisory_lock(m2_get_cursor(), 1, 5):
+            self.assertGreater(time.monotonic() - started, 0.1)
+        holder.join()
+
+    def test_short_timeout(self):
+        """ a timeout under a millisecond still gives up """
+        with advisory_lock(m2_get_cursor(), 1, 0.2):
+            for timeout in [0.0001, 0]:
+                with self.assertRaises(LockTimeout):
+                    with advisory_lock(m2_get_cursor(), 1, timeout):
+                        pass
+
+    def test_branch_lock(self):
+        os.environ['v2_model'] = 'run'
+        settings.reload()
+        self.addCleanup(os.environ.pop, 'v2_model')
+        timeouts = deploy_lock_timeouts.samples()
+        with branch_lock("svc", "br"):
+            with self.assertRaises(LockTimeout):
+                with branch_lock("svc", "br"):
+                    pass
+            with branch_lock("svc", "br2"):
+                pass
+        self.assertNotEqual(deploy_lock_timeouts.samples(), timeouts)
+
+    def test_legacy_branch_lock(self):
+        """ without the 2.x model the lock is taken in the legacy database """
+        dsn = self.pg.dsn()
+        for key, value in [('v2_model', 'false'),
+                           ('pghost', dsn['host']),
+                           ('pgport', str(dsn['port'])),
+                           ('pgdatabase', dsn['database']),
+                           ('pguser', dsn['user'])]:
+            os.environ[key] = value
+            self.addCleanup(os.environ.pop, key)
+        settings.reload()
+
+        with patch("deployment.gce.m2_get_cursor") as mock_m2_get_cursor:
+            with branch_lock("svc", "br"):
+                with self.assertRaises(LockTimeout):
+                    with branch_lock("svc", "br"):
+                        pass
+        mock_m2_get_cursor.assert_not_called()
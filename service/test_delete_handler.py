@@ -1,26 +1,203 @@
+import hashlib
+import hmac
+import io
+import json
+import os
 import unittest
+from unittest.mock import (
+    patch,
+    MagicMock,
+)
+
+import bottle
+import psycopg2
+
+import settings
+from deployment.gce import (
+    Cluster,
+    default_cluster,
+    teardown,
+)
+from m2.handlers import (
+    handle_build,
+    handle_delete,
+)
+from routes import handle_github_delete
+from security import github_signed
+from testdb import start_postgres
+
+
+# the parts of github's delete webhook message herd uses
+delete_payload = {
+    "ref": "mock_branch",
+    "ref_type": "branch",
+    "pusher_type": "user",
+    "repository": {
+        "name": "mock_service",
+        "full_name": "OAODEV/mock_service",
+    },
+}
+
+
+def bind_request(payload, event="delete", secret="mock-secret"):
+    """ make a signed github webhook the request bottle is serving """
+    body = json.dumps(payload).encode()
+    signature = "sha256=" + hmac.new(
+        secret.encode(), body, hashlib.sha256).hexdigest()
+    bottle.request.bind({
+        'REQUEST_METHOD': 'POST',
+        'PATH_INFO': '/v1/github/delete',
+        'CONTENT_TYPE': 'application/json',
+        'CONTENT_LENGTH': str(len(body)),
+        'HTTP_X_GITHUB_EVENT': event,
+        'HTTP_X_HUB_SIGNATURE_256': signature,
+        'wsgi.input': io.BytesIO(body),
+    })
+
 
 class DeleteHandlerTestCase(unittest.TestCase):
 
     def setUp(self):
-        pass
+        os.environ['github_webhook_secret'] = "mock-secret"
+        self.pg = start_postgres()
+
+        backend_patcher = patch("m2.handlers.backend")
+        self.mock_backend = backend_patcher.start()
 
     def tearDown(self):
-        pass
+        patch.stopall()
+        del os.environ['github_webhook_secret']
+        settings.reload()
+        self.pg.stop()
 
+    def query(self, sql, values):
+        """ execute a query and return the results """
+        conn = psycopg2.connect(**self.pg.dsn())
+        cursor = conn.cursor()
+        cursor.execute(sql, values)
+        results = cursor.fetchall()
+        conn.commit()
+        cursor.close()
+        conn.close()
+        return results
 
-    @unittest.skip("bring this back when working on delete handler")
     def test_github_delete_interface(self):
         """ accept github's webhook delete message format """
-        self.assertTrue(False)
+        bind_request(delete_payload)
+        result = github_signed(handle_github_delete)()
+        self.assertEqual(result, {'deleted_branch_ids': []})
+        self.mock_backend.return_value.teardown.assert_called_once_with(
+            "mock-service", "mock-branch")
+
+    def test_github_delete_unsigned(self):
+        """ webhooks not signed with the shared secret are refused """
+        bind_request(delete_payload, secret="mock-wrong-secret")
+        with self.assertRaises(bottle.HTTPError) as error:
+            github_signed(handle_github_delete)()
+        self.assertEqual(error.exception.status_code, 401)
+        self.mock_backend.assert_not_called()
+
+    def test_github_other_events(self):
+        """ pings and tag deletes are acknowledged and ignored """
+        bind_request({"zen": "mock"}, event="ping")
+        self.assertEqual(github_signed(handle_github_delete)(),
+                         {'ignored': 'ping'})
+
+        self.assertEqual(handle_delete(dict(delete_payload, ref_type="tag")),
+                         {'deleted_branch_ids': []})
+        self.mock_backend.assert_not_called()
 
-    @unittest.skip("bring this back when working on delete handler")
     def test_delete_branch_updates_model(self):
         """ should update the correct branch with a deleted datetime """
-        self.assertTrue(False)
+        handle_build("mock_service", "mock_branch", "mb", "c1", "i1")
+        handle_build("mock_service", "other_branch", "mb", "c2", "i2")
+        handle_build("other_service", "mock_branch", "mb2", "c3", "i3")
+
+        result = handle_delete(delete_payload)
+
+        deleted = self.query(
+            """
+            select branch_id, service_name, branch_name
+              from branch
+              join service using (service_id)
+             where deleted_dt <> 'infinity'
+            """,
+            (),
+        )
+        self.assertEqual(
+            [(row[1], row[2]) for row in deleted],
+            [("mock_service", "mock_branch")],
+        )
+        self.assertEqual(result, {'deleted_branch_ids': [deleted[0][0]]})
+
+        # deleting again finds nothing more to delete
+        self.assertEqual(handle_delete(delete_payload),
+                         {'deleted_branch_ids': []})
+
+        # a new branch of the same name can be built
+        handle_build("mock_service", "mock_branch", "mb", "c4", "i4")
 
-    @unittest.skip("bring this back when working on delete handler")
     def test_delete_branch_stops_the_correct_release(self):
         """ should stop the running releases for that branch """
-        self.assertTrue(False)
 
+        def repcon(service, branch, secret):
+            return {
+                "metadata": {
+                    "name": "{}-{}".format(branch, service),
+                    "labels": {"service": service, "branch": branch},
+                },
+                "spec": {"template": {"spec": {"volumes": [
+                    {"name": "v", "secret": {"secretName": secret}},
+                ]}}},
+            }
+
+        os.environ['kubeproxy'] = "mock8s-host"
+        settings.reload()
+        with patch("deployment.gce.requests") as mock_requests:
+            mock_requests.get.return_value.json.return_value = {"items": [
+                repcon("mock-service", "mock-branch", "only-mine"),
+                repcon("mock-service", "mock-branch", "shared"),
+                repcon("mock-service", "other-branch", "shared"),
+            ]}
+            mock_requests.delete.return_value.status_code = 200
+
+            # run SUT
+            with patch("deployment.gce.branch_clusters",
+                       side_effect=lambda *names: [default_cluster()]):
+                statuses = teardown("mock-service", "mock-branch")
+
+        endpoint = "http://mock8s-host/api/v1/namespaces/default/"
+        # the repcons go with one collection delete, by label
+        mock_requests.delete.assert_any_call(
+            endpoint + "replicationcontrollers",
+            params={"labelSelector": "service=mock-service,branch=mock-branch"},
+            json={
+                "kind": "DeleteOptions",
+                "apiVersion": "v1",
+                "propagationPolicy": "Background",
+            },
+        )
+        mock_requests.delete.assert_any_call(
+            endpoint + "services/mock-servic-mock-branch")
+        # only the secret no other branch mounts is deleted
+        mock_requests.delete.assert_any_call(endpoint + "secrets/only-mine")
+        self.assertEqual(mock_requests.delete.call_count, 3)
+        self.assertEqual(set(statuses.values()), {200})
+
+    def test_teardown_every_cluster(self):
+        """ a branch is torn down in each cluster it may run in """
+        os.environ['kubeproxy'] = "mock8s-host"
+        settings.reload()
+        targets = [default_cluster(), Cluster("east", "east-proxy", "pass")]
+        with patch("deployment.gce.requests") as mock_requests:
+            mock_requests.get.return_value.json.return_value = {"items": []}
+            mock_requests.delete.return_value.status_code = 200
+
+            # run SUT
+            statuses = teardown("mock-service", "mock-branch",
+                                targets=targets)
+
+        self.assertEqual(
+            sorted(uri.split('/')[2] for uri in statuses),
+            ["east-proxy", "east-proxy", "mock8s-host", "mock8s-host"],
+        )
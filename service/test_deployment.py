@@ -1,18 +1,37 @@
 import hashlib
 import os
+import time
 import unittest
 from unittest.mock import (
     patch,
     MagicMock,
 )
 import base64
+import psycopg2
+import settings
+import deployment
+from deployment import backend as lookup_backend
 from deployment.gce import runner as gce_runner
 from deployment.gce import (
+    batch_runner,
+    clusters,
+    deploy_batch,
+    digest,
+    environment_clusters,
+    fan_out,
     gc_repcons,
     k8s_secret_description,
+    m2_run_params,
     make_rc_name,
+    render,
+    rendered,
+    sessions,
+    update,
+    wait_ready,
     watch_uri
 )
+from m2.handlers import handle_build
+from testdb import start_postgres
 
 
 class RunTests(unittest.TestCase):
@@ -23,10 +42,19 @@ class RunTests(unittest.TestCase):
         os.environ['k8spassword'] = "mock8s-admin-pass"
 
         os.environ['v2_model'] = 'run'
+        # don't wait for mock repcons to be ready
+        os.environ['deploy_ready_checks'] = '0'
+        settings.reload()
+
+        rendered.clear()
 
         requests_patcher = patch("deployment.gce.requests")
         self.mock_requests = requests_patcher.start()
 
+        # deploy locks and stages use their own m2 connections
+        patch("deployment.gce.branch_lock").start()
+        patch("deployment.gce.stage_recorder").start()
+
         self.get_cursor_patcher = patch("deployment.gce.get_cursor")
         self.mock_get_cursor = self.get_cursor_patcher.start()
         self.mock_get_cursor.return_value.fetchall.return_value = (
@@ -35,7 +63,8 @@ class RunTests(unittest.TestCase):
              789, # mock config id
              "mock-key=mock-value\nmk=mv\n",
              "mockcommithash",
-             "mock_image_name")]
+             "mock_image_name",
+             "")] # mock environment settings
         )
 
         # mock up m2 cursor to return the same as the m1 so we can confirm
@@ -130,6 +159,122 @@ class RunTests(unittest.TestCase):
         # updated config), we want to see 3 here.
         self.assertEqual(self.mock_requests.delete.call_count, 3)
 
+    def branch_repcons(self, annotations):
+        """ mock k8s listing a stale repcon and the release's repcon """
+        repcon_name = make_rc_name("br", "svc", "abc1234", 7)
+        self.mock_requests.get.return_value.json.return_value = {
+            'items': [
+                {
+                    'metadata': {
+                        'name': 'mockstalename',
+                        'selfLink': '/api/v1/mockstaleselflink',
+                    },
+                    'spec': {'replicas': 1},
+                },
+                {
+                    'metadata': {
+                        'name': repcon_name,
+                        'selfLink': '/api/v1/mockcurrentselflink',
+                        'annotations': annotations,
+                    },
+                    'spec': {'replicas': 1},
+                },
+            ],
+            "status": {"replicas": 0},
+        }
+
+    def test_update_unchanged(self):
+        """ a redeploy of what is running keeps the running repcon """
+        manifests = render("svc", "br", 7, "a=b\n", "abc1234", "img")
+        self.branch_repcons(manifests.repcon['metadata']['annotations'])
+
+        # run SUT
+        result = update(("svc", "br", 7, "a=b\n", "abc1234", "img"))
+
+        self.assertEqual(result, "unchanged")
+        # only the stale repcon is scaled down and deleted
+        self.mock_requests.patch.assert_called_once_with(
+            'http://mock8s-host/api/v1/mockstaleselflink',
+            data='{"spec": {"replicas": 0}}',
+            headers={"Content-Type": "application/merge-patch+json"},
+        )
+        self.mock_requests.delete.assert_called_once_with(
+            'http://mock8s-host/api/v1/mockstaleselflink')
+        # a service and a secret, but no new repcon
+        self.assertEqual(
+            [c[0][0].rsplit('/', 1)[1]
+             for c in self.mock_requests.post.call_args_list],
+            ["services", "secrets"],
+        )
+
+    def test_update_changed(self):
+        """ a new image or config replaces the repcon even by the same name """
+        manifests = render("svc", "br", 7, "a=b\n", "abc1234", "img")
+        annotations = dict(manifests.repcon['metadata']['annotations'])
+        annotations["herd/image"] = "old-img"
+        self.branch_repcons(annotations)
+
+        # run SUT
+        result = update(("svc", "br", 7, "a=b\n", "abc1234", "img"))
+
+        self.assertEqual(result, "deployed")
+        self.assertEqual(self.mock_requests.delete.call_count, 2)
+        self.assertEqual(self.mock_requests.post.call_count, 3)
+
+    def test_update_reused_secret(self):
+        """ a secret that is already there is marked used before gc """
+        manifests = render("svc", "br", 7, "a=b\n", "abc1234", "img")
+        self.branch_repcons({})
+        self.mock_requests.post.return_value.status_code = 409
+
+        # run SUT
+        with patch("deployment.gce.time.time", return_value=1462829580.0):
+            update(("svc", "br", 7, "a=b\n", "abc1234", "img"))
+
+        # the secret is marked first, then the stale repcons scaled down
+        secret_uri = "http://mock8s-host/api/v1/namespaces/default/" + \
+            "secrets/" + manifests.secret['metadata']['name']
+        self.assertEqual(self.mock_requests.patch.call_args_list[0][0][0],
+                         secret_uri)
+        self.assertEqual(
+            self.mock_requests.patch.call_args_list[0][1]["data"],
+            '{"metadata": {"annotations": '
+            '{"herd/last-used": "2016-05-09T21:33:00Z"}}}',
+        )
+        self.assertEqual(self.mock_requests.patch.call_count, 3)
+
+    def test_update_readiness(self):
+        """ only deploys someone is watching wait for readiness """
+        os.environ['deploy_ready_checks'] = '3'
+        settings.reload()
+        self.addCleanup(os.environ.__setitem__, 'deploy_ready_checks', '0')
+        self.branch_repcons({})
+        record_stage = MagicMock()
+
+        # run SUT
+        with patch("deployment.gce.wait_ready",
+                   return_value=True) as mock_wait_ready:
+            update(("svc", "br", 7, "a=b\n", "abc1234", "img"))
+            mock_wait_ready.assert_not_called()
+
+            update(("svc", "br", 7, "a=b\n", "abc1234", "img"), record_stage)
+            self.assertEqual(mock_wait_ready.call_args[0][1], 3)
+        record_stage.assert_called_with("repcon_ready")
+
+    def test_wait_ready(self):
+        """ readiness is checked without sleeping after the last check """
+        self.mock_requests.get.return_value.json.return_value = {
+            "spec": {"replicas": 2},
+            "status": {"readyReplicas": 1},
+        }
+
+        # run SUT
+        with patch("deployment.gce.time.sleep") as mock_sleep:
+            self.assertFalse(wait_ready("mock-rc", 3))
+
+        self.assertEqual(self.mock_requests.get.call_count, 3)
+        self.assertEqual([c[0][0] for c in mock_sleep.call_args_list], [0, 1])
+
     def test_secret_description_handles_empty_string(self):
         """ creating a service with no key value pairs should not fail """
         # run SUT
@@ -204,6 +349,7 @@ class RunTests(unittest.TestCase):
             "      ,key_value_pairs\n" + \
             "      ,commit_hash\n" + \
             "      ,image_name\n" + \
+            "      ,e.settings\n" + \
             "  FROM release r\n" + \
             "  JOIN iteration i\n" + \
             "    ON i.iteration_id = r.iteration_id\n" + \
@@ -240,7 +386,7 @@ class RunTests(unittest.TestCase):
              "  join config c\n"
              "    on c.config_id = r.config_id\n"
              "  join service s\n"
-             "    on b.service_id\n"
+             "    on s.service_id = b.service_id\n"
              " where release_id=%s"),
             (123,),
         )
@@ -357,6 +503,11 @@ class RunTests(unittest.TestCase):
                         "service": 'mock-service-name',
                         "branch": 'mock-branch-name',
                     },
+                    "annotations": {
+                        "herd/image": "mock_image_name",
+                        "herd/config-digest": hashlib.sha256(
+                            b'mock-key=mock-value\nmk=mv\n').hexdigest(),
+                    },
                 },
                 "spec": {
                     "replicas": 1,
@@ -417,6 +568,11 @@ class RunTests(unittest.TestCase):
                         "service": "m2mock-service-name",
                         "branch": "m2mock-branch-name",
                     },
+                    "annotations": {
+                        "herd/image": "m2mock_image_name",
+                        "herd/config-digest": hashlib.sha256(
+                            b'm2mock-key=mock-value\nmk=mv\n').hexdigest(),
+                    },
                 },
                 "spec": {
                     "replicas": 1,
@@ -467,5 +623,366 @@ class RunTests(unittest.TestCase):
         # make sure we closed the cursor
         self.mock_get_cursor.return_value.close.asert_called_once_with()
 
+    def test_batch_runner(self):
+        """
+        batch_runner should fetch params for every release in one query per
+        model and deploy each (service, branch) once per param set
+
+        """
+
+        # set up (two releases on one branch, one on another)
+        self.mock_get_cursor.return_value.fetchall.return_value = [
+            (1, "svc", "b1", 10, "k=v\n", "c1", "img1", ""),
+            (2, "svc", "b1", 11, "k=v\n", "c1", "img1", ""),
+            (3, "svc", "b2", 12, "k=v\n", "c2", "img2", ""),
+        ]
+        self.m2_mock_get_cursor.return_value.fetchall.return_value = []
+        self.mock_requests.get.return_value.json.return_value = {
+            "items": [],
+        }
+
+        # run SUT
+        self.assertTrue(batch_runner([1, 2, 3], max_workers=2))
+
+        # one query per model, with every release id
+        self.assertEqual(
+            self.mock_get_cursor.return_value.execute.call_count, 1)
+        args = self.mock_get_cursor.return_value.execute.call_args[0]
+        self.assertIn(" WHERE release_id = ANY(%s)\n", args[0])
+        self.assertEqual(args[1], ([1, 2, 3], "gce"))
+        self.assertEqual(
+            self.m2_mock_get_cursor.return_value.execute.call_count, 1)
+        args = self.m2_mock_get_cursor.return_value.execute.call_args[0]
+        self.assertIn(" where release_id = any(%s)", args[0])
+        self.assertEqual(args[1], ([1, 2, 3],))
+
+        # a service, secret and repcon for each param set
+        self.assertEqual(self.mock_requests.post.call_count, 9)
+
+    def test_render(self):
+        """ render should describe all of a release's k8s objects at once """
+        # run SUT
+        manifests = render("svc", "br", 7, "a=b\n", "abc1234", "img")
+
+        # the secret and repcon should agree on the secret's name
+        self.assertEqual(
+            manifests.secret['metadata']['name'],
+            manifests.repcon['spec']['template']['spec']['volumes'][0]
+                            ['secret']['secretName'],
+        )
+        self.assertEqual(manifests.service['metadata']['name'], "svc-br")
+        self.assertEqual(
+            manifests.repcon['metadata']['name'],
+            make_rc_name("br", "svc", "abc1234", 7),
+        )
+
+    def test_render_is_cached(self):
+        """ rendering the same release and config again should be free """
+        with patch("deployment.gce.digest", wraps=digest) as mock_digest:
+            first = render("svc", "br", 7, "a=b\n", "abc1234", "img")
+            # the config is only digested once per render
+            self.assertEqual(mock_digest.call_count, 1)
+
+            with patch("deployment.gce.b64") as mock_b64:
+                second = render("svc", "br", 7, "a=b\n", "abc1234", "img")
+                # nothing was encoded the second time
+                mock_b64.assert_not_called()
+        self.assertIs(first, second)
+
+        # a new image is a new render
+        third = render("svc", "br", 7, "a=b\n", "abc1234", "img2")
+        self.assertIsNot(first, third)
+        self.assertEqual(
+            third.repcon['spec']['template']['spec']['containers'][0]['image'],
+            "img2",
+        )
+
+    def test_batch_runner_no_releases(self):
+        """ an empty batch should not touch the database or k8s """
+        self.assertTrue(batch_runner([]))
+        self.mock_get_cursor.assert_not_called()
+        self.m2_mock_get_cursor.assert_not_called()
+        self.mock_requests.post.assert_not_called()
+
+    def test_can_pass(self):
+        self.assertTrue(True)
+
+
+class ClustersTestCase(unittest.TestCase):
+    """ a release goes to every cluster its environment lists at once """
+
+    settings = (
+        "clusters=east, west\n"
+        "cluster.east.kubeproxy=east-proxy\n"
+        "cluster.east.password_key=k8spassword-east\n"
+        "cluster.west.kubeproxy=west-proxy\n"
+    )
+
+    def setUp(self):
+        os.environ['kubeproxy'] = "mock8s-host"
+        os.environ['k8spassword'] = "mock8s-admin-pass"
+        os.environ['k8spassword-east'] = "mock8s-east-pass"
+        os.environ['deploy_ready_checks'] = '0'
+        settings.reload()
+        rendered.clear()
+        sessions.clear()
+
+        requests_patcher = patch("deployment.gce.requests")
+        self.mock_requests = requests_patcher.start()
+        # a session per cluster
+        self.mock_requests.Session.side_effect = lambda: MagicMock()
+        patch("deployment.gce.branch_lock").start()
+
+    def tearDown(self):
+        patch.stopall()
+        sessions.clear()
+
+    def test_clusters(self):
+        east, west = clusters(self.settings)
+        self.assertEqual((east.name, east.kubeproxy, east.password),
+                         ("east", "east-proxy", "mock8s-east-pass"))
+        self.assertEqual((west.name, west.kubeproxy, west.password),
+                         ("west", "west-proxy", "mock8s-admin-pass"))
+        # sessions, and so connection pools, are kept per cluster
+        self.assertIsNot(east.session, west.session)
+        self.assertIs(clusters(self.settings)[0].session, east.session)
+
+    def test_default_cluster(self):
+        default, = clusters("mockKey=mockVal")
+        self.assertEqual((default.name, default.kubeproxy, default.session),
+                         ("default", "mock8s-host", None))
+        with self.assertRaises(ValueError):
+            clusters("clusters=east")
+
+    def test_password_key(self):
+        """ only k8s passwords can be sent to a cluster """
+        with self.assertRaises(ValueError):
+            clusters("clusters=east\n"
+                     "cluster.east.kubeproxy=attacker-proxy\n"
+                     "cluster.east.password_key=pgpassword\n")
+
+    def test_deploy_batch_bad_settings(self):
+        """ a release with broken settings fails alone """
+        record_stage = MagicMock()
+        with patch("deployment.gce.stage_recorder",
+                   return_value=record_stage), \
+                patch("deployment.gce.fan_out") as mock_fan_out:
+            with self.assertRaises(ValueError):
+                deploy_batch([
+                    (1, "svc", "b1", 10, "k=v\n", "c1", "img1",
+                     "clusters=broken"),
+                    (2, "svc", "b2", 11, "k=v\n", "c2", "img2", ""),
+                ])
+
+        record_stage.assert_called_once_with(
+            "failed", "cluster broken has no kubeproxy")
+        mock_fan_out.assert_called_once()
+        self.assertEqual(mock_fan_out.call_args[0][1][1], "b2")
+
+    def test_environment_clusters(self):
+        """ the default and every listed cluster, once each """
+        found = environment_clusters(
+            [self.settings, None, "clusters=west\n"
+                                  "cluster.west.kubeproxy=west-proxy\n",
+             "clusters=broken"])
+        self.assertEqual([(c.name, c.kubeproxy) for c in found], [
+            ("default", "mock8s-host"),
+            ("east", "east-proxy"),
+            ("west", "west-proxy"),
+        ])
+
+    def test_fan_out(self):
+        """ each cluster gets the release through its own session """
+        targets = clusters(self.settings)
+        for cluster in targets:
+            cluster.session.get.return_value.json.return_value = {
+                "items": []}
+
+        results = fan_out(
+            update, ("svc", "br", 7, "a=b\n", "abc1234", "img"), targets)
+
+        self.assertEqual(sorted(results), ["east", "west"])
+        self.assertEqual(set(r for r, seconds in results.values()),
+                         {"deployed"})
+        for cluster in targets:
+            self.assertEqual(cluster.session.post.call_count, 3)
+            self.assertTrue(all(
+                c[0][0].startswith("http://{}/".format(cluster.kubeproxy))
+                for c in cluster.session.post.call_args_list))
+        self.mock_requests.post.assert_not_called()
+
+    def test_fan_out_concurrently(self):
+        """ a slow cluster doesn't hold up the others """
+        def slow_in_east(param_set, record_stage, cluster):
+            time.sleep(0.3 if cluster.name == "east" else 0)
+            record_stage("repcon_ready")
+
+        record_stage = MagicMock()
+        started = time.monotonic()
+        results = fan_out(slow_in_east, ("svc", "br"),
+                          clusters(self.settings), record_stage)
+        self.assertLess(time.monotonic() - started, 0.55)
+        self.assertLess(results["west"][1], results["east"][1])
+        record_stage.assert_called_once_with(
+            "repcon_ready", "east: repcon_ready; west: repcon_ready")
+
+    def test_fan_out_failure(self):
+        """ a failing cluster fails the release once the others are done """
+        deployed = []
+
+        def fail_in_east(param_set, record_stage, cluster):
+            if cluster.name == "east":
+                record_stage("failed", "k8s is down")
+                raise IOError("k8s is down")
+            record_stage("rendered")
+            deployed.append(cluster.name)
+            record_stage("repcon_ready")
+
+        record_stage = MagicMock()
+        with self.assertRaises(IOError):
+            fan_out(fail_in_east, ("svc", "br"), clusters(self.settings),
+                    record_stage)
+        self.assertEqual(deployed, ["west"])
+        record_stage.assert_any_call("rendered", "west")
+        record_stage.assert_called_with(
+            "failed", "east: failed k8s is down; west: repcon_ready")
+
+
+class BackendRegistryTestCase(unittest.TestCase):
+    """ releases are sent to their environment's infrastructure backend """
+
+    def setUp(self):
+        get_cursor_patcher = patch("deployment.get_cursor")
+        self.mock_get_cursor = get_cursor_patcher.start()
+        self.addCleanup(get_cursor_patcher.stop)
+
+        self.mock_backends = {"gce": MagicMock(), "dryrun": MagicMock()}
+        backend_patcher = patch(
+            "deployment.backend",
+            side_effect=lambda name: self.mock_backends[name],
+        )
+        self.mock_backend = backend_patcher.start()
+        self.addCleanup(backend_patcher.stop)
+
+    def test_batch_runner_dispatch(self):
+        """ one query finds every release's backend, each backend runs once """
+        # set up
+        self.mock_get_cursor.return_value.fetchall.return_value = [
+            (1, "gce"),
+            (2, "dryrun"),
+            (3, "gce"),
+            (4, "mock-unknown-backend"),
+        ]
+
+        unknown = deployment.unknown_backend_releases.samples()
+
+        # run SUT
+        with self.assertRaises(LookupError):
+            deployment.batch_runner([1, 2, 3, 4], "UPDATE")
+
+        self.assertEqual(
+            self.mock_get_cursor.return_value.execute.call_count, 1)
+        self.assertEqual(
+            self.mock_get_cursor.return_value.execute.call_args[0][1],
+            ([1, 2, 3, 4],),
+        )
+        self.mock_backends["gce"].batch_runner.assert_called_once_with(
+            [1, 3], "UPDATE")
+        self.mock_backends["dryrun"].batch_runner.assert_called_once_with(
+            [2], "UPDATE")
+        # releases for unknown backends fail once the others are sent
+        self.assertEqual(self.mock_backend.call_count, 2)
+        self.assertNotEqual(deployment.unknown_backend_releases.samples(),
+                            unknown)
+
+    def test_batch_runner_no_releases(self):
+        self.assertTrue(deployment.batch_runner([]))
+        self.mock_get_cursor.assert_not_called()
+
+    def test_backend_lookup(self):
+        """ backends are imported by name on first use """
+        with patch.dict(deployment.backends, {"mock": "deployment.dryrun"}), \
+                patch.dict(deployment.loaded, clear=True):
+            module = lookup_backend("mock")
+            self.assertEqual(module.__name__, "deployment.dryrun")
+            self.assertIs(deployment.loaded["mock"], module)
+
+            with self.assertRaises(LookupError):
+                lookup_backend("mock-unknown-backend")
+
+
+class M2RunParamsIntegrationCase(unittest.TestCase):
+    """ m2 run params against a real database with many services """
+
+    def setUp(self):
+        os.environ['kubeproxy'] = "mock8s-host"
+        os.environ['k8spassword'] = "mock8s-admin-pass"
+        os.environ['v2_model'] = 'run'
+        os.environ['deploy_ready_checks'] = '0'
+        self.pg = start_postgres()
+
+        # seed a database with several services, each with a build
+        for n in range(5):
+            handle_build(
+                "service{}".format(n),
+                "branch{}".format(n),
+                "mb{}".format(n),
+                "c{}".format(n),
+                "image{}".format(n),
+            )
+
+        requests_patcher = patch("deployment.gce.requests")
+        self.mock_requests = requests_patcher.start()
+        self.mock_requests.get.return_value.json.return_value = {
+            "items": [],
+        }
+
+        # only the version 2 model is seeded
+        run_params_patcher = patch(
+            "deployment.gce.run_params",
+            return_value=[],
+        )
+        run_params_patcher.start()
+
+    def tearDown(self):
+        patch.stopall()
+        self.pg.stop()
+
+    def release_id(self, commit_hash):
+        """ return the release id for the commit """
+        conn = psycopg2.connect(**self.pg.dsn())
+        cursor = conn.cursor()
+        cursor.execute(
+            "select release_id\n"
+            "  from release\n"
+            "  join iteration using (iteration_id)\n"
+            " where commit_hash=%s",
+            (commit_hash,),
+        )
+        release_id = cursor.fetchone()[0]
+        cursor.close()
+        conn.close()
+        return release_id
+
+    def test_m2_run_params_one_param_set_per_release(self):
+        """ each release resolves to exactly its own service """
+        # run SUT
+        params = m2_run_params(self.release_id("c3"))
+
+        # confirm one param set, for the right service
+        self.assertEqual(len(params), 1)
+        self.assertEqual(params[0][0], "service3")
+        self.assertEqual(params[0][1], "branch3")
+
+    def test_runner_k8s_calls_independent_of_service_count(self):
+        """ a release makes the same k8s calls however many services exist """
+        # run SUT
+        gce_runner({'release_id': self.release_id("c1"), 'action': "UPDATE"})
+
+        # a service, a secret and a repcon
+        self.assertEqual(self.mock_requests.post.call_count, 3)
+        # one list of the branch's repcons
+        self.assertEqual(self.mock_requests.get.call_count, 1)
+
     def test_can_pass(self):
         self.assertTrue(True)
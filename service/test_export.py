@@ -0,0 +1,78 @@
+import json
+import tempfile
+import unittest
+from unittest.mock import patch
+
+from db import m2_get_cursor
+from m2.export import (
+    main,
+    ndjson,
+    release_history,
+)
+from m2.handlers import handle_build
+from testdb import start_postgres
+
+
+class ExportIntegrationCase(unittest.TestCase):
+    """ the release history streams through a server side cursor """
+
+    def setUp(self):
+        self.pg = start_postgres()
+
+        for n in range(5):
+            handle_build('s{}'.format(n % 2), 'b', 'mb{}'.format(n % 2),
+                         'c{}'.format(n), 'i{}'.format(n))
+
+    def tearDown(self):
+        self.pg.stop()
+
+    def test_release_history(self):
+        """ every release, oldest first, fetched a chunk at a time """
+        cursors = []
+
+        def get_cursor(name=None):
+            cursors.append(m2_get_cursor(name))
+            return cursors[-1]
+
+        with patch("m2.export.get_cursor", side_effect=get_cursor):
+            history = list(release_history(size=2))
+
+        self.assertEqual([r['commit_hash'] for r in history],
+                         ['c0', 'c1', 'c2', 'c3', 'c4'])
+        self.assertEqual(history[1]['service_name'], 's1')
+        self.assertEqual(history[1]['merge_base_commit_hash'], 'mb1')
+        self.assertIn('config_id', history[0])
+
+        # a named, server side, cursor that was closed with its connection
+        self.assertEqual(cursors[0].name, "release_history")
+        self.assertTrue(cursors[0].connection.closed)
+
+        since = history[2]['release_id']
+        self.assertEqual([r['commit_hash'] for r in release_history(since)],
+                         ['c3', 'c4'])
+
+    def test_stopping_early_closes_the_connection(self):
+        """ a client that goes away doesn't leave the connection open """
+        cursors = []
+
+        def get_cursor(name=None):
+            cursors.append(m2_get_cursor(name))
+            return cursors[-1]
+
+        with patch("m2.export.get_cursor", side_effect=get_cursor):
+            history = release_history(size=1)
+            next(history)
+            history.close()
+        self.assertTrue(cursors[0].connection.closed)
+
+    def test_cli(self):
+        with tempfile.NamedTemporaryFile() as output:
+            self.assertEqual(main(["--output", output.name, "--since", "0"]),
+                             0)
+            with open(output.name) as f:
+                lines = [json.loads(line) for line in f]
+        self.assertEqual(len(lines), 5)
+
+    def test_ndjson(self):
+        self.assertEqual(list(ndjson([{'b': 1, 'a': 2}, {}])),
+                         [b'{"a": 2, "b": 1}\n', b'{}\n'])
@@ -6,6 +6,8 @@ from unittest.mock import (
     PropertyMock,
 )
 
+import settings
+
 from getters import (
     get_config,
     get_env,
@@ -26,6 +28,7 @@ class FactoryTestCase(unittest.TestCase):
 
     def setUp(self):
         os.environ['default_infrastructure_backend'] = 'mockdib'
+        settings.reload()
         get_cursor_patcher = patch('factories.get_cursor')
         self.mock_get_cur = get_cursor_patcher.start()
         self.mock_rowcount = PropertyMock(return_value=0)
@@ -5,12 +5,21 @@ from unittest.mock import (
     PropertyMock,
 )
 
+from m2.getters import (
+    list_branches,
+    list_releases,
+    list_services,
+)
+from m2.handlers import handle_build
+from db import m2_get_cursor
 from getters import (
     get_iteration,
     make_getter,
     get_config,
     get_env,
 )
+from testdb import start_postgres
+
 
 class GettersTestCase(unittest.TestCase):
     """ functions that get objects """
@@ -193,3 +202,71 @@ class GettersTestCase(unittest.TestCase):
 
     def test_can_pass(self):
         self.assertTrue(True)
+
+
+class M2ListIntegrationCase(unittest.TestCase):
+    """ the read api pages newest first by keyset """
+
+    def setUp(self):
+        self.pg = start_postgres()
+
+        for n in range(7):
+            handle_build('s', 'b{}'.format(n % 2), 'mb', 'c{}'.format(n),
+                         'i{}'.format(n))
+        handle_build('other', 'b0', 'mb2', 'c', 'i')
+
+    def tearDown(self):
+        self.pg.stop()
+
+    def test_pages(self):
+        """ following next visits every release once, newest first """
+        seen = []
+        after = None
+        while True:
+            page = list_releases('s', after=after, limit=3)
+            self.assertLessEqual(len(page['items']), 3)
+            seen += page['items']
+            after = page['next']
+            if after is None:
+                break
+
+        self.assertEqual([r['commit_hash'] for r in seen],
+                         ['c{}'.format(n) for n in reversed(range(7))])
+        self.assertEqual(len(set(r['release_id'] for r in seen)), 7)
+
+    def test_lists(self):
+        services = list_services()
+        self.assertEqual([s['service_name'] for s in services['items']],
+                         ['other', 's'])
+        self.assertIsNone(services['next'])
+
+        branches = list_branches('s')['items']
+        self.assertEqual(sorted(b['branch_name'] for b in branches),
+                         ['b0', 'b1'])
+        self.assertIsNone(branches[0]['deleted_dt'])
+
+    def test_versions(self):
+        """ a list's version changes with its rows """
+        branches = list_branches.version('s')
+        releases = list_releases.version('s')
+        self.assertEqual(list_branches.version('s'), branches)
+
+        # a new release of an existing branch moves its head
+        handle_build('s', 'b0', 'mb', 'c7', 'i7')
+        self.assertNotEqual(list_branches.version('s'), branches)
+        self.assertNotEqual(list_releases.version('s'), releases)
+        branches = list_branches.version('s')
+
+        cursor = m2_get_cursor()
+        cursor.execute("update branch set deleted_dt = now()"
+                       " where branch_name = 'b1'")
+        cursor.close()
+        self.assertNotEqual(list_branches.version('s'), branches)
+
+        services = list_services.version()
+        handle_build('new', 'b0', 'mb3', 'c', 'i')
+        self.assertNotEqual(list_services.version(), services)
+
+    def test_bad_token(self):
+        with self.assertRaises(ValueError):
+            list_releases('s', after='not-a-token')
@@ -13,33 +13,16 @@ from hypothesis.strategies import (
 )
 from m2.handlers import (
     handle_build,
+    handle_builds,
     save,
 )
 import os
 import psycopg2
-import testing.postgresql
+import settings
+import sqlstats
 import unittest
 from unittest.mock import patch
-
-def pg_init(pg):
-    conn = psycopg2.connect(**pg.dsn())
-    cursor = conn.cursor()
-    with open('service/schema-2.1.2.sql', 'r') as schema:
-        cursor.execute(schema.read())
-    conn.commit()
-    cursor.close()
-    conn.close()
-
-# Generate Postgresql class which shares the generated database
-Postgresql = testing.postgresql.PostgresqlFactory(
-    cache_initialized_db=True,
-    on_initialized=pg_init,
-)
-
-
-def tearDownModule():
-    # clear cached database at end of tests
-    Postgresql.clear_cache()
+from testdb import start_postgres
 
 
 class M2HandlersIntegrationCase(unittest.TestCase):
@@ -68,11 +51,7 @@ class M2HandlersIntegrationCase(unittest.TestCase):
 
         """
 
-        self.pg = Postgresql()
-        os.environ['pg-host'] = self.pg.dsn()['host']
-        os.environ['pg-port'] = str(self.pg.dsn()['port'])
-        os.environ['pg-database'] = self.pg.dsn()['database']
-        os.environ['pg-user'] = self.pg.dsn()['user']
+        self.pg = start_postgres()
 
         # set up a few builds for context
         previous_builds = [
@@ -418,6 +397,118 @@ class M2HandlersIntegrationCase(unittest.TestCase):
         self.assertTrue(True)
 
 
+class M2BatchBuildIntegrationCase(unittest.TestCase):
+    """ many builds are saved in one transaction with set based inserts """
+
+    def setUp(self):
+        os.environ['v2_model'] = 'false'
+        self.pg = start_postgres()
+
+        # an existing branch released with a config of its own
+        handle_build('s', 'b', 'mb', 'c', 'i')
+        self.query(
+            """
+            with new_config as (
+                insert into config (key_value_pairs)
+                     values ('A => a')
+                  returning config_id
+            )
+            update release set config_id = (select config_id from new_config)
+            """,
+            (),
+        )
+
+    def tearDown(self):
+        self.pg.stop()
+
+    def query(self, sql, values):
+        """ execute a query and return the results """
+        conn = psycopg2.connect(**self.pg.dsn())
+        cursor = conn.cursor()
+        cursor.execute(sql, values)
+        try:
+            results = cursor.fetchall()
+        except:
+            results = []
+        conn.commit()
+        cursor.close()
+        conn.close()
+        return results
+
+    def builds(self, *args):
+        return [dict(zip(['service_name',
+                          'branch_name',
+                          'merge_base_commit_hash',
+                          'commit_hash',
+                          'image_name'], build))
+                for build in args]
+
+    def test_handle_builds(self):
+        """ each build gets a release with the config handle_build picks """
+        builds = self.builds(
+            ('s', 'b', 'mb', 'c2', 'i2'),     # existing branch
+            ('s', 'b3', 'c', 'c3', 'i3'),     # merge base has a release
+            ('s2', 'bx', 'mx', 'cx', 'ix'),   # new service
+            ('s2', 'bx', 'mx', 'cx', 'ix'),   # retried in the same batch
+        )
+
+        # run SUT
+        saved = handle_builds(builds)
+
+        release_ids = [build.pop('release_id') for build in saved]
+        self.assertEqual(saved, builds)
+        self.assertEqual(len(set(release_ids)), 4)
+
+        selected = dict(self.query(
+            """
+            select release_id, key_value_pairs::text
+              from release
+              join config using (config_id)
+             where release_id = any(%s)
+            """,
+            (release_ids,),
+        ))
+        self.assertEqual(
+            [selected[release_id] for release_id in release_ids],
+            ['"A"=>"a"', '"A"=>"a"', '', ''],
+        )
+
+        # the duplicate build shares its iteration
+        self.assertEqual(self.query(
+            "select count(*) from iteration where commit_hash = 'cx'", ()),
+            [(1,)],
+        )
+        self.assertEqual(self.query("select count(*) from service", ()),
+                         [(2,)])
+
+    def test_statements_independent_of_batch_size(self):
+        """ a batch costs the same number of statements at any size """
+        counts = []
+        for size in [2, 20]:
+            stats = sqlstats.begin_request()
+            handle_builds(self.builds(*[
+                ('svc{}'.format(n), 'br', 'mb{}'.format(size), 'c', 'i')
+                for n in range(size)
+            ]))
+            counts.append(stats.count)
+        self.assertEqual(counts[0], counts[1])
+
+    def test_handle_builds_deploys_one_batch(self):
+        os.environ['v2_model'] = 'run'
+        settings.reload()
+        with patch('m2.handlers.backend') as mock_backend:
+            saved = handle_builds(self.builds(
+                ('s', 'b', 'mb', 'c2', 'i2'),
+                ('s', 'b2', 'mb', 'c3', 'i3'),
+            ))
+        mock_backend.assert_called_once_with('gce')
+        mock_backend.return_value.m2_batch_runner.assert_called_once_with(
+            [build['release_id'] for build in saved], "UPDATE")
+
+    def test_no_builds(self):
+        self.assertEqual(handle_builds([]), [])
+
+
 class HandlersTestCase(unittest.TestCase):
     """ test the web handlers """
 
@@ -487,9 +578,9 @@ class HandlersTestCase(unittest.TestCase):
         )
         release_in_auto_pipes_patcher = patch(
             "handlers.idem_release_in_automatic_pipelines",
-            return_value=[12345],
+            return_value=[(12345,), (12346,)],
         )
-        runner_patcher = patch("handlers.runner")
+        runner_patcher = patch("handlers.batch_runner")
         mock_get_iteration = get_iteration_patcher.start()
         mock_set_iteration = set_iteration_patcher.start()
         mock_release_in_auto_pipes = release_in_auto_pipes_patcher.start()
@@ -509,9 +600,8 @@ class HandlersTestCase(unittest.TestCase):
         mock_release_in_auto_pipes.assert_called_once_with(
             'mock-iteration-id',
         )
-        mock_runner.assert_called_once_with(
-            {"release_id": 12345, "action": "UPDATE"}
-        )
+        # every release is deployed in a single batch
+        mock_runner.assert_called_once_with([12345, 12346], "UPDATE")
 
     def test_can_pass(self):
         self.assertTrue(True)
@@ -0,0 +1,137 @@
+import os
+import unittest
+
+import psycopg2
+
+from m2.getters import list_branches
+from m2.handlers import handle_build, handle_builds
+from m2.heads import rebuild
+from testdb import start_postgres
+
+
+class BranchHeadIntegrationCase(unittest.TestCase):
+    """ every release moves its branch's head in the same transaction """
+
+    def setUp(self):
+        os.environ['v2_model'] = 'false'
+        self.pg = start_postgres()
+
+        handle_build('s', 'm', 'mb', 'mb', 'i0')
+        handle_build('s', 'b', 'mb', 'c', 'i')
+        handle_build('s', 'b', 'mb', 'c2', 'i2')
+
+    def tearDown(self):
+        self.pg.stop()
+
+    def query(self, sql, values=()):
+        """ execute a query and return the results """
+        conn = psycopg2.connect(**self.pg.dsn())
+        cursor = conn.cursor()
+        cursor.execute(sql, values)
+        try:
+            results = cursor.fetchall()
+        except:
+            results = []
+        conn.commit()
+        cursor.close()
+        conn.close()
+        return results
+
+    def heads(self):
+        return self.query(
+            """
+            select branch_name, commit_hash, release_id, config_id
+              from branch_head
+              join branch using (branch_id)
+              join iteration using (iteration_id)
+             order by branch_name
+            """,
+        )
+
+    def release_config(self, commit_hash):
+        return self.query(
+            """
+            select key_value_pairs::text
+              from release
+              join iteration using (iteration_id)
+              join config using (config_id)
+             where commit_hash = %s
+            """,
+            (commit_hash,),
+        )
+
+    def test_head_follows_releases(self):
+        self.assertEqual(
+            [(b, c) for b, c, r, cf in self.heads()],
+            [('b', 'c2'), ('m', 'mb')],
+        )
+
+        # a new config on the head release is the head's config
+        self.query(
+            """
+            with new_config as (
+                insert into config (key_value_pairs)
+                     values ('B => b')
+                  returning config_id
+            )
+            update release
+               set config_id = (select config_id from new_config)
+             where iteration_id = (select iteration_id
+                                     from iteration
+                                    where commit_hash = 'c2')
+            """,
+        )
+        handle_build('s', 'b', 'mb', 'c3', 'i3')
+        self.assertEqual(self.release_config('c3'), [('"B"=>"b"',)])
+
+        # releasing an older iteration again does not move the head back
+        self.query(
+            """
+            insert into release (iteration_id, config_id)
+            select iteration_id, config_id
+              from release join iteration using (iteration_id)
+             where commit_hash = 'c'
+            """,
+        )
+        self.assertEqual(self.heads()[0][1], 'c3')
+
+    def test_new_branch_uses_merge_base(self):
+        self.query(
+            """
+            with new_config as (
+                insert into config (key_value_pairs)
+                     values ('A => a')
+                  returning config_id
+            )
+            update release
+               set config_id = (select config_id from new_config)
+             where iteration_id = (select iteration_id
+                                     from iteration
+                                    where commit_hash = 'c')
+            """,
+        )
+        handle_build('s', 'b2', 'c', 'c4', 'i4')
+        handle_builds([{
+            'service_name': 's',
+            'branch_name': 'b3',
+            'merge_base_commit_hash': 'c',
+            'commit_hash': 'c5',
+            'image_name': 'i5',
+        }])
+        self.assertEqual(self.release_config('c4'), [('"A"=>"a"',)])
+        self.assertEqual(self.release_config('c5'), [('"A"=>"a"',)])
+
+    def test_rebuild(self):
+        heads = self.heads()
+        self.query("delete from branch_head")
+
+        # run SUT
+        self.assertEqual(rebuild(), 2)
+        self.assertEqual(self.heads(), heads)
+
+    def test_branches_list_heads(self):
+        branches = dict(
+            (b['branch_name'], b) for b in list_branches('s')['items'])
+        self.assertEqual(branches['b']['head_commit_hash'], 'c2')
+        self.assertEqual(branches['b']['head_image_name'], 'i2')
+        self.assertEqual(branches['m']['head_release_id'], 1)
@@ -0,0 +1,229 @@
+import asyncio
+import threading
+import time
+import unittest
+from unittest.mock import (
+    patch,
+    MagicMock,
+)
+
+import bottle
+
+import idempotency
+from idempotency import (
+    answer_once,
+    duplicates,
+    idempotent,
+    request_key,
+    responses,
+)
+from testdb import start_postgres
+
+
+def bind_request(path, token="CI"):
+    """ make path the request bottle is serving """
+    route = MagicMock()
+    route.name = "mock_route"
+    bottle.request.bind({
+        'PATH_INFO': path,
+        'REQUEST_METHOD': 'GET',
+        'HTTP_X_AUTHENTICATED_TOKEN': token,
+        'bottle.route': route,
+    })
+
+
+def duplicate_count():
+    return duplicates.values.get(("mock_route",), 0)
+
+
+class IdempotencyTestCase(unittest.TestCase):
+    """ duplicate webhooks get the original response """
+
+    def setUp(self):
+        responses.clear()
+        get_cursor_patcher = patch("idempotency.m2_get_cursor")
+        self.mock_get_cursor = get_cursor_patcher.start()
+        self.addCleanup(get_cursor_patcher.stop)
+        # nothing stored in postgres
+        self.mock_get_cursor.return_value.fetchone.return_value = None
+
+        self.handler = MagicMock(return_value={'iteration_id': 1})
+        self.idempotent_handler = idempotent(self.handler)
+
+    def test_request_key(self):
+        """ equivalent paths share a key, principals do not """
+        self.assertEqual(request_key("CI", "/build/abc/img"),
+                         request_key("CI", "//build/abc//img/"))
+        self.assertEqual(request_key("CI", "/build/abc/us.gcr.io%2Fimg"),
+                         request_key("CI", "/build/abc/us.gcr.io/img"))
+        self.assertNotEqual(request_key("CI", "/build/abc/img"),
+                            request_key("other", "/build/abc/img"))
+
+    def test_duplicate_gets_original_response(self):
+        """ the handler runs once and duplicates are counted """
+        before = duplicate_count()
+
+        bind_request("/build/abc/img")
+        first = self.idempotent_handler("abc", "img")
+        bind_request("/build/abc/img/")
+        second = self.idempotent_handler("abc", "img")
+
+        self.assertEqual(first, {'iteration_id': 1})
+        self.assertEqual(second, first)
+        self.handler.assert_called_once_with("abc", "img")
+        self.assertEqual(duplicate_count(), before + 1)
+
+        # the response was stored for other processes, and the memory hit
+        # on the duplicate did not look in postgres
+        self.assertEqual(
+            self.mock_get_cursor.return_value.execute.call_count, 2)
+
+    def test_different_principal(self):
+        bind_request("/build/abc/img", token="CI")
+        self.idempotent_handler("abc", "img")
+        bind_request("/build/abc/img", token="other")
+        self.idempotent_handler("abc", "img")
+        self.assertEqual(self.handler.call_count, 2)
+
+    def test_failure_is_not_remembered(self):
+        """ a retry after a failure runs the handler again """
+        self.handler.side_effect = [ValueError("mock failure"),
+                                    {'iteration_id': 2}]
+        bind_request("/build/abc/img")
+        with self.assertRaises(ValueError):
+            self.idempotent_handler("abc", "img")
+        self.assertEqual(self.idempotent_handler("abc", "img"),
+                         {'iteration_id': 2})
+
+    def test_failure_with_duplicates_waiting(self):
+        """ after a failure one waiting duplicate retries, the rest wait """
+        release = threading.Event()
+        calls = []
+
+        def handler(*args):
+            calls.append(args)
+            if len(calls) == 1:
+                release.wait(5)
+                raise ValueError("mock failure")
+            time.sleep(0.1)
+            return {'iteration_id': 2}
+        idempotent_handler = idempotent(handler)
+
+        results = []
+
+        def call(original=False):
+            bind_request("/build/abc/img")
+            try:
+                results.append(idempotent_handler("abc", "img"))
+            except ValueError:
+                self.assertTrue(original)
+
+        threads = [threading.Thread(target=call, args=(True,))]
+        threads[0].start()
+        time.sleep(0.1)
+        threads += [threading.Thread(target=call) for _ in range(2)]
+        for thread in threads[1:]:
+            thread.start()
+        time.sleep(0.1)
+        release.set()
+        for thread in threads:
+            thread.join(5)
+
+        self.assertEqual(len(calls), 2)
+        self.assertEqual(results, [{'iteration_id': 2}] * 2)
+
+    def test_stored_response(self):
+        """ a response stored by another process is used """
+        self.mock_get_cursor.return_value.fetchone.return_value = (
+            '{"iteration_id": 3}', 60.0)
+        bind_request("/build/abc/img")
+        self.assertEqual(self.idempotent_handler("abc", "img"),
+                         {'iteration_id': 3})
+        self.handler.assert_not_called()
+
+    def test_empty_response(self):
+        """ handlers that return nothing are remembered too """
+        self.handler.return_value = None
+        bind_request("/v1/build/svc/br/base/abc/img")
+        self.assertIsNone(self.idempotent_handler())
+        self.assertEqual(self.idempotent_handler(), "")
+        self.handler.assert_called_once_with()
+
+    def test_disabled(self):
+        with patch("idempotency.ttl", 0):
+            bind_request("/build/abc/img")
+            self.idempotent_handler("abc", "img")
+            self.idempotent_handler("abc", "img")
+        self.assertEqual(self.handler.call_count, 2)
+        self.mock_get_cursor.assert_not_called()
+
+
+class IdempotencyIntegrationCase(unittest.TestCase):
+    """ responses are shared through postgres """
+
+    def setUp(self):
+        self.pg = start_postgres()
+        responses.clear()
+
+    def tearDown(self):
+        self.pg.stop()
+
+    def test_store_and_lookup(self):
+        idempotency.store_response("mock-key", {'iteration_id': 4}, 60)
+        idempotency.store_response("mock-key", {'iteration_id': 5}, 60)
+        idempotency.store_response("mock-expired-key", {}, -1)
+
+        self.assertEqual(idempotency.stored_response("mock-key"),
+                         {'iteration_id': 5})
+        self.assertIsNone(idempotency.stored_response("mock-expired-key"))
+        # found in memory from now on
+        self.assertEqual(responses.get("mock-key"), {'iteration_id': 5})
+
+
+class AnswerOnceTestCase(unittest.IsolatedAsyncioTestCase):
+    """ requests on the event loop are answered once, without aiohttp """
+
+    async def asyncSetUp(self):
+        self.stored = {}
+
+    async def lookup(self, key):
+        return self.stored.get(key)
+
+    async def remember(self, key, response):
+        self.stored[key] = response
+
+    async def test_duplicate_gets_original_response(self):
+        calls = []
+
+        async def handle():
+            calls.append(None)
+            await asyncio.sleep(0.05)
+            return {'iteration_id': 1}
+
+        answers = await asyncio.gather(*[
+            answer_once("key", self.lookup, self.remember, handle)
+            for _ in range(3)])
+
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(answers, [({'iteration_id': 1}, False)] +
+                         [({'iteration_id': 1}, True)] * 2)
+
+    async def test_failure_with_duplicates_waiting(self):
+        """ after a failure one waiting duplicate retries, the rest wait """
+        calls = []
+
+        async def handle():
+            calls.append(None)
+            await asyncio.sleep(0.05)
+            if len(calls) == 1:
+                raise ValueError("mock failure")
+            return {'iteration_id': 2}
+
+        answers = await asyncio.gather(*[
+            answer_once("key", self.lookup, self.remember, handle)
+            for _ in range(3)], return_exceptions=True)
+
+        self.assertEqual(len(calls), 2)
+        self.assertIsInstance(answers[0], ValueError)
+        self.assertEqual(answers[1:], [({'iteration_id': 2}, False),
+                                       ({'iteration_id': 2}, True)])
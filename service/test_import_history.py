@@ -0,0 +1,139 @@
+import io
+import unittest
+from unittest.mock import patch
+
+import psycopg2
+
+from m2 import import_history as importer
+from m2.handlers import handle_build
+from testdb import start_postgres
+
+
+def records(count):
+    """ releases of a few services, with a config change part way """
+    for n in range(count):
+        yield {
+            'service_name': 's{}'.format(n % 3),
+            'branch_name': 'b',
+            'merge_base_commit_hash': 'mb{}'.format(n % 3),
+            'commit_hash': 'c{}'.format(n // 2),
+            'image_name': 'i{}'.format(n // 2),
+            'key_value_pairs': 'A=a\n' if n < count // 2 else 'A="b"\n',
+            'created_dt': '2016-05-09T21:33:{:02d}.000000'.format(n),
+        }
+
+
+class ImportHistoryIntegrationCase(unittest.TestCase):
+    """ history is copied in and merged a chunk at a time """
+
+    def setUp(self):
+        self.pg = start_postgres()
+        self.report = io.StringIO()
+
+    def tearDown(self):
+        self.pg.stop()
+
+    def query(self, sql, values=()):
+        """ execute a query and return the results """
+        conn = psycopg2.connect(**self.pg.dsn())
+        cursor = conn.cursor()
+        cursor.execute(sql, values)
+        results = cursor.fetchall()
+        conn.commit()
+        cursor.close()
+        conn.close()
+        return results
+
+    def test_import(self):
+        """ records become services, branches, iterations and releases """
+        # a branch that already exists is reused
+        handle_build('s0', 'b', 'mb0', 'c0', 'i0')
+
+        merged = importer.import_history(
+            "mock-import", records(12), size=5, report=self.report)
+
+        self.assertEqual(merged, 12)
+        self.assertEqual(self.query("select count(*) from service"), [(3,)])
+        self.assertEqual(self.query("select count(*) from branch"), [(3,)])
+        self.assertEqual(self.query("select count(*) from release"), [(13,)])
+        self.assertEqual(
+            self.query("select count(*) from import_release"), [(0,)])
+        # configs round trip through hstore, quotes and all
+        self.assertEqual(
+            self.query("select key_value_pairs -> 'A' from config"
+                       " where key_value_pairs ? 'A' order by 1"),
+            [('"b"',), ('a',)],
+        )
+        self.assertIn("mock-import finished: 12 lines", self.report.getvalue())
+
+        # running a finished import again does nothing
+        self.assertEqual(importer.import_history(
+            "mock-import", records(12), size=5, report=self.report), 0)
+        self.assertEqual(self.query("select count(*) from release"), [(13,)])
+
+    def test_resume(self):
+        """ an interrupted import carries on after its last merged chunk """
+        merge_chunk = importer.merge_chunk
+        calls = []
+
+        def interrupted(import_name, rows):
+            calls.append(rows[0][1])
+            if len(calls) == 2:
+                raise KeyboardInterrupt()
+            merge_chunk(import_name, rows)
+
+        with patch("m2.import_history.merge_chunk", side_effect=interrupted):
+            with self.assertRaises(KeyboardInterrupt):
+                importer.import_history(
+                    "mock-import", records(12), size=5, report=self.report)
+        self.assertEqual(self.query("select count(*) from release"), [(5,)])
+        self.assertEqual(
+            self.query("select lines_merged, finished_dt is null"
+                       "  from import_progress"),
+            [(5, True)],
+        )
+
+        merged = importer.import_history(
+            "mock-import", records(12), size=5, report=self.report)
+        self.assertEqual(merged, 7)
+        self.assertIn("resuming import mock-import after line 5",
+                      self.report.getvalue())
+        self.assertEqual(self.query("select count(*) from release"), [(12,)])
+
+    def test_same_history_twice(self):
+        """ releases already imported with the same time are skipped """
+        importer.import_history("first", records(4), report=self.report)
+        importer.import_history("second", records(4), report=self.report)
+        self.assertEqual(self.query("select count(*) from release"), [(4,)])
+
+    def test_undated_history_twice(self):
+        """ undated records are deduplicated by iteration and config """
+        def undated():
+            for record in records(4):
+                del record['created_dt']
+                yield record
+            # the same release again, in the same import
+            yield dict(record)
+
+        importer.import_history("first", undated(), report=self.report)
+        self.assertEqual(self.query("select count(*) from release"), [(4,)])
+        importer.import_history("second", undated(), report=self.report)
+        self.assertEqual(self.query("select count(*) from release"), [(4,)])
+
+    def test_csv(self):
+        lines = io.StringIO(
+            "service_name,branch_name,merge_base_commit_hash,commit_hash,"
+            "image_name,key_value_pairs,created_dt\n"
+            "s,b,mb,c,i,,\n"
+            "s,b,mb,c2,i2,\"A=a\nB=b\n\",2016-05-09 21:33:00\n"
+        )
+        importer.import_history("csv", importer.read_csv(lines),
+                                report=self.report)
+        self.assertEqual(
+            self.query("select commit_hash, akeys(key_value_pairs)"
+                       "  from release"
+                       "  join iteration using (iteration_id)"
+                       "  join config using (config_id)"
+                       " order by commit_hash"),
+            [('c', []), ('c2', ['A', 'B'])],
+        )
@@ -0,0 +1,246 @@
+import json
+import os
+import unittest
+from unittest.mock import (
+    patch,
+    MagicMock,
+)
+
+import settings
+from deployment.gce import Cluster, default_cluster
+from deployment.known_secrets import (
+    KnownSecrets,
+    collect_all,
+    start_all,
+)
+
+endpoint = "http://mock8s-host/api/v1/namespaces/default/"
+old_secret = "a" * 64 + "-config-1"
+new_secret = "b" * 64 + "-config-2"
+shared_secret = "c" * 64 + "-config-3"
+
+
+def repcon(name, secret):
+    return {
+        "metadata": {"name": name},
+        "spec": {"template": {"spec": {"volumes": [
+            {"name": "v", "secret": {"secretName": secret}},
+        ]}}},
+    }
+
+
+def secret(name, created="2016-05-01T00:00:00Z", used=None, version="42"):
+    metadata = {"name": name, "creationTimestamp": created,
+                "resourceVersion": version}
+    if used is not None:
+        metadata["annotations"] = {"herd/last-used": used}
+    return {"metadata": metadata}
+
+
+cluster = {
+    "replicationcontrollers": [
+        repcon("live-svc-1", shared_secret),
+        repcon("other-svc-1", shared_secret),
+    ],
+    "secrets": [
+        secret(shared_secret),
+        secret(old_secret),
+        # created moments ago by a deploy that has not made its repcon yet
+        secret(new_secret, created="2016-05-09T21:32:59Z"),
+        secret("default-token-abcde"),
+    ],
+}
+now = 1462829580.0    # 2016-05-09T21:33:00Z
+
+
+class KnownSecretsTestCase(unittest.TestCase):
+    """ the secret cache skips known secrets and collects unused ones """
+
+    def setUp(self):
+        os.environ['kubeproxy'] = "mock8s-host"
+        settings.reload()
+
+        requests_patcher = patch("deployment.gce.requests")
+        self.mock_requests = requests_patcher.start()
+        self.addCleanup(requests_patcher.stop)
+
+        def get(uri, **kwargs):
+            response = MagicMock()
+            response.json.return_value = {
+                "metadata": {"resourceVersion": "100"},
+                "items": cluster[uri.rsplit('/', 1)[1]],
+            }
+            return response
+        self.mock_requests.get.side_effect = get
+        self.mock_requests.delete.return_value.status_code = 200
+        self.mock_requests.post.return_value.status_code = 201
+
+        self.known = KnownSecrets(default_cluster())
+        for resource in self.known.resources:
+            self.known.seed(resource)
+
+    def test_seed(self):
+        """ one list of each, keeping only herd's config secrets """
+        self.assertEqual(self.mock_requests.get.call_count, 2)
+        self.assertEqual(
+            set(self.known.secrets),
+            {shared_secret, old_secret, new_secret},
+        )
+        self.assertEqual(self.known.references(), {
+            shared_secret: 2,
+            old_secret: 0,
+            new_secret: 0,
+        })
+        self.assertEqual(self.known.versions["secrets"], "100")
+
+    def test_ensure_known(self):
+        """ a secret the cluster has is marked used, not posted again """
+        self.mock_requests.patch.return_value.status_code = 200
+        self.mock_requests.patch.return_value.json.return_value = secret(
+            old_secret, used="2016-05-09T21:33:00Z", version="43")
+
+        self.assertFalse(self.known.ensure(secret(old_secret)))
+        self.mock_requests.post.assert_not_called()
+        self.assertEqual(self.mock_requests.patch.call_args[0][0],
+                         endpoint + "secrets/" + old_secret)
+        self.assertIn("herd/last-used",
+                      self.mock_requests.patch.call_args[1]["data"])
+        self.assertEqual(self.known.secrets[old_secret], now)
+        self.assertEqual(self.known.secret_versions[old_secret], "43")
+
+        # a mark seen moments ago is fresh enough
+        with patch("deployment.known_secrets.time.time",
+                   return_value=now + 10):
+            self.assertFalse(self.known.ensure(secret(old_secret)))
+        self.assertEqual(self.mock_requests.patch.call_count, 1)
+
+    def test_ensure_collected_elsewhere(self):
+        """ a known secret another process deleted is posted again """
+        self.mock_requests.patch.return_value.status_code = 404
+        self.assertTrue(self.known.ensure(secret(old_secret)))
+        self.assertEqual(self.mock_requests.post.call_args[0][0],
+                         endpoint + "secrets")
+
+    def test_ensure_unknown(self):
+        """ a new secret is posted, and known from then on """
+        name = "d" * 64 + "-config-4"
+        self.assertTrue(self.known.ensure(secret(name)))
+        self.assertEqual(self.mock_requests.post.call_args[0][0],
+                         endpoint + "secrets")
+        self.assertIn(name, self.known)
+        self.assertFalse(self.known.ensure(secret(name)))
+        self.assertEqual(self.mock_requests.post.call_count, 1)
+
+    def test_ensure_failed_post(self):
+        """ a secret that failed to post isn't known, and fails the deploy """
+        name = "d" * 64 + "-config-4"
+        self.mock_requests.post.return_value.status_code = 403
+        with self.assertRaises(IOError):
+            self.known.ensure(secret(name))
+        self.assertNotIn(name, self.known)
+
+        # one another process posted first is there all the same
+        self.mock_requests.post.return_value.status_code = 409
+        self.assertTrue(self.known.ensure(secret(name)))
+        self.assertIn(name, self.known)
+
+    def test_watch(self):
+        """ watch events keep the secrets and mounts current """
+        events = [
+            {"type": "DELETED",
+             "object": repcon("other-svc-1", shared_secret)},
+            {"type": "ADDED",
+             "object": repcon("live-svc-2", old_secret)},
+        ]
+        response = MagicMock()
+        response.iter_lines.return_value = [
+            json.dumps(e).encode() for e in events]
+        self.mock_requests.get.side_effect = None
+        self.mock_requests.get.return_value = response
+
+        self.known.watch_once("replicationcontrollers", timeout=1)
+        self.assertEqual(
+            self.mock_requests.get.call_args[0][0],
+            "http://mock8s-host/api/v1/watch/namespaces/default/"
+            "replicationcontrollers",
+        )
+        self.assertEqual(
+            self.mock_requests.get.call_args[1]["params"]["resourceVersion"],
+            "100",
+        )
+        self.assertEqual(self.known.references(), {
+            shared_secret: 1,
+            old_secret: 1,
+            new_secret: 0,
+        })
+
+    def test_watch_expired(self):
+        """ a watch too old to resume from lists again """
+        response = MagicMock()
+        response.iter_lines.return_value = [json.dumps({
+            "type": "ERROR",
+            "object": {"code": 410},
+        }).encode()]
+        get = self.mock_requests.get.side_effect
+        self.mock_requests.get.side_effect = \
+            lambda uri, **kwargs: response if "/watch/" in uri else get(uri)
+
+        self.known.watch_once("secrets", timeout=1)
+        self.assertEqual(self.mock_requests.get.call_count, 4)
+        response.close.assert_called_once_with()
+
+    def test_unreferenced(self):
+        """ unmounted secrets go once they are past the grace period """
+        self.assertEqual(self.known.unreferenced(60, now), [old_secret])
+        # marked used by a deploy anywhere, seen through the watch
+        with self.known.lock:
+            self.known.apply("secrets", "MODIFIED", secret(
+                old_secret, used="2016-05-09T21:32:30Z"))
+        self.assertEqual(self.known.unreferenced(60, now), [])
+
+    def test_collect_in_batches(self):
+        """ unreferenced secrets are deleted in batches """
+        self.known.secrets["d" * 64 + "-config-4"] = 0
+        with patch("deployment.known_secrets.time.sleep") as mock_sleep:
+            deleted = self.known.collect(
+                grace=60, batch_size=1, batch_interval=5)
+        self.assertEqual(deleted, 3)
+        self.assertEqual(self.mock_requests.delete.call_args_list[0][0][0],
+                         endpoint + "secrets/" + old_secret)
+        # a secret marked used since the cache saw it is kept
+        self.assertEqual(
+            self.mock_requests.delete.call_args_list[0][1]["json"]
+                ["preconditions"],
+            {"resourceVersion": "42"},
+        )
+        self.assertEqual(mock_sleep.call_count, 2)
+        self.assertEqual(set(self.known.secrets), {shared_secret})
+
+    def test_collect_all(self):
+        """ every cluster is collected, whatever happens in the others """
+        east = Cluster("east", "east-proxy", "mock-pass")
+        caches = {"default": MagicMock(), "east": MagicMock()}
+        caches["default"].collect.side_effect = ValueError("mock failure")
+        caches["east"].collect.return_value = 2
+        with patch("deployment.known_secrets.all_clusters",
+                   return_value=[default_cluster(), east]), \
+                patch("deployment.known_secrets.known_secrets",
+                      side_effect=lambda cluster: caches[cluster.name]):
+            self.assertEqual(collect_all(), {"east": 2})
+        caches["default"].collect.assert_called_once_with()
+
+    def test_start_all(self):
+        """ every cluster's cache is seeded, whatever happens in the others """
+        east = Cluster("east", "east-proxy", "mock-pass")
+        started = []
+
+        def known_secrets(cluster):
+            started.append(cluster.name)
+            if cluster.name == "default":
+                raise ConnectionError("mock failure")
+        with patch("deployment.known_secrets.all_clusters",
+                   return_value=[default_cluster(), east]), \
+                patch("deployment.known_secrets.known_secrets",
+                      side_effect=known_secrets):
+            start_all()
+        self.assertEqual(started, ["default", "east"])
@@ -0,0 +1,73 @@
+import unittest
+
+from metrics import (
+    Counter,
+    Gauge,
+    Histogram,
+    Registry,
+)
+
+
+class MetricsTestCase(unittest.TestCase):
+    """ in process metrics in the prometheus text format """
+
+    def setUp(self):
+        self.registry = Registry()
+
+    def test_counter(self):
+        """ counters add up per label value """
+        counter = Counter("mock_total", "Mock things", ["kind"],
+                          registry=self.registry)
+        counter.inc(kind="a")
+        counter.inc(2, kind="a")
+        counter.inc(kind='b"\n')
+
+        self.assertEqual(self.registry.render(), "\n".join([
+            "# HELP mock_total Mock things",
+            "# TYPE mock_total counter",
+            'mock_total{kind="a"} 3',
+            'mock_total{kind="b\\"\\n"} 1',
+        ]) + "\n")
+
+    def test_unlabelled_gauge(self):
+        """ unlabelled metrics are scraped before they are first used """
+        gauge = Gauge("mock_depth", "Mock depth", registry=self.registry)
+        self.assertIn("mock_depth 0\n", self.registry.render())
+
+        gauge.inc(3)
+        gauge.dec()
+        self.assertIn("mock_depth 2\n", self.registry.render())
+
+    def test_histogram(self):
+        """ histograms count observations into cumulative buckets """
+        histogram = Histogram("mock_seconds", "Mock time", ["stage"],
+                              buckets=(0.1, 1.0), registry=self.registry)
+        histogram.observe(0.05, stage="x")
+        histogram.observe(0.5, stage="x")
+        histogram.observe(5.0, stage="x")
+
+        self.assertEqual(histogram.samples(), [
+            'mock_seconds_bucket{stage="x",le="0.1"} 1',
+            'mock_seconds_bucket{stage="x",le="1.0"} 2',
+            'mock_seconds_bucket{stage="x",le="+Inf"} 3',
+            'mock_seconds_sum{stage="x"} 5.55',
+            'mock_seconds_count{stage="x"} 3',
+        ])
+
+    def test_histogram_time(self):
+        """ time observes the duration of a with block """
+        histogram = Histogram("mock_seconds", "Mock time",
+                              registry=self.registry)
+        with histogram.time():
+            pass
+        self.assertIn("mock_seconds_count 1", histogram.samples())
+
+    def test_wrong_labels(self):
+        """ using the wrong labels should fail loudly """
+        counter = Counter("mock_total", "Mock things", ["kind"],
+                          registry=self.registry)
+        with self.assertRaises(ValueError):
+            counter.inc(verb="x")
+
+    def test_can_pass(self):
+        self.assertTrue(True)
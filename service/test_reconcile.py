@@ -0,0 +1,170 @@
+import os
+import unittest
+from unittest.mock import (
+    patch,
+    MagicMock,
+)
+
+import settings
+from deployment.gce import Cluster, default_cluster
+from deployment.reconcile import (
+    find_orphans,
+    reconcile,
+)
+
+endpoint = "http://mock8s-host/api/v1/namespaces/default/"
+old_secret = "a" * 64 + "-config-1"
+new_secret = "b" * 64 + "-config-2"
+shared_secret = "c" * 64 + "-config-3"
+reused_secret = "d" * 64 + "-config-4"
+
+
+def repcon(service, branch, secret):
+    return {
+        "metadata": {
+            "name": "{}-{}".format(branch, service),
+            "labels": {"service": service, "branch": branch},
+        },
+        "spec": {"template": {"spec": {"volumes": [
+            {"name": "v", "secret": {"secretName": secret}},
+        ]}}},
+    }
+
+
+def service(name, service_name, branch):
+    return {
+        "metadata": {"name": name},
+        "spec": {"selector": {"service": service_name, "branch": branch}},
+    }
+
+
+def secret(name, created="2016-05-01T00:00:00Z", used=None):
+    metadata = {"name": name, "creationTimestamp": created,
+                "resourceVersion": "42"}
+    if used is not None:
+        metadata["annotations"] = {"herd/last-used": used}
+    return {"metadata": metadata}
+
+
+cluster = {
+    "replicationcontrollers": [
+        repcon("svc", "live", shared_secret),
+        repcon("svc", "gone", shared_secret),
+        repcon("svc", "gone", old_secret),
+    ],
+    "services": [
+        service("svc-live", "svc", "live"),
+        service("svc-gone", "svc", "gone"),
+        # not one of herd's
+        {"metadata": {"name": "kubernetes"}, "spec": {}},
+    ],
+    "secrets": [
+        secret(shared_secret),
+        secret(old_secret),
+        # created moments ago by a deploy that has not made its repcon yet
+        secret(new_secret, created="2016-05-09T21:32:59Z"),
+        secret("default-token-abcde"),
+    ],
+}
+now = 1462829580.0    # 2016-05-09T21:33:00Z
+
+
+class ReconcileTestCase(unittest.TestCase):
+    """ the reconciler deletes objects for branches that are gone """
+
+    def setUp(self):
+        os.environ['kubeproxy'] = "mock8s-host"
+        settings.reload()
+
+        clusters_patcher = patch("deployment.reconcile.all_clusters",
+                                 side_effect=lambda: [default_cluster()])
+        clusters_patcher.start()
+        self.addCleanup(clusters_patcher.stop)
+
+        live_patcher = patch("deployment.reconcile.live_branches",
+                             return_value={("svc", "live")})
+        self.mock_live = live_patcher.start()
+        self.addCleanup(live_patcher.stop)
+
+        requests_patcher = patch("deployment.gce.requests")
+        self.mock_requests = requests_patcher.start()
+        self.addCleanup(requests_patcher.stop)
+
+        def get(uri, **kwargs):
+            response = MagicMock()
+            response.json.return_value = {
+                "items": cluster[uri.rsplit('/', 1)[1]],
+            }
+            return response
+        self.mock_requests.get.side_effect = get
+        self.mock_requests.delete.return_value.status_code = 200
+
+    def test_find_orphans(self):
+        deletes = find_orphans(
+            {("svc", "live")},
+            cluster["replicationcontrollers"],
+            cluster["services"],
+            cluster["secrets"] + [
+                # old, but just reused by a deploy that has scaled down its
+                # repcon and not yet made the new one
+                secret(reused_secret, used="2016-05-09T21:32:59Z"),
+            ],
+            grace=60,
+            now=now,
+        )
+        self.assertEqual([(kind, uri) for kind, uri, kwargs in deletes], [
+            ("replicationcontrollers", endpoint + "replicationcontrollers"),
+            ("services", endpoint + "services/svc-gone"),
+            ("secrets", endpoint + "secrets/" + old_secret),
+        ])
+        self.assertEqual(deletes[0][2]["params"],
+                         {"labelSelector": "service=svc,branch=gone"})
+        # a deploy marking the secret after it was listed keeps it
+        self.assertEqual(deletes[2][2]["json"]["preconditions"],
+                         {"resourceVersion": "42"})
+
+    def test_dry_run(self):
+        """ a dry run only reports """
+        found = reconcile(dry_run=True)
+        self.assertEqual(found, {
+            "replicationcontrollers": 1,
+            "services": 1,
+            "secrets": 2,
+        })
+        # one list per kind
+        self.assertEqual(self.mock_requests.get.call_count, 3)
+        self.mock_requests.delete.assert_not_called()
+
+    def test_delete_in_batches(self):
+        """ orphans are deleted in batches with a pause between them """
+        with patch("deployment.reconcile.time.sleep") as mock_sleep:
+            deleted = reconcile(dry_run=False, batch_size=2, batch_interval=5)
+        self.assertEqual(deleted, {
+            "replicationcontrollers": 1,
+            "services": 1,
+            "secrets": 2,
+        })
+        self.assertEqual(self.mock_requests.delete.call_count, 4)
+        mock_sleep.assert_called_once_with(5)
+
+    def test_every_cluster(self):
+        """ each cluster's orphans are deleted in that cluster """
+        east = Cluster("east", "east-proxy", "mock-pass")
+        deleted = reconcile(dry_run=False,
+                            targets=[default_cluster(), east])
+        self.assertEqual(deleted, {
+            "replicationcontrollers": 2,
+            "services": 2,
+            "secrets": 4,
+        })
+        self.assertEqual(self.mock_requests.get.call_count, 6)
+        self.mock_requests.delete.assert_any_call(
+            "http://east-proxy/api/v1/namespaces/default/services/svc-gone")
+        self.mock_requests.delete.assert_any_call(
+            endpoint + "services/svc-gone")
+
+    def test_no_live_branches(self):
+        """ an empty database is more likely broken, so nothing is deleted """
+        self.mock_live.return_value = set()
+        reconcile(dry_run=False)
+        self.mock_requests.delete.assert_not_called()
@@ -0,0 +1,224 @@
+import json
+import os
+import unittest
+from unittest.mock import patch
+
+import bottle
+import psycopg2
+
+import release_status
+import routes  # registers the routes on the default app
+import settings
+from deployment.gce import stage_recorder, update
+from release_status import Broker, sse
+from testdb import start_postgres
+
+
+class BrokerTestCase(unittest.TestCase):
+
+    def test_fan_out(self):
+        broker = Broker()
+        first = broker.subscribe(1)
+        second = broker.subscribe(1)
+        other = broker.subscribe(2)
+
+        broker.publish(1, {'stage': 'rendered'})
+
+        self.assertEqual(first.get_nowait(), {'stage': 'rendered'})
+        self.assertEqual(second.get_nowait(), {'stage': 'rendered'})
+        self.assertTrue(other.empty())
+
+        broker.unsubscribe(1, first)
+        broker.publish(1, {'stage': 'failed'})
+        self.assertTrue(first.empty())
+        self.assertEqual(second.get_nowait(), {'stage': 'failed'})
+
+    def test_slow_subscriber(self):
+        """ a full subscriber misses events rather than blocking others """
+        broker = Broker(maxsize=1)
+        slow = broker.subscribe(1)
+        broker.publish(1, {'stage': 'rendered'})
+        broker.publish(1, {'stage': 'service_applied'})
+        self.assertEqual(slow.get_nowait(), {'stage': 'rendered'})
+        self.assertTrue(slow.empty())
+
+    def test_sse(self):
+        self.assertEqual(
+            sse({'stage': 'rendered', 'release_id': 3}),
+            b'event: rendered\ndata: {"release_id": 3, "stage": "rendered"}'
+            b'\n\n',
+        )
+
+
+class StreamSlotTestCase(unittest.TestCase):
+    """ each process serves a bounded number of event streams """
+
+    def setUp(self):
+        for key in ['sse_max_streams', 'server_mode', 'server_workers']:
+            os.environ.pop(key, None)
+        settings.reload()
+
+    def tearDown(self):
+        self.setUp()
+
+    def test_max_streams(self):
+        # wsgiref's one thread can't be given to a stream
+        self.assertEqual(release_status.max_streams(), 0)
+
+        os.environ['server_mode'] = 'threaded'
+        os.environ['server_workers'] = '16'
+        settings.reload()
+        self.assertEqual(release_status.max_streams(), 4)
+
+        os.environ['server_mode'] = 'async'
+        settings.reload()
+        self.assertEqual(release_status.max_streams(), 4)
+
+        os.environ['sse_max_streams'] = '2'
+        settings.reload()
+        self.assertEqual(release_status.max_streams(), 2)
+
+    def test_stream_slot(self):
+        os.environ['sse_max_streams'] = '1'
+        settings.reload()
+        with release_status.stream_slot():
+            with self.assertRaises(release_status.TooManyStreams):
+                with release_status.stream_slot():
+                    pass
+        # the slot is free again
+        with release_status.stream_slot():
+            pass
+
+    def test_route_refuses_streams(self):
+        """ past the limit the events route answers 503 """
+        statuses = []
+        body = bottle.default_app()({
+            'REQUEST_METHOD': 'GET',
+            'PATH_INFO': '/v1/releases/5/events',
+            'HTTP_X_AUTHENTICATED_TOKEN': 'CI',
+        }, lambda status, headers, exc_info=None: statuses.append(
+            (status, dict(headers))))
+        self.assertEqual(statuses[0][0], '503 Service Unavailable')
+        self.assertIn('Retry-After', statuses[0][1])
+        self.assertIn(b'already serving 0 event streams', b''.join(body))
+
+
+class ReleaseStatusIntegrationCase(unittest.TestCase):
+    """ deploy stages reach subscribers through one listener """
+
+    def setUp(self):
+        os.environ['kubeproxy'] = "mock8s-host"
+        os.environ['deploy_ready_checks'] = '2'
+        # recorded deploys are the 2.x model's, and lock in its database
+        os.environ['v2_model'] = 'run'
+        self.pg = start_postgres()
+
+        requests_patcher = patch("deployment.gce.requests")
+        self.mock_requests = requests_patcher.start()
+        self.mock_requests.get.return_value.json.return_value = {
+            "items": [],
+            "spec": {"replicas": 1},
+            "status": {"readyReplicas": 1},
+        }
+
+    def tearDown(self):
+        release_status.stop_listening()
+        patch.stopall()
+        self.pg.stop()
+        del os.environ['v2_model']
+
+    def query(self, sql, values=()):
+        """ execute a query and return the results """
+        conn = psycopg2.connect(**self.pg.dsn())
+        cursor = conn.cursor()
+        cursor.execute(sql, values)
+        results = cursor.fetchall()
+        conn.commit()
+        cursor.close()
+        conn.close()
+        return results
+
+    def deploy(self, release_id):
+        update(("svc", "br", 7, "a=b\n", "abc1234", "img"),
+               stage_recorder(release_id))
+
+    def test_update_records_stages(self):
+        with patch("release_status.record",
+                   wraps=release_status.record) as mock_record:
+            self.deploy(5)
+        self.assertEqual(
+            [c[0][2] for c in mock_record.call_args_list],
+            release_status.stages,
+        )
+        self.assertEqual(
+            self.query("select release_id, stage from release_status"),
+            [(5, 'repcon_ready')],
+        )
+
+    def test_update_records_failure(self):
+        self.mock_requests.post.side_effect = IOError("k8s is down")
+        with self.assertRaises(IOError):
+            self.deploy(5)
+        self.assertEqual(
+            self.query("select stage, detail from release_status"),
+            [('failed', 'k8s is down')],
+        )
+
+    def test_not_ready(self):
+        self.mock_requests.get.return_value.json.return_value = {
+            "items": [],
+            "spec": {"replicas": 1},
+            "status": {"replicas": 1},
+        }
+        self.deploy(5)
+        self.assertEqual(
+            self.query("select stage, detail from release_status"),
+            [('repcon_not_ready', 'not ready after 2 checks')],
+        )
+
+    def test_events(self):
+        """ a subscriber gets the current stage, then each new one """
+        stage_recorder(5)("rendered")
+        stream = release_status.events(5, keepalive=0.1, max_seconds=10)
+
+        first = next(stream)
+        self.assertTrue(first.startswith(b'event: rendered\n'))
+
+        # from another connection, as a deploy would
+        record_stage = stage_recorder(5)
+        record_stage("service_applied")
+        record_stage("repcon_ready")
+        # no other release's stages
+        stage_recorder(6)("failed")
+
+        events = [e for e in stream if not e.startswith(b':')]
+        self.assertEqual(
+            [json.loads(e.decode().split('data: ')[1])['stage']
+             for e in events],
+            ["service_applied", "repcon_ready"],
+        )
+        self.assertEqual(release_status.broker.subscribers, {})
+
+    def test_events_across_reconnect(self):
+        """ stages recorded while the listener reconnects still arrive """
+        stage_recorder(5)("rendered")
+        stream = release_status.events(5, keepalive=0.1, max_seconds=10)
+        self.assertTrue(next(stream).startswith(b'event: rendered\n'))
+
+        # drop the listener's connection, and finish while it's away
+        self.query("select pg_terminate_backend(pid)"
+                   "  from pg_stat_activity where query like 'listen %%'")
+        stage_recorder(5)("repcon_ready")
+
+        events = [e for e in stream if not e.startswith(b':')]
+        self.assertEqual(len(events), 1)
+        self.assertTrue(events[0].startswith(b'event: repcon_ready\n'))
+
+    def test_events_of_finished_release(self):
+        stage_recorder(5)("repcon_ready")
+        self.assertEqual(
+            len(list(release_status.events(5, max_seconds=10))), 1)
+
+    def test_events_time_out(self):
+        stream = release_status.events(5, keepalive=0.1, max_seconds=0.3)
+        self.assertEqual(set(stream), {b": keepalive\n\n"})
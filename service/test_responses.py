@@ -0,0 +1,116 @@
+import gzip
+import json
+import unittest
+
+import bottle
+
+from responses import (
+    accepts_gzip,
+    cached_json,
+    none_match,
+)
+
+
+def bind_request(**headers):
+    environ = {'REQUEST_METHOD': 'GET', 'PATH_INFO': '/v1/mock'}
+    for name, value in headers.items():
+        environ['HTTP_' + name.upper()] = value
+    bottle.request.bind(environ)
+    bottle.response.bind()
+
+
+class CachedJsonTestCase(unittest.TestCase):
+    """ polling clients get 304s and gzipped bodies """
+
+    def setUp(self):
+        self.data = {'items': [{'n': n} for n in range(200)], 'next': None}
+        self.handler = cached_json(lambda: self.data)
+
+    def test_etag(self):
+        bind_request()
+        body = self.handler()
+        self.assertEqual(json.loads(body.decode()), self.data)
+        self.assertEqual(bottle.response.content_type, 'application/json')
+        tag = bottle.response.get_header('ETag')
+
+        # the same data gets the same tag, and a 304 when it is sent back
+        bind_request(if_none_match=tag)
+        not_modified = self.handler()
+        self.assertIsInstance(not_modified, bottle.HTTPResponse)
+        self.assertEqual(not_modified.status_code, 304)
+        self.assertEqual(not_modified.get_header('ETag'), tag)
+
+        # changed data is sent in full with a new tag
+        self.data['next'] = 'mock-token'
+        bind_request(if_none_match=tag)
+        self.assertEqual(json.loads(self.handler().decode()), self.data)
+        self.assertNotEqual(bottle.response.get_header('ETag'), tag)
+
+    def test_gzip(self):
+        bind_request(accept_encoding='deflate, gzip;q=0.8')
+        body = self.handler()
+        self.assertEqual(bottle.response.get_header('Content-Encoding'), 'gzip')
+        self.assertEqual(json.loads(gzip.decompress(body).decode()), self.data)
+
+    def test_gzip_etag(self):
+        """ gzipped and identity bodies have different tags """
+        bind_request()
+        self.handler()
+        identity = bottle.response.get_header('ETag')
+        bind_request(accept_encoding='gzip')
+        self.handler()
+        gzipped = bottle.response.get_header('ETag')
+        self.assertEqual(gzipped, identity[:-1] + '-gzip"')
+
+        bind_request(accept_encoding='gzip', if_none_match=gzipped)
+        self.assertEqual(self.handler().status_code, 304)
+
+    def test_validator(self):
+        """ a validated 304 doesn't run the handler """
+        calls = []
+        version = [1]
+
+        def handler():
+            calls.append(1)
+            return self.data
+        handler = cached_json(handler, validator=lambda: version[0])
+
+        bind_request()
+        handler()
+        tag = bottle.response.get_header('ETag')
+        self.assertEqual(len(calls), 1)
+
+        bind_request(if_none_match=tag)
+        not_modified = handler()
+        self.assertEqual(not_modified.status_code, 304)
+        self.assertEqual(not_modified.get_header('ETag'), tag)
+        self.assertEqual(len(calls), 1)
+
+        # a gzipped copy is validated too
+        bind_request(accept_encoding='gzip', if_none_match=tag[:-1] + '-gzip"')
+        self.assertEqual(handler().status_code, 304)
+        self.assertEqual(len(calls), 1)
+
+        # a new version runs the handler
+        version[0] = 2
+        bind_request(if_none_match=tag)
+        self.assertEqual(json.loads(handler().decode()), self.data)
+        self.assertNotEqual(bottle.response.get_header('ETag'), tag)
+        self.assertEqual(len(calls), 2)
+
+    def test_small_bodies_are_not_gzipped(self):
+        self.data = {'items': [], 'next': None}
+        bind_request(accept_encoding='gzip')
+        self.assertEqual(json.loads(self.handler().decode()), self.data)
+        self.assertIsNone(bottle.response.get_header('Content-Encoding'))
+
+    def test_header_parsing(self):
+        self.assertTrue(none_match('"a", W/"b"', '"b"'))
+        self.assertTrue(none_match('*', '"b"'))
+        self.assertFalse(none_match(None, '"b"'))
+        self.assertFalse(none_match('"a"', '"b"'))
+
+        self.assertTrue(accepts_gzip('gzip'))
+        self.assertTrue(accepts_gzip('br, *'))
+        self.assertFalse(accepts_gzip('gzip;q=0'))
+        self.assertFalse(accepts_gzip(None))
@@ -0,0 +1,202 @@
+import csv
+import datetime
+import gzip
+import os
+import shutil
+import tempfile
+import unittest
+from unittest.mock import patch
+
+import psycopg2
+
+from m2 import retention
+from m2.handlers import (
+    handle_build,
+    handle_builds,
+)
+from testdb import start_postgres
+
+
+class ExpiredPartitionsTestCase(unittest.TestCase):
+
+    def test_expired_partitions(self):
+        ends = {
+            'release_y2015m11': datetime.datetime(2015, 12, 1),
+            'release_y2015m12': datetime.datetime(2016, 1, 1),
+            'release_y2016m01': datetime.datetime(2016, 2, 1),
+        }
+        self.assertEqual(
+            retention.expired_partitions(
+                ends,
+                datetime.timedelta(days=30),
+                now=datetime.datetime(2016, 1, 31),
+            ),
+            ['release_y2015m11', 'release_y2015m12'],
+        )
+
+
+class RetentionIntegrationCase(unittest.TestCase):
+    """ old months are archived and detached, keeping live branch heads """
+
+    def setUp(self):
+        os.environ['v2_model'] = 'false'
+        self.pg = start_postgres()
+        self.archive_dir = tempfile.mkdtemp()
+
+        # releases in december 2015, the last of branch b is its head
+        self.query("select create_release_partition('2015-12-01')")
+        handle_build('s', 'b', 'mb', 'c', 'i')
+        handle_build('s', 'b', 'mb', 'c2', 'i2')
+        handle_build('s', 'gone', 'mb', 'c3', 'i3')
+        self.query("update release set created_dt = '2015-12-01'::timestamp"
+                   " + release_id * interval '1 day'")
+        self.query("update branch set deleted_dt = now()"
+                   " where branch_name = 'gone'")
+        # and one this month
+        handle_build('s', 'b2', 'mb', 'c4', 'i4')
+
+    def tearDown(self):
+        self.pg.stop()
+        shutil.rmtree(self.archive_dir)
+
+    def query(self, sql, values=()):
+        """ execute a query and return the results """
+        conn = psycopg2.connect(**self.pg.dsn())
+        cursor = conn.cursor()
+        cursor.execute(sql, values)
+        try:
+            results = cursor.fetchall()
+        except:
+            results = []
+        conn.commit()
+        cursor.close()
+        conn.close()
+        return results
+
+    def test_dry_run(self):
+        self.assertEqual(
+            retention.retire(dry_run=True, horizon_days=60,
+                             archive_dir=self.archive_dir),
+            ['release_y2015m12'],
+        )
+        self.assertEqual(self.query("select count(*) from release"), [(4,)])
+        self.assertEqual(os.listdir(self.archive_dir), [])
+
+    def test_retire(self):
+        # run SUT
+        retired = retention.retire(horizon_days=60,
+                                   archive_dir=self.archive_dir)
+
+        self.assertEqual(retired, ['release_y2015m12'])
+        self.assertNotIn('release_y2015m12',
+                         retention.month_partition_ends())
+        with gzip.open(os.path.join(self.archive_dir,
+                                    'release_y2015m12.csv.gz'), 'rt') as f:
+            rows = list(csv.DictReader(f))
+        self.assertEqual([r['release_id'] for r in rows], ['1', '2', '3'])
+
+        # the live branch's head is kept, versions and all
+        self.assertEqual(
+            self.query(
+                """
+                select release.tableoid::regclass::text, commit_hash,
+                       branch_version_seq
+                  from release join iteration using (iteration_id)
+                 order by release_id
+                """),
+            [('release_default', 'c2', 1),
+             (retention.ensure_partitions(0)[0], 'c4', 1)],
+        )
+        # and versions carry on from it
+        self.query(
+            """
+            insert into release (iteration_id, config_id)
+            select iteration_id, config_id
+              from release join iteration using (iteration_id)
+             where commit_hash = 'c2'
+            """)
+        self.assertEqual(
+            self.query(
+                """
+                select max(branch_version_seq)
+                  from release join iteration using (iteration_id)
+                 where commit_hash = 'c2'
+                """),
+            [(2,)],
+        )
+
+        # nothing is left to retire
+        self.assertEqual(retention.retire(horizon_days=60,
+                                          archive_dir=self.archive_dir), [])
+
+    def test_retired_merge_base(self):
+        """ a branch cut from a retired commit gets its branch's config """
+        self.query("insert into config (key_value_pairs) values ('A=>a')")
+        self.query("update release set config_id = config.config_id"
+                   "  from config where key_value_pairs = 'A=>a'")
+
+        retention.retire(horizon_days=60, archive_dir=self.archive_dir)
+        # c's release is archived, its branch b's head c2 is kept
+        handle_build('s', 'b3', 'c', 'c5', 'i5')
+        handle_builds([dict(service_name='s', branch_name='b5',
+                            merge_base_commit_hash='c', commit_hash='c6',
+                            image_name='i6')])
+
+        self.assertEqual(
+            self.query(
+                """
+                select commit_hash, key_value_pairs
+                  from release
+                  join iteration using (iteration_id)
+                  join config using (config_id)
+                 where commit_hash in ('c5', 'c6')
+                 order by commit_hash
+                """),
+            [('c5', '"A"=>"a"'), ('c6', '"A"=>"a"')],
+        )
+
+    def test_changed_while_archiving(self):
+        """ a month that changes after its copy is left attached """
+        real_open = gzip.open
+
+        def insert_then_open(*args, **kwargs):
+            self.query("insert into release (iteration_id, config_id,"
+                       "                     created_dt)"
+                       " select iteration_id, config_id, '2015-12-20'"
+                       "   from release limit 1")
+            return real_open(*args, **kwargs)
+
+        with patch('m2.retention.gzip.open', side_effect=insert_then_open):
+            with self.assertRaises(RuntimeError):
+                retention.retire(horizon_days=60,
+                                 archive_dir=self.archive_dir)
+
+        self.assertIn('release_y2015m12', retention.month_partition_ends())
+        self.assertEqual(self.query("select count(*) from release"), [(5,)])
+        self.assertEqual(os.listdir(self.archive_dir), [])
+
+    def test_ensure_partitions(self):
+        names = retention.ensure_partitions(2)
+        self.assertEqual(len(names), 3)
+        self.assertTrue(set(names) <= set(retention.month_partition_ends()))
+
+    def test_late_partition(self):
+        """ releases in the default partition move into their month's """
+        self.query("insert into release (iteration_id, config_id, created_dt)"
+                   " select iteration_id, config_id, '2016-03-05'"
+                   "   from release limit 1")
+        self.assertEqual(
+            self.query("select count(*) from release_default"), [(1,)])
+
+        self.query("select create_release_partition('2016-03-01')")
+
+        self.assertEqual(
+            self.query("select count(*) from release_default"), [(0,)])
+        self.assertEqual(
+            self.query("select count(*) from release_y2016m03"), [(1,)])
+        self.assertEqual(self.query("select count(*) from release"), [(5,)])
+        # and making it again is a no-op
+        self.assertEqual(
+            self.query("select create_release_partition('2016-03-09')"),
+            [('release_y2016m03',)],
+        )
@@ -2,7 +2,10 @@ import os
 import unittest
 from unittest.mock import patch
 
-from security import restricted
+from security import (
+    authorized,
+    restricted,
+)
 
 
 def mock_handler(a, b, c):
@@ -60,3 +63,9 @@ class SecurityTestCase(unittest.TestCase):
 
     def test_can_pass(self):
         self.assertTrue(True)
+
+    def test_authorized(self):
+        """ the check both servers' restricted handlers make """
+        self.assertTrue(authorized({'X-Authenticated-Token': "CI"}))
+        self.assertFalse(authorized({'X-Authenticated-Token': "other"}))
+        self.assertFalse(authorized({}))
@@ -0,0 +1,137 @@
+import socket
+import threading
+import unittest
+
+from unittest.mock import patch
+from wsgiref.simple_server import make_server
+
+import bottle
+
+from server import (
+    server_adapter,
+    AsyncServer,
+    ThreadPoolServer,
+    ThreadPoolWSGIServer,
+    TimeoutHandler,
+)
+
+
+class ServerAdapterTestCase(unittest.TestCase):
+    """ server_mode picks the server __main__ runs """
+
+    def adapter(self, start_process=None, **settings):
+        def cfg(key, default=None):
+            return settings.get(key, default)
+        with patch('server.cfg', side_effect=cfg):
+            return server_adapter("0.0.0.0", "8000", start_process)
+
+    def test_default_mode(self):
+        """ bottle's own server is the default """
+        self.assertIsInstance(self.adapter(), bottle.WSGIRefServer)
+
+    def test_threaded_mode(self):
+        """ threaded mode uses the bounded thread pool """
+        adapter = self.adapter(server_mode='threaded',
+                               server_workers='3',
+                               server_queue_limit='5')
+        self.assertIsInstance(adapter, ThreadPoolServer)
+        self.assertEqual(adapter.options['workers'], 3)
+        self.assertEqual(adapter.options['queue_limit'], 5)
+
+    def test_prefork_mode(self):
+        """ prefork mode runs gunicorn's threaded workers """
+        adapter = self.adapter(server_mode='prefork', server_processes='2')
+        self.assertIsInstance(adapter, bottle.GunicornServer)
+        self.assertEqual(adapter.options['workers'], 2)
+        self.assertEqual(adapter.options['worker_class'], 'gthread')
+
+    def test_start_process(self):
+        """ each serving process is started, after the fork in prefork """
+        started = []
+        self.adapter(lambda: started.append('threaded'),
+                     server_mode='threaded')
+        self.assertEqual(started, ['threaded'])
+
+        adapter = self.adapter(lambda: started.append('prefork'),
+                               server_mode='prefork')
+        self.assertEqual(started, ['threaded'])
+        adapter.options['post_worker_init'](object())
+        self.assertEqual(started, ['threaded', 'prefork'])
+
+    def test_async_mode(self):
+        """ async mode runs the asyncio server """
+        adapter = self.adapter(server_mode='async', server_queue_limit='500')
+        self.assertIsInstance(adapter, AsyncServer)
+        self.assertEqual(adapter.options['backlog'], 500)
+
+    def test_unknown_mode(self):
+        with self.assertRaises(ValueError):
+            self.adapter(server_mode='mock')
+
+
+class ThreadPoolWSGIServerTestCase(unittest.TestCase):
+    """ the thread pool server bounds the requests it queues """
+
+    def setUp(self):
+        self.release = threading.Event()
+        self.started = threading.Event()
+
+        def app(environ, start_response):
+            self.started.set()
+            self.release.wait(5)
+            start_response('200 OK', [('Content-Length', '2')])
+            return [b'ok']
+
+        self.server = make_server(
+            "127.0.0.1", 0, app,
+            lambda address, handler_class: ThreadPoolWSGIServer(
+                address, handler_class, workers=1, queue_limit=0,
+                request_timeout=5),
+            TimeoutHandler,
+        )
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.start()
+
+    def tearDown(self):
+        self.release.set()
+        self.server.shutdown()
+        self.thread.join()
+        self.server.server_close()
+
+    def get(self):
+        conn = socket.create_connection(("127.0.0.1", self.server.server_port),
+                                        timeout=5)
+        conn.sendall(b"GET / HTTP/1.0\r\n\r\n")
+        return conn
+
+    def read(self, conn):
+        chunks = []
+        while True:
+            chunk = conn.recv(4096)
+            if not chunk:
+                break
+            chunks.append(chunk)
+        conn.close()
+        return b"".join(chunks)
+
+    def test_rejects_over_queue_limit(self):
+        """ a connection with no free worker or queue slot gets a 503 """
+        busy = self.get()
+        self.assertTrue(self.started.wait(5))
+
+        rejected = self.read(self.get())
+        self.assertTrue(rejected.startswith(b"HTTP/1.0 503"))
+        self.assertIn(b"Retry-After: 1", rejected)
+
+        self.release.set()
+        self.assertIn(b"200 OK", self.read(busy))
+
+    def test_drain(self):
+        """ drain waits for requests in flight """
+        busy = self.get()
+        self.assertTrue(self.started.wait(5))
+        self.assertFalse(self.server.drain(timeout=0.1))
+
+        self.release.set()
+        self.read(busy)
+        self.assertTrue(self.server.drain(timeout=5))
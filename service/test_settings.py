@@ -0,0 +1,71 @@
+import os
+import shutil
+import tempfile
+import unittest
+from unittest.mock import patch
+
+import settings
+
+
+class SettingsTestCase(unittest.TestCase):
+    """ config is served from a snapshot reloaded when /secret changes """
+
+    def setUp(self):
+        self.secret_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.secret_dir)
+
+        def cfg(key, default=None):
+            path = os.path.join(self.secret_dir, key)
+            if os.path.isfile(path):
+                with open(path) as f:
+                    return f.read().strip()
+            return os.environ.get(key, default)
+
+        for patcher in [
+            patch("settings.secret_dir", self.secret_dir),
+            patch("settings.config_finder.cfg", side_effect=cfg),
+            patch.dict(os.environ, {"mock-env-key": "from-env"}),
+        ]:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.addCleanup(settings.reload)
+
+        self.write("mock-secret-key", "from-secret")
+        settings.reload()
+
+    def write(self, key, value):
+        with open(os.path.join(self.secret_dir, key), 'w') as f:
+            f.write(value)
+
+    def test_cfg_from_snapshot(self):
+        """ keys from the secret dir and environment are served from memory """
+        self.assertEqual(settings.cfg("mock-secret-key"), "from-secret")
+        self.assertEqual(settings.cfg("mock-env-key"), "from-env")
+        self.assertEqual(settings.cfg("mock-missing-key", "dflt"), "dflt")
+
+        with patch("settings.config_finder.cfg") as mock_cfg, \
+                patch("settings.os.stat") as mock_stat:
+            settings.cfg("mock-secret-key")
+            mock_cfg.assert_not_called()
+            mock_stat.assert_not_called()
+
+    def test_snapshot_is_immutable(self):
+        with self.assertRaises(TypeError):
+            settings.snapshot["mock-secret-key"] = "changed"
+
+    def test_reload_when_secret_changes(self):
+        """ a changed secret is picked up by changed(), not before """
+        self.assertFalse(settings.changed())
+
+        self.write("mock-secret-key", "rotated")
+        os.utime(os.path.join(self.secret_dir, "mock-secret-key"),
+                 ns=(0, 1))
+        self.assertEqual(settings.cfg("mock-secret-key"), "from-secret")
+
+        self.assertTrue(settings.changed())
+        self.assertEqual(settings.cfg("mock-secret-key"), "rotated")
+
+    def test_reload_when_secret_added(self):
+        self.write("mock-new-key", "new")
+        self.assertTrue(settings.changed())
+        self.assertEqual(settings.cfg("mock-new-key"), "new")
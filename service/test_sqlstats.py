@@ -0,0 +1,97 @@
+import unittest
+from unittest.mock import patch
+
+import sqlstats
+from sqlstats import (
+    begin_request,
+    fingerprint,
+    record,
+    redact,
+    request_stats,
+    StatementStats,
+)
+
+
+class SqlStatsTestCase(unittest.TestCase):
+    """ statistics on executed sql """
+
+    def setUp(self):
+        sqlstats.local.stats = None
+        print_patcher = patch('sqlstats.print', create=True)
+        self.mock_print = print_patcher.start()
+
+    def tearDown(self):
+        patch.stopall()
+
+    def test_fingerprint(self):
+        """ queries differing only in values share a fingerprint """
+        self.assertEqual(
+            fingerprint("SELECT *\n  FROM iteration\n WHERE iteration_id=%s"),
+            "select * from iteration where iteration_id=?",
+        )
+        self.assertEqual(
+            fingerprint("select 1 from t where a = 'x' and b = 12"),
+            fingerprint("select 2 from t where a = 'it''s' and b = 7"),
+        )
+        self.assertEqual(
+            fingerprint("insert into t (a, b, c) values (%s, %s, %s)"),
+            "insert into t (a, b, c) values (?)",
+        )
+        self.assertEqual(
+            fingerprint("update t set a=%(a)s"),
+            "update t set a=?",
+        )
+
+    def test_redact(self):
+        """ bind parameters should only be logged as their types """
+        self.assertEqual(redact(("secret", 1)), ("<str>", "<int>"))
+        self.assertEqual(redact({"password": "x"}), {"password": "<str>"})
+        self.assertIsNone(redact(None))
+
+    def test_statement_stats(self):
+        """ stats aggregate by fingerprint """
+        stats = StatementStats()
+        stats.record("select ?", 0.5, 1)
+        stats.record("select ?", 0.25, 2)
+        stats.record("delete ?", 1.0, -1)
+
+        self.assertEqual(stats.count, 3)
+        self.assertEqual(stats.seconds, 1.75)
+        self.assertEqual(stats.summary(), [
+            ("delete ?",
+             {"count": 1, "seconds": 1.0, "max_seconds": 1.0, "rows": 0}),
+            ("select ?",
+             {"count": 2, "seconds": 0.75, "max_seconds": 0.5, "rows": 3}),
+        ])
+
+    def test_record_per_request_and_process(self):
+        """ statements count toward the process and the current request """
+        process_count = sqlstats.process_stats.count
+
+        # outside a request only the process sees it
+        record("select %s", (1,), 0.001, 1)
+        self.assertIsNone(request_stats())
+
+        stats = begin_request()
+        record("select %s", (2,), 0.001, 1)
+        record(b"select %s", (3,), 0.001, 1)
+
+        self.assertIs(request_stats(), stats)
+        self.assertEqual(stats.count, 2)
+        self.assertEqual(sqlstats.process_stats.count, process_count + 3)
+
+    def test_slow_query_log(self):
+        """ slow statements are logged without their values """
+        with patch('sqlstats.slow_query_ms', 100), \
+                patch('sqlstats.slow_query_log', None):
+            record("select * from t where pw=%s", ("hunter2",), 0.01, 1)
+            self.mock_print.assert_not_called()
+
+            record("select * from t where pw=%s", ("hunter2",), 0.2, 1)
+            self.mock_print.assert_called_once_with(
+                "slow sql (200.0ms, 1 rows) "
+                "select * from t where pw=? with args ('<str>',)"
+            )
+
+    def test_can_pass(self):
+        self.assertTrue(True)
@@ -0,0 +1,56 @@
+"""
+A postgres with herd's schema for the integration tests
+
+The base schema, then each later schema in version order, is loaded once
+into a template database when this is first imported. `start_postgres`
+starts a copy of it for a test and points the herd 2.x model's config at
+it. The template is removed when the test run ends.
+
+"""
+
+import atexit
+import glob
+import os
+import re
+
+import psycopg2
+import testing.postgresql
+
+import settings
+
+schema_dir = os.path.dirname(os.path.abspath(__file__))
+
+
+def schema_version(path):
+    return [int(n) for n in re.findall(r'\d+', os.path.basename(path))]
+
+
+def pg_init(pg):
+    conn = psycopg2.connect(**pg.dsn())
+    cursor = conn.cursor()
+    for path in sorted(glob.glob(os.path.join(schema_dir, 'schema-*.sql')),
+                       key=schema_version):
+        with open(path, 'r') as schema:
+            cursor.execute(schema.read())
+    conn.commit()
+    cursor.close()
+    conn.close()
+
+# Generate Postgresql class which shares the generated database
+Postgresql = testing.postgresql.PostgresqlFactory(
+    cache_initialized_db=True,
+    on_initialized=pg_init,
+)
+atexit.register(Postgresql.clear_cache)
+
+
+def start_postgres():
+    """ start a copy of the template database and configure herd to use it """
+    pg = Postgresql()
+    dsn = pg.dsn()
+    os.environ['pg-host'] = dsn['host']
+    os.environ['pg-port'] = str(dsn['port'])
+    os.environ['pg-database'] = dsn['database']
+    os.environ['pg-user'] = dsn['user']
+    settings.reload()
+    return pg